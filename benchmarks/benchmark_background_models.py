@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark comparing the background models in background_models.py.
+
+Frames are read once from a recorded video or a synthetic source. Each model
+then runs through the same roi_plan (background model + median blur + dilate
++ blob counting) on the same frames, so the reported per frame cost is the
+whole analysis cost of that model. Counts of every model are compared against
+the original 'knn' model (percentage of frames with the exact same count and
+the mean absolute count difference).
+
+The 'median' model uses the median of the first --background-frames frames
+as its static background, like the experiment manager does with its sample frames.
+
+Example:
+    python benchmark_background_models.py                      (synthetic frames)
+    python benchmark_background_models.py "video--2016-03-01 12.00.00.avi" --models knn median
+"""
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fly_group_activity_monitor'))
+
+import numpy as np
+
+import frame_sources
+import roi_analysis
+import background_models
+
+def read_frames(source, max_frames):
+    reader = source.open(grayscale=True)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = reader.read()
+        if not ret:
+            break
+        frames.append(frame)
+    reader.release()
+    return frames
+
+def run_model(bg_model, frames, background, counter):
+    """
+    Returns the per frame counts and per frame times (in sec) of one model
+    """
+    height, width = frames[0].shape[:2]
+    plan = roi_analysis.roi_plan(([0, 0], [width, height]), frames[0].shape, counter)
+    bg_subtractor = roi_analysis.create_bg_subtractor(bg_model, background)
+    timer = timeit.default_timer
+    counts = []
+    times = []
+    for frame in frames:
+        start = timer()
+        count, cropped = plan.process(bg_subtractor, frame, annotate=False)
+        times.append(timer() - start)
+        counts.append(count)
+    return np.array(counts), np.array(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', nargs='?', default='synthetic',
+                        help="video file, image directory or 'synthetic' (default)")
+    parser.add_argument('--max-frames', type=int, default=500)
+    parser.add_argument('--background-frames', type=int, default=60)
+    parser.add_argument('--counter', choices=roi_analysis.COUNTERS, default='contours')
+    parser.add_argument('--models', nargs='+', choices=background_models.BG_MODELS,
+                        default=list(background_models.BG_MODELS))
+    args = parser.parse_args()
+
+    source = frame_sources.frame_source_from_spec(args.source)
+    frames = read_frames(source, args.max_frames)
+    if not frames:
+        sys.exit("Could not read any frames from: {}".format(source))
+    print("Read {} frames ({}x{}) from {}".format(len(frames), frames[0].shape[1], frames[0].shape[0], source))
+    background = background_models.median_background(frames[:args.background_frames])
+
+    #knn is the reference every other model is compared against
+    models = ['knn'] + [bg_model for bg_model in args.models if bg_model != 'knn']
+    results = {}
+    for bg_model in models:
+        results[bg_model] = run_model(bg_model, frames, background, args.counter)
+
+    reference_counts, reference_times = results['knn']
+    print("{:<18}{:>12}{:>12}{:>12}{:>10}{:>12}{:>10}".format('model', 'mean (us)', 'median (us)', 'p99 (us)',
+                                                              'speedup', 'agree (%)', 'mad'))
+    for bg_model in models:
+        counts, times = results[bg_model]
+        print("{:<18}{:>12.1f}{:>12.1f}{:>12.1f}{:>9.2f}x{:>12.1f}{:>10.3f}".format(
+              bg_model, times.mean() * 1e6, np.median(times) * 1e6, np.percentile(times, 99) * 1e6,
+              reference_times.mean() / times.mean(), np.mean(counts == reference_counts) * 100,
+              np.abs(counts - reference_counts).mean()))
+
+if __name__ == '__main__':
+    main()
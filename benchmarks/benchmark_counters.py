@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark comparing the 'contours' (cv2.findContours) and 'components'
+(cv2.connectedComponentsWithStats) blob counters in roi_analysis.py.
+
+Motion masks are generated once (background subtraction + filtering) from a
+recorded video or a synthetic source and then both counters are timed on the
+exact same masks, so only the cost of counting is compared. Also reports
+how often the two counters agree on the count.
+
+Example:
+    python benchmark_counters.py                      (synthetic frames)
+    python benchmark_counters.py "video--2016-03-01 12.00.00.avi" --min-area 20
+"""
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fly_group_activity_monitor'))
+
+import numpy as np
+
+import frame_sources
+import roi_analysis
+
+def collect_masks(source, max_frames):
+    reader = source.open(grayscale=True)
+    bg_subtractor = roi_analysis.create_bg_subtractor()
+    plan = None
+    masks = []
+    while len(masks) < max_frames:
+        ret, frame = reader.read()
+        if not ret:
+            break
+        if plan is None:
+            height, width = frame.shape[:2]
+            plan = roi_analysis.roi_plan(([0, 0], [width, height]), frame.shape)
+        #the plan reuses its mask buffers for every frame, so keep copies
+        masks.append(plan.motion_mask(bg_subtractor, plan.crop(frame)).copy())
+    reader.release()
+    return masks
+
+def time_counter(count_func, masks, repeats, min_area, max_area):
+    """
+    Returns the per mask counts and the best of 'repeats' per mask times (in sec)
+    """
+    counts = [count_func(mask, min_area, max_area)[0] for mask in masks]
+    timer = timeit.default_timer
+    times = []
+    for mask in masks:
+        best = float('inf')
+        for x in range(repeats):
+            start = timer()
+            count_func(mask, min_area, max_area)
+            best = min(best, timer() - start)
+        times.append(best)
+    return np.array(counts), np.array(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', nargs='?', default='synthetic',
+                        help="video file, image directory or 'synthetic' (default)")
+    parser.add_argument('--max-frames', type=int, default=500)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--min-area', type=float, default=0)
+    parser.add_argument('--max-area', type=float, default=None)
+    args = parser.parse_args()
+
+    source = frame_sources.frame_source_from_spec(args.source)
+    masks = collect_masks(source, args.max_frames)
+    if not masks:
+        sys.exit("Could not read any frames from: {}".format(source))
+    print("Collected {} motion masks ({}x{}) from {}".format(len(masks), masks[0].shape[1], masks[0].shape[0], source))
+
+    results = {}
+    for name, count_func in (('contours', roi_analysis.count_contours),
+                             ('components', roi_analysis.count_components)):
+        results[name] = time_counter(count_func, masks, args.repeats, args.min_area, args.max_area)
+
+    print("{:<12}{:>14}{:>14}{:>14}".format('counter', 'mean (us)', 'median (us)', 'p99 (us)'))
+    for name in ('contours', 'components'):
+        times = results[name][1] * 1e6
+        print("{:<12}{:>14.1f}{:>14.1f}{:>14.1f}".format(name, times.mean(), np.median(times), np.percentile(times, 99)))
+
+    contour_counts, component_counts = results['contours'][0], results['components'][0]
+    agreement = np.mean(contour_counts == component_counts) * 100
+    print("Speedup (mean): {:.2f}x".format(results['contours'][1].mean() / results['components'][1].mean()))
+    print("Counts agree on {:.1f}% of masks (mean absolute difference: {:.3f})".format(
+          agreement, np.abs(contour_counts - component_counts).mean()))
+
+if __name__ == '__main__':
+    main()
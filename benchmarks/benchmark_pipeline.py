@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput, latency and counting accuracy benchmark of the whole analysis
+pipeline on synthetic arenas with known ground truth.
+
+Frames come from frame_sources.synthetic_arena_source: a grid of circular
+arenas with dark flies on a bright (IR backlit) floor that randomly start and
+stop walking, so the number of moving flies in every arena is known for
+every frame. Every combination of --resolutions, --arenas (one circle ROI per
+arena, see roi_analysis.plate_rois()) and --flies (flies per arena) is run
+and reports:
+    fps: analyzed frames per second
+    p50/p99 (ms): per frame latency (all ROIs of a frame)
+    MAE: mean absolute difference between counted and truly moving flies
+         per arena and frame (after the first --burn-in frames, while the
+         background models are still learning)
+    bias: mean signed difference (negative means flies are missed, i.e.
+          touching flies merging into one blob)
+
+Two analysis paths are timed on the same frames (frame rendering is not timed):
+    'get_activity_counts': roi_analysis.get_activity_counts() (a new
+                           roi_plan every call)
+    'roi_plan': roi_plans built once, as the experiment loop does
+
+With --end-to-end the full capture to results path is run as well: a headless
+experiment reads the synthetic source in its camera process, hands frames
+through the shared frame ring to the analysis loop (and --workers analysis
+processes) and writes .csv files. Its latencies are the 'analysis' stage of
+the experiment's stage_timing.json, its fps includes capture, the frame ring
+and result writing. Startup is the time it takes to set up the experiment.
+
+Example:
+    python benchmark_pipeline.py
+    python benchmark_pipeline.py --resolutions 1280x960 --arenas 4x6 --flies 5 10 --end-to-end --workers 4
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'fly_group_activity_monitor'))
+
+import numpy as np
+
+import frame_sources
+import roi_analysis
+import background_models
+
+#start_expt() waits this long for the camera process before the first frame
+START_EXPT_DELAY = 0.5
+
+def parse_pair(text):
+    first, second = text.lower().split('x')
+    return int(first), int(second)
+
+def count_errors(counts, truth, burn_in):
+    """
+    Mean absolute and mean signed error of (frames, arenas) counts against the ground truth
+    """
+    diff = (np.asarray(counts, dtype=float) - truth)[burn_in:]
+    if not diff.size:
+        return float('nan'), float('nan')
+    return np.abs(diff).mean(), diff.mean()
+
+def run_analysis(source, roi_list, roi_dict, args):
+    """
+    Time both analysis paths on the same frames. Returns
+    {path name: (per frame times (sec), (frames, arenas) counts)}
+    """
+    timer = timeit.default_timer
+    counter_kwargs = {"counter": args.counter}
+    reader = source.open(grayscale=not args.color)
+    ret, frame = reader.read()
+    plans = [roi_analysis.roi_plan(roi_dict[roi_name], frame.shape, **counter_kwargs) for roi_name in roi_list]
+    paths = ('get_activity_counts', 'roi_plan')
+    bg_subtractors = dict((path, [roi_analysis.create_bg_subtractor(args.bg_model) for roi_name in roi_list])
+                          for path in paths)
+    results = dict((path, ([], [])) for path in paths)
+    while ret:
+        start = timer()
+        counts = [roi_analysis.get_activity_counts(bg_subtractor, frame, roi_dict[roi_name],
+                                                   annotate=False, **counter_kwargs)[0]
+                  for roi_name, bg_subtractor in zip(roi_list, bg_subtractors['get_activity_counts'])]
+        results['get_activity_counts'][0].append(timer() - start)
+        results['get_activity_counts'][1].append(counts)
+        start = timer()
+        counts = [plan.process(bg_subtractor, frame, annotate=False)[0]
+                  for plan, bg_subtractor in zip(plans, bg_subtractors['roi_plan'])]
+        results['roi_plan'][0].append(timer() - start)
+        results['roi_plan'][1].append(counts)
+        ret, frame = reader.read()
+    reader.release()
+    return dict((path, (np.array(times), np.array(counts))) for path, (times, counts) in results.items())
+
+def run_end_to_end(source, roi_list, roi_dict, args):
+    """
+    Run a headless experiment on the source. Returns the startup time (sec),
+    analyzed frames per second, the 'analysis' stage summary of the
+    experiment's stage timer and the (frames, arenas) counts (NaN for
+    frames that were not analyzed)
+    """
+    #only imported here, the experiment manager pulls in a lot more than the analysis
+    import fly_activity_experiment_manager as manager
+    save_dir = tempfile.mkdtemp(prefix='benchmark_pipeline-')
+    try:
+        expt_dur = source.num_frames / source.fps + 1
+        start = timeit.default_timer()
+        expt = manager.experiment(write_csv=True, keep_results=True, headless=True,
+                                  expt_dur=expt_dur, stim_on_time=expt_dur, stim_dur=0,
+                                  roi_list=roi_list, roi_dict=roi_dict, default_save_dir=save_dir,
+                                  frame_source=source, analysis_workers=args.workers,
+                                  drop_policy='block', grayscale=not args.color,
+                                  counter=args.counter, bg_model=args.bg_model, time_stages=True)
+        startup = timeit.default_timer() - start
+        start = timeit.default_timer()
+        expt.start_expt()
+        elapsed = timeit.default_timer() - start - START_EXPT_DELAY
+        with open("{}/{}-stage_timing.json".format(expt.save_dir, expt.expt_timestring), 'r') as timing_file:
+            analysis_timing = json.load(timing_file)["stages"].get("analysis", {})
+    finally:
+        shutil.rmtree(save_dir, ignore_errors=True)
+    counts = np.full((source.num_frames, len(roi_list)), np.nan)
+    num_analyzed = 0
+    for roi_indx, roi_name in enumerate(roi_list):
+        for time_stamp, count, stim_bool in expt.results_dict[roi_name]:
+            frame_indx = int(round(time_stamp * source.fps))
+            if frame_indx < source.num_frames:
+                counts[frame_indx, roi_indx] = count
+        num_analyzed = max(num_analyzed, len(expt.results_dict[roi_name]))
+    return startup, num_analyzed / elapsed, analysis_timing, counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolutions', nargs='+', type=parse_pair, default=[(640, 480), (1280, 960)],
+                        help="frame sizes as WIDTHxHEIGHT (default: 640x480 1280x960)")
+    parser.add_argument('--arenas', nargs='+', type=parse_pair, default=[(1, 1), (2, 2), (4, 6)],
+                        help="arena grids as ROWSxCOLS (default: 1x1 2x2 4x6)")
+    parser.add_argument('--flies', nargs='+', type=int, default=[5, 20],
+                        help="flies per arena (default: 5 20)")
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--burn-in', type=int, default=60,
+                        help="frames left out of the count error (default: 60)")
+    parser.add_argument('--bg-model', default='knn',
+                        choices=[bg_model for bg_model in background_models.BG_MODELS if bg_model != 'median'])
+    parser.add_argument('--counter', default='contours', choices=roi_analysis.COUNTERS)
+    parser.add_argument('--color', action='store_true', help="analyze 3 channel instead of grayscale frames")
+    parser.add_argument('--end-to-end', action='store_true', help="also run the full experiment pipeline")
+    parser.add_argument('--workers', type=int, default=0, help="analysis workers of the end to end run")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write all results to this .json file")
+    args = parser.parse_args()
+
+    print("{:<11}{:>7}{:>6}  {:<20}{:>9}{:>11}{:>11}{:>8}{:>8}".format(
+          'resolution', 'arenas', 'flies', 'path', 'fps', 'p50 (ms)', 'p99 (ms)', 'MAE', 'bias'))
+    results = []
+    for width, height in args.resolutions:
+        for rows, cols in args.arenas:
+            for flies in args.flies:
+                source = frame_sources.synthetic_arena_source(height, width, args.frames, rows, cols, flies,
+                                                              seed=args.seed)
+                roi_list, roi_dict = roi_analysis.plate_rois(*source.arena_layout())
+                truth = source.ground_truth()
+                config = {"resolution": [width, height], "arenas": rows * cols, "flies_per_arena": flies}
+                runs = []
+                for path, (times, counts) in sorted(run_analysis(source, roi_list, roi_dict, args).items()):
+                    mae, bias = count_errors(counts, truth, args.burn_in)
+                    runs.append((path, {"fps": 1.0 / times.mean(), "p50_ms": np.median(times) * 1e3,
+                                        "p99_ms": np.percentile(times, 99) * 1e3, "mae": mae, "bias": bias}))
+                if args.end_to_end:
+                    startup, fps, analysis_timing, counts = run_end_to_end(source, roi_list, roi_dict, args)
+                    analyzed = ~np.isnan(counts[:, 0])
+                    mae, bias = count_errors(counts[analyzed], truth[analyzed], args.burn_in)
+                    runs.append(('end_to_end', {"fps": fps, "p50_ms": analysis_timing.get("p50_ms", float('nan')),
+                                                "p99_ms": analysis_timing.get("p99_ms", float('nan')),
+                                                "mae": mae, "bias": bias, "startup_sec": startup,
+                                                "frames_analyzed": int(analyzed.sum())}))
+                for path, run in runs:
+                    print("{:<11}{:>7}{:>6}  {:<20}{:>9.1f}{:>11.2f}{:>11.2f}{:>8.3f}{:>8.3f}".format(
+                          '{}x{}'.format(width, height), rows * cols, flies, path, run["fps"],
+                          run["p50_ms"], run["p99_ms"], run["mae"], run["bias"]))
+                    if "startup_sec" in run:
+                        print("{:<24}  startup {:.2f} sec, {} of {} frames analyzed".format(
+                              '', run["startup_sec"], run["frames_analyzed"], args.frames))
+                    result = dict(config)
+                    result.update(run)
+                    result["path"] = path
+                    results.append(result)
+                sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump({"frames": args.frames, "burn_in": args.burn_in, "bg_model": args.bg_model,
+                       "counter": args.counter, "grayscale": not args.color, "results": results},
+                      outfile, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
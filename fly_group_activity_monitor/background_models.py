@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Background models that can be used to find moving flies in an ROI.
+
+Every model has the same apply(image, fgmask=None) method as the OpenCV
+background subtractors and returns a binary (0/255) foreground mask, so they
+are interchangeable in roi_analysis.roi_plan.
+
+    'knn': cv2.createBackgroundSubtractorKNN (the original model)
+    'mog2': cv2.createBackgroundSubtractorMOG2
+    'running_average': exponentially weighted average background
+                       (cv2.accumulateWeighted) + absdiff/threshold
+    'frame_difference': absdiff/threshold against the previous frame
+    'median': absdiff/threshold against a static background, the median of
+              the sample frames collected before the experiment
+
+Under IR backlight the cheap models (everything but knn and mog2) are often
+good enough. See benchmarks/benchmark_background_models.py to compare them.
+"""
+import numpy as np
+import cv2
+
+BG_MODELS = ('knn', 'mog2', 'running_average', 'frame_difference', 'median')
+#history and threshold used when create_background_model() isn't given one
+DEFAULT_HISTORIES = {'knn': 5, 'mog2': 500}
+DEFAULT_THRESHOLDS = {'knn': 300, 'mog2': 16, 'running_average': 25, 'frame_difference': 25, 'median': 25}
+
+class _difference_model(object):
+    """
+    Base class for the simple models that threshold the absolute difference
+    between the (grayscale) current frame and a reference image.
+    Work buffers are allocated on the first frame and reused afterwards.
+    """
+    def __init__(self, threshold=25):
+        self.threshold = threshold
+        self.gray = None
+        self.diff = None
+
+    def _to_gray(self, image):
+        if image.ndim == 2:
+            return image
+        if self.gray is None:
+            self.gray = np.empty(image.shape[:2], np.uint8)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, self.gray)
+
+    def _threshold(self, reference, gray, fgmask):
+        if self.diff is None:
+            self.diff = np.empty(gray.shape, np.uint8)
+        cv2.absdiff(gray, reference, self.diff)
+        return cv2.threshold(self.diff, self.threshold, 255, cv2.THRESH_BINARY, fgmask)[1]
+
+class running_average_model(_difference_model):
+    """
+    alpha: weight of the newest frame in the running average background
+    """
+    def __init__(self, alpha=0.05, threshold=25):
+        _difference_model.__init__(self, threshold)
+        self.alpha = alpha
+        self.average = None
+        self.background = None
+
+    def apply(self, image, fgmask=None):
+        gray = self._to_gray(image)
+        if self.average is None:
+            self.average = gray.astype(np.float32)
+            self.background = gray.copy()
+        cv2.convertScaleAbs(self.average, self.background)
+        fgmask = self._threshold(self.background, gray, fgmask)
+        cv2.accumulateWeighted(gray, self.average, self.alpha)
+        return fgmask
+
+class frame_difference_model(_difference_model):
+    def __init__(self, threshold=25):
+        _difference_model.__init__(self, threshold)
+        self.previous = None
+
+    def apply(self, image, fgmask=None):
+        gray = self._to_gray(image)
+        if self.previous is None:
+            self.previous = gray.copy()
+        fgmask = self._threshold(self.previous, gray, fgmask)
+        np.copyto(self.previous, gray)
+        return fgmask
+
+class static_background_model(_difference_model):
+    """
+    background: the background image (i.e. median of the sample frames)
+    """
+    def __init__(self, background, threshold=25):
+        _difference_model.__init__(self, threshold)
+        self.background = self._to_gray(background).copy()
+
+    def apply(self, image, fgmask=None):
+        return self._threshold(self.background, self._to_gray(image), fgmask)
+
+def median_background(frames):
+    """
+    Pixelwise median of a list of frames
+    """
+    return np.median(np.array(frames), axis=0).astype(np.uint8)
+
+def create_background_model(bg_model='knn', background=None, history=None, threshold=None):
+    """
+    bg_model: one of BG_MODELS
+    background: static background image, only used (and required) by 'median'
+    history: number of frames in the model history ('knn' and 'mog2' only)
+    threshold: model specific foreground threshold (dist2Threshold for 'knn',
+               varThreshold for 'mog2', the absdiff threshold for the others)
+    None uses the default history/threshold of the model (0 is a valid value).
+    """
+    if history is None:
+        history = DEFAULT_HISTORIES.get(bg_model)
+    if threshold is None:
+        threshold = DEFAULT_THRESHOLDS.get(bg_model)
+    if bg_model == 'knn':
+        return cv2.createBackgroundSubtractorKNN(history, threshold, False)
+    elif bg_model == 'mog2':
+        return cv2.createBackgroundSubtractorMOG2(history, threshold, False)
+    elif bg_model == 'running_average':
+        return running_average_model(threshold=threshold)
+    elif bg_model == 'frame_difference':
+        return frame_difference_model(threshold)
+    elif bg_model == 'median':
+        if background is None:
+            raise ValueError("The 'median' background model needs a background image!")
+        return static_background_model(background, threshold)
+    raise ValueError('Unknown background model "{}"! Choose one of: {}'.format(bg_model, BG_MODELS))
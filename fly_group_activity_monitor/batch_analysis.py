@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Batch (offline) re-analysis of recorded experiment videos.
+
+Finds every 'video--<timestring>.avi' file in a directory tree and re-scores
+it with the same per-ROI analysis as experiment.start_expt(), writing the same
+'<timestring>-<roi_name>.csv' files. Videos are decoded as fast as the CPU
+allows (not at camera speed) with no plots or windows, and are spread over a
+pool of worker processes, one video per worker at a time.
+
+Output .csv files are written with the streaming_csv_writer so they only get
+their final name once a video has been completely analyzed. Videos whose
+.csv files all exist already are skipped, so an interrupted batch can simply
+be restarted (use --overwrite to redo them).
+
+Videos written by control_expt have already been corrected for lens
+distortion, so --calibration is only needed for videos that were not.
+The stimulation column can't be recovered from the video itself and is
+reconstructed from --stim-on-time and --stim-dur (no stimulation by default).
+
+Example:
+    python batch_analysis.py "D:/flyGrAM data" --rois FlyActivityAssay_ROIs.json
+    python batch_analysis.py "D:/flyGrAM data" --rois FlyActivityAssay_ROIs.json --output-dir "D:/rescored" --workers 6
+"""
+import os
+import sys
+import time
+import fnmatch
+import argparse
+import multiprocessing as mp
+
+import cv2
+
+import frame_sources
+import camera_calibration
+import roi_analysis
+import background_models
+import line_crossing
+from results_writer import streaming_csv_writer
+
+VIDEO_PREFIX = 'video--'
+
+def find_videos(root_dir, pattern=VIDEO_PREFIX + '*.avi'):
+    """
+    All files under root_dir (recursively) matching pattern, in sorted order
+    """
+    video_paths = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        for filename in fnmatch.filter(filenames, pattern):
+            video_paths.append(os.path.join(dirpath, filename))
+    return sorted(video_paths)
+
+def get_output_paths(video_path, roi_list, root_dir, output_dir=None):
+    """
+    .csv file paths (roi_name -> path) for a video, named like the ones
+    written by start_expt(). Without an output_dir they go next to the video,
+    otherwise into the same relative location under output_dir.
+    """
+    video_dir, video_fname = os.path.split(os.path.abspath(video_path))
+    timestring = os.path.splitext(video_fname)[0]
+    if timestring.startswith(VIDEO_PREFIX):
+        timestring = timestring[len(VIDEO_PREFIX):]
+    if output_dir:
+        video_dir = os.path.join(output_dir, os.path.relpath(video_dir, os.path.abspath(root_dir)))
+    return dict((roi_name, os.path.join(video_dir, "{}-{}.csv".format(timestring, roi_name))) for roi_name in roi_list)
+
+def crossings_path(roi_csv_path):
+    """
+    Line ROIs also get a '<timestring>-<line_name>_crossings.csv' file
+    """
+    return os.path.splitext(roi_csv_path)[0] + '_crossings.csv'
+
+def analyze_video(video_path, output_paths, roi_list, roi_dict, calibration=None, grayscale=False,
+                  counter='contours', min_area=0, max_area=None, bg_model='knn', analysis_scale=1.0,
+                  stim_on_time=None, stim_dur=0, background_frames=60):
+    """
+    Analyze every frame of one video and write one .csv file per ROI.
+    Returns the number of frames analyzed.
+    """
+    source = frame_sources.video_file_source(video_path)
+    reader = source.open(grayscale=grayscale)
+    frames = []
+    ret, frame = reader.read()
+    if not ret:
+        reader.release()
+        raise IOError('Could not read any frames from: {}'.format(video_path))
+    frame_height, frame_width = frame.shape[:2]
+    if analysis_scale != 1:
+        analysis_size = (max(1, int(round(frame_width * analysis_scale))),
+                         max(1, int(round(frame_height * analysis_scale))))
+        analysis_shape = (analysis_size[1], analysis_size[0]) + frame.shape[2:]
+    else:
+        analysis_size = None
+        analysis_shape = frame.shape
+
+    def prepare(frame):
+        if calibration is not None:
+            frame = calibration.undistort(frame)
+        if analysis_size:
+            frame = cv2.resize(frame, analysis_size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    #frames are only kept around to build the static 'median' background
+    frames.append((reader.frame_time, prepare(frame)))
+    if bg_model == 'median':
+        while len(frames) < background_frames:
+            ret, frame = reader.read()
+            if not ret:
+                break
+            frames.append((reader.frame_time, prepare(frame)))
+        background = background_models.median_background([frame for frame_time, frame in frames])
+    else:
+        background = None
+
+    counter_kwargs = roi_analysis.scale_counter_kwargs({"counter": counter, "min_area": min_area, "max_area": max_area},
+                                                       analysis_scale)
+    roi_plans = []
+    bg_subtractors = []
+    for roi_name in roi_list:
+        roi_coords = roi_analysis.scale_roi_coords(roi_dict[roi_name], analysis_scale)
+        if line_crossing.is_line_roi(roi_name):
+            roi_plans.append(line_crossing.line_crossing_detector(roi_coords, analysis_shape))
+            bg_subtractors.append(None)
+        else:
+            plan = roi_analysis.roi_plan(roi_coords, analysis_shape, **counter_kwargs)
+            roi_plans.append(plan)
+            bg_subtractors.append(roi_analysis.create_bg_subtractor(bg_model, None if background is None else plan.crop(background)))
+    work = list(zip(roi_list, roi_plans, bg_subtractors))
+    lines = [(roi_name, plan) for roi_name, plan in zip(roi_list, roi_plans) if line_crossing.is_line_roi(roi_name)]
+
+    for filepath in output_paths.values():
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+    csv_writer = streaming_csv_writer()
+    for roi_name in roi_list:
+        count_header = "Number of crossings" if line_crossing.is_line_roi(roi_name) else "Number of active flies"
+        csv_writer.add_table(roi_name, output_paths[roi_name],
+                             ["Time Elapsed (sec)", count_header, "Stimulation"])
+    for line_name, plan in lines:
+        csv_writer.add_table(line_name + '_crossings', crossings_path(output_paths[line_name]),
+                             ["Time Elapsed (sec)", "Position (px)", "Direction", "Stimulation"])
+
+    def analyze(time_stamp, frame):
+        stim_bool = stim_on_time is not None and stim_on_time <= time_stamp < stim_on_time + stim_dur
+        csv_writer.write_rows([(roi_name, [time_stamp, plan.process(bg_subtractor, frame, False)[0], stim_bool])
+                               for roi_name, plan, bg_subtractor in work])
+        for line_name, plan in lines:
+            events = plan.pop_events()
+            if events:
+                csv_writer.write_rows([(line_name + '_crossings', [time_stamp, position, direction, stim_bool])
+                                       for position, direction in events])
+
+    num_frames = len(frames)
+    for time_stamp, frame in frames:
+        analyze(time_stamp, frame)
+    frames = None
+    while True:
+        ret, frame = reader.read()
+        if not ret:
+            break
+        analyze(reader.frame_time, prepare(frame))
+        num_frames += 1
+    reader.release()
+    csv_writer.close()
+    return num_frames
+
+def _init_worker():
+    #one video per worker process, so keep OpenCV from starting its own
+    #threads in every worker
+    cv2.setNumThreads(1)
+
+def _analyze_video_job(job):
+    video_path, output_paths, roi_list, roi_dict, analysis_kwargs = job
+    start = time.time()
+    try:
+        num_frames = analyze_video(video_path, output_paths, roi_list, roi_dict, **analysis_kwargs)
+    except Exception as e:
+        return video_path, None, '{}: {}'.format(type(e).__name__, e)
+    return video_path, num_frames, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root_dir', help='directory (tree) containing the recorded videos')
+    parser.add_argument('--rois', required=True, help='ROI .json file saved by the GUI')
+    parser.add_argument('--calibration', default=None,
+                        help='camera calibration .json file (only for videos that were not undistorted)')
+    parser.add_argument('--output-dir', default=None, help='where to write .csv files (default: next to each video)')
+    parser.add_argument('--pattern', default=VIDEO_PREFIX + '*.avi', help='filename pattern of the videos')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--overwrite', action='store_true', help='redo videos that already have .csv files')
+    parser.add_argument('--grayscale', action='store_true')
+    parser.add_argument('--counter', choices=roi_analysis.COUNTERS, default='contours')
+    parser.add_argument('--min-area', type=float, default=0)
+    parser.add_argument('--max-area', type=float, default=None)
+    parser.add_argument('--bg-model', choices=background_models.BG_MODELS, default='knn')
+    parser.add_argument('--analysis-scale', type=float, default=1.0)
+    parser.add_argument('--stim-on-time', type=float, default=None)
+    parser.add_argument('--stim-dur', type=float, default=0)
+    args = parser.parse_args()
+
+    roi_list, roi_dict = roi_analysis.load_roi_file(args.rois)
+    calibration = camera_calibration.camera_calibration.from_file(args.calibration) if args.calibration else None
+    analysis_kwargs = {"calibration": calibration, "grayscale": args.grayscale,
+                       "counter": args.counter, "min_area": args.min_area, "max_area": args.max_area,
+                       "bg_model": args.bg_model, "analysis_scale": args.analysis_scale,
+                       "stim_on_time": args.stim_on_time, "stim_dur": args.stim_dur}
+
+    video_paths = find_videos(args.root_dir, args.pattern)
+    jobs = []
+    for video_path in video_paths:
+        output_paths = get_output_paths(video_path, roi_list, args.root_dir, args.output_dir)
+        expected_paths = list(output_paths.values()) + [crossings_path(output_paths[roi_name]) for roi_name in roi_list 
+                                                        if line_crossing.is_line_roi(roi_name)]
+        if not args.overwrite and all(os.path.isfile(filepath) for filepath in expected_paths):
+            continue
+        jobs.append((video_path, output_paths, roi_list, roi_dict, analysis_kwargs))
+    print("Found {} videos, {} already analyzed, {} to go".format(len(video_paths), len(video_paths) - len(jobs), len(jobs)))
+    sys.stdout.flush()
+    if not jobs:
+        return
+
+    num_workers = max(1, min(args.workers or mp.cpu_count(), len(jobs)))
+    pool = mp.Pool(num_workers, _init_worker)
+    failed = 0
+    try:
+        for indx, (video_path, num_frames, result) in enumerate(pool.imap_unordered(_analyze_video_job, jobs)):
+            if num_frames is None:
+                failed += 1
+                print("[{}/{}] FAILED {} ({})".format(indx + 1, len(jobs), video_path, result))
+            else:
+                print("[{}/{}] {} ({} frames, {:.1f} fps)".format(indx + 1, len(jobs), video_path,
+                                                                  num_frames, num_frames/max(result, 1e-9)))
+            sys.stdout.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        #finished videos are kept, unfinished ones only left .partial files
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    if failed:
+        sys.exit("{} videos could not be analyzed!".format(failed))
+
+if __name__ == '__main__':
+    main()
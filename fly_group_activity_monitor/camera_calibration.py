@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Camera calibration object that corrects radial "fisheye" lens distortion.
+
+Running cv2.getOptimalNewCameraMatrix() and cv2.undistort() on every frame
+rebuilds the whole rectification model each time. Instead, the
+cv2.initUndistortRectifyMap() lookup tables (in the compact fixed point
+CV_16SC2 format) are built once per frame size and every frame is corrected
+with a single cv2.remap() call, which gives the same result as cv2.undistort().
+
+When the calibration was loaded from a .json file, the lookup tables are saved
+next to it (i.e. Camera_calibration_matrices_remap_640x480.npz) so that they
+load instantly the next time. Saved tables are only reused if they were built
+from the same camera matrix and distortion coefficients.
+"""
+import os
+import json
+import hashlib
+
+import numpy as np
+import cv2
+
+class camera_calibration(object):
+    """
+    camera_matrix, dist_coeff, reprojection_error: as produced by cv2.calibrateCamera()
+    filepath: (optional) the calibration .json file, used to persist remap tables
+    """
+    def __init__(self, camera_matrix, dist_coeff, reprojection_error=None, filepath=None):
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+        self.dist_coeff = np.asarray(dist_coeff, dtype=np.float64)
+        self.reprojection_error = reprojection_error
+        self.filepath = filepath
+        #(width, height) -> (map1, map2)
+        self._remap_tables = {}
+
+    @classmethod
+    def from_file(cls, filepath):
+        with open(filepath, 'r') as data_file:
+            data = json.load(data_file)
+        return cls(data["camera_matrix"], data["dist_coeff"],
+                   data.get("reprojection_error"), filepath=os.path.abspath(filepath))
+
+    @classmethod
+    def from_dict(cls, calibration_data):
+        """
+        Create a calibration from the dictionaries used throughout the GUI
+        and experiment manager ("camera_matrix", "dist_coeff", etc...)
+        """
+        if isinstance(calibration_data, cls):
+            return calibration_data
+        return cls(calibration_data["camera_matrix"], calibration_data["dist_coeff"],
+                   calibration_data.get("reprojection_error"),
+                   filepath=calibration_data.get("filepath"))
+
+    def to_dict(self):
+        return {"reprojection_error": self.reprojection_error,
+                "camera_matrix": self.camera_matrix,
+                "dist_coeff": self.dist_coeff,
+                "filepath": self.filepath}
+
+    def fingerprint(self):
+        """
+        Hash of the calibration used to check that saved tables still match
+        """
+        sha = hashlib.sha1()
+        sha.update(self.camera_matrix.tobytes())
+        sha.update(self.dist_coeff.tobytes())
+        return sha.hexdigest()
+
+    def remap_table_path(self, frame_width, frame_height):
+        if not self.filepath:
+            return None
+        base_path = os.path.splitext(self.filepath)[0]
+        return '{}_remap_{}x{}.npz'.format(base_path, frame_width, frame_height)
+
+    def _build_remap_tables(self, frame_width, frame_height):
+        size = (frame_width, frame_height)
+        newcameramtx, region = cv2.getOptimalNewCameraMatrix(self.camera_matrix, self.dist_coeff, size, 1, size)
+        return cv2.initUndistortRectifyMap(self.camera_matrix, self.dist_coeff, None,
+                                           newcameramtx, size, cv2.CV_16SC2)
+
+    def _load_remap_tables(self, table_path):
+        if not table_path or not os.path.exists(table_path):
+            return None
+        try:
+            saved = np.load(table_path)
+            if str(saved["fingerprint"]) == self.fingerprint():
+                return saved["map1"], saved["map2"]
+        except (IOError, ValueError, KeyError):
+            pass
+        print("Saved undistortion tables at {} are out of date, rebuilding them!".format(table_path))
+        return None
+
+    def _save_remap_tables(self, table_path, map1, map2):
+        try:
+            with open(table_path, 'wb') as outfile:
+                np.savez(outfile, map1=map1, map2=map2, fingerprint=self.fingerprint())
+        except (IOError, OSError):
+            print("Could not save undistortion tables to: {}".format(table_path))
+
+    def get_remap_tables(self, frame_width, frame_height):
+        """
+        Returns the (map1, map2) cv2.remap() lookup tables for a frame size.
+        Tables are looked up in memory, then on disk and only built if needed.
+        """
+        key = (frame_width, frame_height)
+        if key not in self._remap_tables:
+            table_path = self.remap_table_path(frame_width, frame_height)
+            tables = self._load_remap_tables(table_path)
+            if tables is None:
+                tables = self._build_remap_tables(frame_width, frame_height)
+                if table_path:
+                    self._save_remap_tables(table_path, *tables)
+            self._remap_tables[key] = tables
+        return self._remap_tables[key]
+
+    def undistort(self, input_frame, dst=None):
+        """
+        Correct lens distortion in a frame. If dst is given (i.e. a preallocated
+        buffer of the same shape), the corrected frame is written into it.
+        """
+        h, w = input_frame.shape[:2]
+        map1, map2 = self.get_remap_tables(w, h)
+        return cv2.remap(input_frame, map1, map2, cv2.INTER_LINEAR, dst=dst)
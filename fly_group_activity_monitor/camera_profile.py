@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Persisted profile of a live camera: its measured frame rate, the size of the
+frames it delivers and how many frames it needs after opening before auto
+exposure/gain has settled.
+
+Measuring these used to be done on every experiment start (reading 5x30
+frames to time the camera, 60 sample frames and 30 warm-up frames, each time
+opening the camera again), which took many seconds and reset the camera
+repeatedly. Now a camera is measured once, the first time it is used, and its
+profile is saved to a .json file (DEFAULT_PROFILE_FILE, keyed by camera
+device) that every later run reuses:
+    {"0": {"fps": 29.97, "frame_width": 640, "frame_height": 480,
+           "channels": 3, "warmup_frames": 6, "measured": "2016-03-01 12.00.00"}}
+
+With a profile, the experiment knows the frame size (and so can create its
+shared frame ring) without opening the camera. The camera is then opened only
+once, by the control_expt() capture process, which sends the sample frames
+the experiment needs back to it.
+
+If a camera changes (i.e. a different camera is plugged in), delete its entry
+or call get_camera_profile(..., remeasure=True).
+"""
+import os
+import json
+import time
+
+import numpy as np
+
+from capture_scheduler import clock
+
+DEFAULT_PROFILE_FILE = "Camera_profiles.json"
+#auto exposure has settled once the mean brightness of SETTLE_FRAMES
+#consecutive frames changes by less than SETTLE_TOLERANCE (fraction)
+SETTLE_FRAMES = 3
+SETTLE_TOLERANCE = 0.01
+MAX_WARMUP_FRAMES = 60
+#number of frames timed to measure the frame rate
+NUM_FPS_FRAMES = 30
+
+class camera_profile(object):
+    """
+    device: the cv2.VideoCapture device index of the camera
+    fps: measured frame rate
+    frame_width, frame_height, channels: size of the frames the camera delivers
+    warmup_frames: frames to discard after opening the camera
+    measured: when the profile was measured
+    """
+    def __init__(self, device, fps, frame_width, frame_height, channels=3, warmup_frames=0, measured=None):
+        self.device = device
+        self.fps = float(fps)
+        self.frame_width = int(frame_width)
+        self.frame_height = int(frame_height)
+        self.channels = int(channels)
+        self.warmup_frames = int(warmup_frames)
+        self.measured = measured
+
+    def frame_shape(self, grayscale=False):
+        """
+        Shape of the frames read from the camera (see frame_sources.frame_reader)
+        """
+        if grayscale or self.channels == 1:
+            return (self.frame_height, self.frame_width)
+        return (self.frame_height, self.frame_width, self.channels)
+
+    @classmethod
+    def from_dict(cls, device, data):
+        return cls(device, data["fps"], data["frame_width"], data["frame_height"],
+                   data.get("channels", 3), data.get("warmup_frames", 0), data.get("measured"))
+
+    def to_dict(self):
+        return {"fps": self.fps, "frame_width": self.frame_width, "frame_height": self.frame_height,
+                "channels": self.channels, "warmup_frames": self.warmup_frames, "measured": self.measured}
+
+    def __repr__(self):
+        return 'camera_profile(device={}, {:.2f} fps, {}x{}, {} warm-up frames)'.format(
+               self.device, self.fps, self.frame_width, self.frame_height, self.warmup_frames)
+
+def _read_profiles(filepath):
+    if not os.path.exists(filepath):
+        return {}
+    try:
+        with open(filepath, 'r') as data_file:
+            return json.load(data_file)
+    except (IOError, ValueError):
+        print("Could not read camera profiles from: {}".format(filepath))
+        return {}
+
+def _write_profiles(profiles, filepath):
+    try:
+        with open(filepath, 'w') as outfile:
+            json.dump(profiles, outfile, indent=2, sort_keys=True)
+    except (IOError, OSError):
+        print("Could not save camera profiles to: {}".format(filepath))
+
+def load_camera_profile(device, filepath=DEFAULT_PROFILE_FILE):
+    """
+    The saved profile of a camera device or None if it was never measured
+    """
+    data = _read_profiles(filepath).get(str(device))
+    if not data:
+        return None
+    try:
+        return camera_profile.from_dict(device, data)
+    except (KeyError, TypeError, ValueError):
+        print("Saved camera profile of device {} in {} is invalid, measuring it again!".format(device, filepath))
+        return None
+
+def save_camera_profile(profile, filepath=DEFAULT_PROFILE_FILE):
+    profiles = _read_profiles(filepath)
+    profiles[str(profile.device)] = profile.to_dict()
+    _write_profiles(profiles, filepath)
+
+def remove_camera_profile(device, filepath=DEFAULT_PROFILE_FILE):
+    """
+    Forget the profile of a camera device so it is measured again next time
+    """
+    profiles = _read_profiles(filepath)
+    if profiles.pop(str(device), None) is not None:
+        _write_profiles(profiles, filepath)
+
+def measure_camera(cam, device):
+    """
+    Profile an opened camera (a frame_sources.frame_reader). Frames are read
+    until auto exposure has settled (the number of frames this took is the
+    warm-up needed), then NUM_FPS_FRAMES frames are timed.
+    """
+    brightness = []
+    frame = None
+    num_read = 0
+    while num_read < MAX_WARMUP_FRAMES:
+        ret, new_frame = cam.read()
+        num_read += 1
+        if not ret:
+            continue
+        frame = new_frame
+        brightness.append(float(np.mean(frame[::8, ::8])))
+        if len(brightness) > SETTLE_FRAMES:
+            recent = np.array(brightness[-SETTLE_FRAMES - 1:])
+            if np.all(np.abs(np.diff(recent)) <= SETTLE_TOLERANCE * max(1.0, recent.mean())):
+                break
+    if frame is None:
+        raise IOError('Could not read any frames from camera device: {}'.format(device))
+    warmup_frames = max(0, num_read - SETTLE_FRAMES)
+
+    start = clock()
+    num_timed = 0
+    for x in range(NUM_FPS_FRAMES):
+        ret, new_frame = cam.read()
+        if ret:
+            frame = new_frame
+            num_timed += 1
+    elapsed = clock() - start
+    if not num_timed or elapsed <= 0:
+        raise IOError('Could not measure the frame rate of camera device: {}'.format(device))
+    channels = frame.shape[2] if frame.ndim == 3 else 1
+    return camera_profile(device, num_timed / elapsed, frame.shape[1], frame.shape[0], channels,
+                          warmup_frames, time.strftime("%Y-%m-%d %H.%M.%S"))
+
+def get_camera_profile(frame_source, filepath=DEFAULT_PROFILE_FILE, remeasure=False, cam=None):
+    """
+    The profile of a frame_sources.camera_source. It is loaded from filepath
+    if the camera was measured before, otherwise the camera is measured (and
+    the profile saved) now. If the camera is already open, pass its (color)
+    frame_reader as cam to measure with it instead of opening it again.
+    """
+    profile = None if remeasure else load_camera_profile(frame_source.device, filepath)
+    if profile is None:
+        print("Measuring camera device {}, this is only done the first time a camera is used...".format(frame_source.device))
+        if cam is not None:
+            profile = measure_camera(cam, frame_source.device)
+        else:
+            #measure the raw (color) frames the camera delivers
+            cam = frame_source.open()
+            try:
+                profile = measure_camera(cam, frame_source.device)
+            finally:
+                cam.release()
+        save_camera_profile(profile, filepath)
+        print("Saved {} to: {}".format(profile, filepath))
+    return profile
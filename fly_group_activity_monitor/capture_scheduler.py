@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Deadline based frame capture scheduler for the control_expt() camera loop.
+
+Frame n is scheduled for start_time + n/fps. Instead of busy waiting (which
+pins a whole CPU core) the scheduler sleeps until shortly before the next
+deadline. Because deadlines are computed from the start time rather than from
+the previous frame, timing errors never accumulate (no drift). If capture falls
+more than a whole frame period behind, the missed frame slots are skipped (and
+counted) instead of capturing a burst of frames to catch up.
+"""
+import sys
+import time
+
+#time.clock() measures CPU time on Linux and was removed in python 3.8
+#so use a monotonic high resolution wall clock
+if hasattr(time, 'perf_counter'):
+    clock = time.perf_counter
+elif sys.platform == 'win32':
+    #On windows python 2.7 time.clock() is a high resolution wall clock
+    clock = time.clock
+else:
+    clock = time.time
+
+class capture_scheduler(object):
+    """
+    fps: target frame rate. An fps of None or 0 never waits.
+    spin_margin: time (in seconds) before a deadline at which sleeping stops
+                 and a short spin takes over (sleep() can overshoot on some OSes)
+    """
+    def __init__(self, fps, spin_margin=0.002):
+        self.period = 1/float(fps) if fps else 0.0
+        self.spin_margin = spin_margin
+        self.start_time = None
+        self.frame_indx = 0
+        self.missed_slots = 0
+
+    def start(self):
+        self.start_time = clock()
+        self.frame_indx = 0
+        self.missed_slots = 0
+
+    def elapsed(self):
+        """
+        Time in seconds since start() was called
+        """
+        return clock() - self.start_time
+
+    def wait_for_next_frame(self):
+        """
+        Sleep until the next frame slot is due.
+        Returns the time (relative to start()) the frame was scheduled for.
+        """
+        scheduled_time = self.frame_indx * self.period
+        remaining = scheduled_time - self.elapsed()
+
+        if self.period and remaining < -self.period:
+            #we've fallen more than one frame behind, skip the missed slots
+            missed = int(-remaining // self.period)
+            self.missed_slots += missed
+            self.frame_indx += missed
+            scheduled_time = self.frame_indx * self.period
+        else:
+            if remaining > self.spin_margin:
+                time.sleep(remaining - self.spin_margin)
+            deadline = self.start_time + scheduled_time
+            while clock() < deadline:
+                pass
+
+        self.frame_indx += 1
+        return scheduled_time
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight centroid tracker used to estimate how far (and how fast) the
+moving flies in an ROI travel.
+
+Every frame, the centroids of the blobs found in an ROI are linked to the
+centroids of the previous frame. Links are mutual nearest neighbours (the
+closest current blob of a previous blob, which in turn has that previous blob
+as its closest one) that are no further apart than max_distance. The whole
+association is done on the (previous x current) distance matrix with NumPy,
+there is no per fly Python loop, so dozens of flies per ROI are no problem.
+
+Blobs that were not linked (flies that just started or stopped moving, or
+merged/split blobs) simply don't contribute to the distance travelled.
+"""
+import numpy as np
+
+def match_centroids(prev_centroids, centroids, max_distance):
+    """
+    Gated mutual nearest neighbour matching of two (n, 2) arrays of centroids.
+    Returns the indices of the linked previous centroids, the indices of the
+    linked current centroids and the distance of every link
+    """
+    if len(prev_centroids) == 0 or len(centroids) == 0:
+        empty = np.zeros(0, np.intp)
+        return empty, empty, np.zeros(0)
+    deltas = prev_centroids[:, np.newaxis, :] - centroids[np.newaxis, :, :]
+    distances = np.sqrt((deltas**2).sum(axis=2))
+    nearest_current = distances.argmin(axis=1)
+    nearest_prev = distances.argmin(axis=0)
+    prev_indxs = np.arange(len(prev_centroids))
+    link_distances = distances[prev_indxs, nearest_current]
+    keep = (nearest_prev[nearest_current] == prev_indxs) & (link_distances <= max_distance)
+    return prev_indxs[keep], nearest_current[keep], link_distances[keep]
+
+class centroid_tracker(object):
+    """
+    Accumulates the distance travelled by the flies in one ROI.
+
+    max_distance: largest distance (in analyzed pixels) a fly can move between
+                  two frames and still be linked
+    px_scale: factor to convert analyzed pixels into reported pixels (i.e.
+              1/analysis_scale to report distances at full camera resolution)
+    """
+    def __init__(self, max_distance=20.0, px_scale=1.0):
+        self.max_distance = max_distance
+        self.px_scale = px_scale
+        self.prev_centroids = np.zeros((0, 2))
+        self.prev_time = None
+        #distance moved by all linked flies in the most recent frame
+        self.last_distance = 0.0
+        self.total_distance = 0.0
+        #sum over all links of the time between their frames (fly-seconds)
+        self.total_time = 0.0
+        self.num_links = 0
+
+    def update(self, centroids, time_stamp):
+        """
+        centroids: (n, 2) array of the blob centroids in the current frame
+        Returns the distance moved by all linked flies since the previous frame
+        """
+        prev_indxs, indxs, link_distances = match_centroids(self.prev_centroids, centroids, self.max_distance)
+        self.last_distance = link_distances.sum() * self.px_scale
+        self.total_distance += self.last_distance
+        self.num_links += len(link_distances)
+        if self.prev_time is not None and time_stamp > self.prev_time:
+            self.total_time += (time_stamp - self.prev_time) * len(link_distances)
+        self.prev_centroids = centroids
+        self.prev_time = time_stamp
+        return self.last_distance
+
+    @property
+    def mean_speed(self):
+        """
+        Mean speed (pixels/sec) of the linked flies over the whole run
+        """
+        return self.total_distance / self.total_time if self.total_time else 0.0
+
+    def summary(self):
+        return {"total_distance": self.total_distance, "mean_speed": self.mean_speed,
+                "num_links": self.num_links}
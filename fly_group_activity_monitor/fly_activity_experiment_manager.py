@@ -30,26 +30,26 @@ import os
 import sys
 import time
 import json
-import timeit
 import serial
 
-#import cProfile
-#profiler = cProfile.Profile()
-#if sys.platform == 'win32' or sys.platform == "darwin":
-#    desktop_path = os.path.abspath(os.path.expanduser("~/Desktop/"))
-
 import serial.tools.list_ports as lp
 import numpy as np
-import matplotlib.pyplot as plt
 import multiprocessing as mp
-import subprocess as sp
 
-from functools import wraps
-from itertools import chain
-from collections import deque
 
 import cv2
-import roi
+import frame_sources
+import shared_frame_buffer
+import camera_calibration
+import camera_profile
+import roi_analysis
+import background_models
+import line_crossing
+from video_writer import async_video_writer
+from capture_scheduler import capture_scheduler, clock
+from results_writer import streaming_csv_writer
+from stage_timing import stage_timer
+from live_display import live_plot_renderer, tracking_display
 
 #Note to self: Using interactive interpreter elements works horribly with multiprocessing...
 #Ipython functionality to disable inline matplotlib plots
@@ -60,20 +60,54 @@ import roi
 #Location of your ffmpeg.exe file in order to write video out
 FFMPEG_BIN = u'C:/FFMPEG/bin/ffmpeg.exe'
 
+#message the camera process sends ahead of the first frame when timing stages
+CLOCK_START_MSG = 'clock_start'
+#seconds to wait for the camera process to send back its stage timer
+TIMER_TIMEOUT = 2.0
+
+#colors used to draw ROIs that are set interactively
+ROI_COLORS = ['blue', 'red', 'green', 'purple', 'orange', 'cyan', 'magenta', 'yellow']
+
+#number of sample frames the static 'median' background is made from
+MEDIAN_SAMPLE_FRAMES = 60
+#how long to wait (sec) for the camera process to send its sample frames
+SAMPLE_FRAME_TIMEOUT = 30
+
 #%%
 def correct_distortion(input_frame, calib_mtx, calib_dist):
     """
     Function that applies correction for radial "fisheye" lens distortion
     make sure you've already loaded the relevant calibration correction matrices
     with the 'read_cam_calibration_file()' function at some point...
+    
+    Note: this rebuilds the undistortion model on every call. For repeated 
+    calls use a camera_calibration.camera_calibration object which caches it.
     """
-    h, w = input_frame.shape[:2]        
-    #apply undistortion
-    newcameramtx, region = cv2.getOptimalNewCameraMatrix(calib_mtx,calib_dist,(w,h),1,(w,h))
-    corrected_frame = cv2.undistort(input_frame, calib_mtx, calib_dist, None, newcameramtx)         
-    return corrected_frame
+    return camera_calibration.camera_calibration(calib_mtx, calib_dist).undistort(input_frame)
 
 #%%
+def receive_sample_frames(parent_conn, frame_source, frame_shape, 
+                          profile_file=camera_profile.DEFAULT_PROFILE_FILE,
+                          timeout=SAMPLE_FRAME_TIMEOUT):
+    """
+    Sample frames sent back by a control_expt() process (see num_sample_frames).
+    frame_shape is the shape the camera profile says the frames have (and the
+    frame ring was made for). If the camera delivers frames of another size
+    its profile is out of date, so it is removed (the camera will be measured
+    again next time) and an IOError is raised.
+    """
+    if not parent_conn.poll(timeout):
+        raise IOError('The camera process did not send any sample frames from: {}'.format(frame_source))
+    sample_frames = parent_conn.recv()
+    if not sample_frames:
+        raise IOError('Could not read any frames from: {}'.format(frame_source))
+    if sample_frames[-1].shape != tuple(frame_shape):
+        camera_profile.remove_camera_profile(frame_source.device, profile_file)
+        raise IOError('{} delivers {} frames but its camera profile expected {}! '
+                      'The profile was removed, start again to measure the camera.'.format(frame_source, 
+                      sample_frames[-1].shape, tuple(frame_shape)))
+    return sample_frames
+
 def find_arduinos():
     """
     Function that scans serial ports to look for Arduinos
@@ -84,10 +118,11 @@ def find_arduinos():
     return [port[0] for port in ports if "Arduino" in port[1]]
 
 #%%
-def control_expt(child_conn_obj, data_q_obj, use_arduino, expt_dur, led_freq, led_dur, 
-                 stim_on_time, stim_dur, calib_mtx, calib_dist,
+def control_expt(child_conn_obj, frame_ring_obj, use_arduino, expt_dur, led_freq, led_dur, 
+                 stim_on_time, stim_dur, calibration,
                  write_video, frame_height, frame_width, fps_cap,
-                 default_save_dir):
+                 default_save_dir, frame_source, grayscale=False, analysis_size=None,
+                 time_stages=False, num_sample_frames=0):
     """
     This function contains the camera read() loop, controls
     the timing/freq/duration for when the arduino turns on and off the 
@@ -98,6 +133,9 @@ def control_expt(child_conn_obj, data_q_obj, use_arduino, expt_dur, led_freq, le
     its own process using multiprocessing (mp) see the experiment class for the
     initialization.
     
+    Frames are handed to the analysis loop through a shared memory ring buffer
+    (frame_ring_obj, see shared_frame_buffer.py) so they are never pickled.
+    
     #experiment relevant options
     expt_dur: duration of the entire experiment (in seconds)
     led_freq: frequency of LED flashes (Hz)
@@ -114,10 +152,30 @@ def control_expt(child_conn_obj, data_q_obj, use_arduino, expt_dur, led_freq, le
     #other
     use_arduino: specify whether to use an arduino for opto stim or not
     fps_cap: specify a maximum framerate cap to capture at
+    calibration: a camera_calibration.camera_calibration object (or None) 
+                 used to correct lens distortion
+    frame_source: a frame_sources.frame_source to read frames from.
+                  Sources that are not live (recorded video, images, synthetic)
+                  are read as fast as possible without the fps cap and are
+                  timestamped using the source's own frame rate.
+    grayscale: capture, analyze and write single channel frames only
+    analysis_size: (width, height) of the frames handed to the analysis loop.
+                   If given, the video is still written at full resolution
+                   but frames in the frame ring are downscaled (INTER_AREA)
+    time_stages: time camera reads, undistortion and video writing (see
+                 stage_timing.py). The stage_timer is sent back through
+                 child_conn_obj when the loop ends. For live sources the
+                 clock() time the capture timestamps count from is sent to
+                 the analysis loop as a CLOCK_START_MSG message first, so
+                 it can time how long frames spend in transit
+    num_sample_frames: the frame source is opened (and warmed up) as soon as
+                       the process starts and is kept open until the
+                       experiment ends. If num_sample_frames is given, that
+                       many raw frames are sent back through child_conn_obj
+                       right after the warm-up so the experiment doesn't have
+                       to open the camera itself. Live cameras keep streaming
+                       until the experiment starts
     """    
-        
-    def elapsed_time(start_time):
-        return time.clock()-start_time  
     
     if use_arduino:
         arduino_ports = find_arduinos()
@@ -157,44 +215,81 @@ def control_expt(child_conn_obj, data_q_obj, use_arduino, expt_dur, led_freq, le
             if state[0] == 0.00 and state[1] == 0.00:
                 arduino.is_on = False
                     
+    #in grayscale mode frames are converted to single channel once, right 
+    #after capture, so undistortion, video writing and analysis all run on 
+    #1/3rd of the data
+    #The camera is only opened once, here, and stays open until the end
+    cam = frame_source.open(grayscale=grayscale)
+    is_live = cam.is_live
+    #We don't want the camera to try to autogain as it messes up the image
+    #So start acquiring some frames to avoid the autogain frames
+    for x in range(frame_source.warmup_frames):
+        ret, temp = cam.read()       
+    if num_sample_frames:
+        sample_frames = []
+        for x in range(num_sample_frames):
+            ret, sample_frame = cam.read()
+            if ret:
+                sample_frames.append(sample_frame)
+        child_conn_obj.send(sample_frames)
+    
     #Wait for the start signal from the parent process to begin grabbing frames
     while True:
-        #This will block until it receives the message it was waiting for
+        #keep live cameras streaming (so exposure stays settled and no stale
+        #frames pile up in the driver) while the experiment is being set up
+        if is_live and not child_conn_obj.poll(0.001):
+            cam.read()
+            continue
         msg = child_conn_obj.recv()        
         #The parent process will send a timestamp right before sending the 
         #'Start' signal. This allows all file names to be synchronized to when
         #the expt.start_expt() command is called.
         if 'Time' in msg:            
             timestring = msg.split(":")[-1]            
+            base_fname = '{}'.format(os.path.abspath(os.path.join(default_save_dir,timestring)))
+            #scheduled vs. actual capture time of every live frame
+            if frame_source.is_live:
+                timing_log = open(os.path.join(base_fname, "{}-capture_timing.csv".format(timestring)), "w")
+                timing_log.write("Scheduled Time (sec),Capture Time (sec)\n")
+            else:
+                timing_log = None
             if write_video: 
-                base_fname = '{}'.format(os.path.abspath(os.path.join(default_save_dir,timestring)))
                 fname = "video--" + timestring                    
+                #single channel video can't be encoded with libx264rgb
+                if grayscale:
+                    pix_fmt, vcodec, frame_shape = 'gray', 'libx264', (frame_height, frame_width)
+                else:
+                    pix_fmt, vcodec, frame_shape = 'bgr24', 'libx264rgb', (frame_height, frame_width, 3)
                 ffmpeg_command = [ FFMPEG_BIN,
                                   '-f', 'rawvideo',
-                                  '-pix_fmt', 'bgr24',
+                                  '-pix_fmt', pix_fmt,
                                   '-s', '{}x{}'.format(frame_width,frame_height), # size of one frame
                                   '-r', '{}'.format(fps_cap), # frames per second
                                   '-i', '-', # The imput comes from a pipe
                                   '-an', # Tells FFMPEG not to expect any audio
-                                  '-vcodec', 'libx264rgb',
+                                  '-vcodec', vcodec,
+                                  '-pix_fmt', pix_fmt,
                                   '-preset', 'fast',
                                   '-crf', '15', #See: http://slhck.info/articles/crf for information about crf
                                   #'-qp', '0', #"-qp 0" specifies lossless output
                                   base_fname + "/{}.avi".format(fname)]
                                            
-                #Note to self, don't try to redirect stout or sterr to sp.PIPE as filling the pipe up will cause subprocess to hang really bad :(
-                video_writer = sp.Popen(ffmpeg_command, stdin=sp.PIPE)                  
+                #ffmpeg is fed from its own thread so encoding stalls can't
+                #hold up the camera loop (see video_writer.py)
+                video_writer = async_video_writer(ffmpeg_command, frame_shape)                  
         if msg == 'Start!':
             break         
-    cam = cv2.VideoCapture(0)
-    #We don't want the camera to try to autogain as it messes up the image
-    #So start acquiring some frames to avoid the autogain frames
-    for x in range(30):
-        ret, temp = cam.read()       
     #start the clock!!
-    expt_start_time = time.clock() 
-    fps_cap_timer = time.clock()
+    #frames are captured on a fixed schedule of deadlines (see capture_scheduler.py)
+    scheduler = capture_scheduler(fps_cap)
+    scheduler.start()
+    timer = stage_timer() if time_stages else None
+    if time_stages and is_live:
+        frame_ring_obj.put_message(scheduler.start_time, CLOCK_START_MSG, False)
     stim_bool = False 
+    time_stamp = 0
+    #full resolution undistortion output when analysis runs on downscaled frames
+    full_frame = None
     
     #camera read and experiment control loop
     while True:
@@ -203,61 +298,111 @@ def control_expt(child_conn_obj, data_q_obj, use_arduino, expt_dur, led_freq, le
         if child_conn_obj.poll():
             msg = child_conn_obj.recv()
         if msg == 'Shutdown!':
-            data_q_obj.put_nowait((elapsed_time(expt_start_time),'stop', stim_bool))
+            frame_ring_obj.put_message(scheduler.elapsed(),'stop', stim_bool)
             break
         
         #enforce an FPS cap such that camera read speed cannot be faster than the cap
-        if elapsed_time(fps_cap_timer) >= 1/float(fps_cap):   
-            fps_cap_timer = time.clock()            
-            ret, raw_frame = cam.read()  
-            if calib_mtx.any():
-                frame = correct_distortion(raw_frame, calib_mtx, calib_dist)
+        #by sleeping until the next frame is due. Recorded and synthetic 
+        #sources are replayed as fast as possible
+        if is_live:
+            scheduled_time = scheduler.wait_for_next_frame()
+        if timer:
+            read_start = clock()
+        ret, raw_frame = cam.read()  
+        if timer:
+            read_end = clock()
+            timer.record('capture_read', read_end - read_start)
+        if not ret:
+            if is_live:
+                continue
+            #We've run out of recorded frames so the experiment is over
+            frame_ring_obj.put_message(time_stamp,'stop', stim_bool)
+            break
+        #live frames are stamped with the wall clock, replayed frames with
+        #the time they were originally recorded at
+        if is_live:
+            time_stamp = scheduler.elapsed()
+            if timing_log:
+                timing_log.write('{:.6f},{:.6f}\n'.format(scheduled_time, time_stamp))
+        else:
+            time_stamp = cam.frame_time
+        #undistort (or copy) the frame straight into the next free slot 
+        #of the shared frame ring. If there is no free slot, the frame
+        #still needs to be corrected and written to video
+        slot, frame = frame_ring_obj.next_slot()
+        if timer:
+            prepare_start = clock()
+        if analysis_size:
+            #video gets the full resolution frame, analysis a downscaled copy
+            if calibration is not None:
+                if full_frame is None:
+                    full_frame = np.empty_like(raw_frame)
+                full_frame = calibration.undistort(raw_frame, dst=full_frame)
+            else:
+                full_frame = raw_frame
+            if frame is not None:
+                cv2.resize(full_frame, analysis_size, frame, interpolation=cv2.INTER_AREA)
+            video_frame = full_frame
+        else:
+            if calibration is not None:
+                frame = calibration.undistort(raw_frame, dst=frame)
+            elif frame is not None:
+                np.copyto(frame, raw_frame)
             else:
                 frame = raw_frame            
-            if write_video:
-                video_writer.stdin.write(frame.tostring())
-            
-            # Use the multiprocessing Queue to send a timestamp, video frame,
-            # and indicator of whether optostim is occurring during frame
-            # to the post-processing and analysis portion of script             
-            data_q_obj.put_nowait((elapsed_time(expt_start_time), frame, stim_bool))
+            video_frame = frame
+        if timer:
+            prepare_end = clock()
+            #includes copying (or downscaling) the frame into its ring slot
+            timer.record('undistort', prepare_end - prepare_start)
+        if write_video:
+            video_writer.write(video_frame)
+            if timer:
+                timer.record('video_write', clock() - prepare_end)
+        
+        # Use the shared memory ring to send a timestamp, video frame,
+        # and indicator of whether optostim is occurring during frame
+        # to the post-processing and analysis portion of script
+        # If the analysis loop has fallen so far behind that no slot is free
+        # the frame is dropped and an overrun is reported to the analysis loop
+        if slot is None:
+            frame_ring_obj.report_overrun(time_stamp, stim_bool)
+        else:
+            frame_ring_obj.commit_slot(slot, time_stamp, stim_bool)
+        
+        if time_stamp >= stim_on_time + stim_dur:
+            if use_arduino:
+                if getattr(arduino, "is_on"):
+                    turn_off_stim()
+            stim_bool = False
+        elif time_stamp >= stim_on_time:
+            if use_arduino:
+                if not getattr(arduino, "is_on"):
+                    turn_on_stim(led_freq, led_dur)
+            stim_bool = True
             
-            if elapsed_time(expt_start_time) >= stim_on_time + stim_dur:
-                if use_arduino:
-                    if getattr(arduino, "is_on"):
-                        turn_off_stim()
-                stim_bool = False
-            elif elapsed_time(expt_start_time) >= stim_on_time:
-                if use_arduino:
-                    if not getattr(arduino, "is_on"):
-                        turn_on_stim(led_freq, led_dur)
-                stim_bool = True
-                
-            if elapsed_time(expt_start_time) >= expt_dur:
-                data_q_obj.put_nowait((elapsed_time(expt_start_time),'stop', stim_bool))
-                break
+        if time_stamp >= expt_dur:
+            frame_ring_obj.put_message(time_stamp,'stop', stim_bool)
+            break
             
     #clean up connections before closing process
+    if timer:
+        child_conn_obj.send(timer)
     child_conn_obj.close()
-    data_q_obj.close()
+    frame_ring_obj.close()
     if use_arduino:
         turn_off_stim()
         arduino.close()            
     if write_video:
-        video_writer.stdin.close()
-        video_writer.wait()
+        #flush whatever frames are still waiting to be encoded
+        video_writer.close()
+        print("Video writer stats: {frames_written} frames written, {frames_dropped} frames dropped, max lag of {max_lag} frames".format(**video_writer.stats()))
+    if timing_log:
+        timing_log.close()
+        if scheduler.missed_slots:
+            print("Camera loop fell behind and missed {} scheduled frames".format(scheduler.missed_slots))
     cam.release()
 
-#%%
-def counted(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        wrapper.calls += 1
-        return func(*args, **kwargs)
-    wrapper.calls = 0
-    wrapper.__name__= func.__name__
-    return wrapper
-
 #%%
 class experiment(object):
     def __init__(self, expt_conn_obj=None, write_video=False, write_csv=False,
@@ -265,7 +410,17 @@ class experiment(object):
                  stim_on_time=60, stim_dur = 60, fps_cap = None, 
                  roi_list = None, roi_dict = None, gui_cam_calib_data = None, 
                  default_save_dir = None,
-                 line_mode ='vertical'):
+                 line_mode ='vertical', frame_source = None,
+                 frame_buffer_slots = 64, analysis_workers = 0,
+                 drop_policy = 'drop_newest', max_lag = None, every_nth = 2,
+                 grayscale = False, csv_flush_interval = 5.0, keep_results = False,
+                 headless = False, status_interval = None, status_format = 'text',
+                 counter = 'contours', min_blob_area = 0, max_blob_area = None,
+                 bg_model = 'knn', analysis_scale = 1.0, track_flies = False, 
+                 max_link_distance = 20, num_rois = 4, roi_shape = 'rectangle',
+                 plot_rate = 5.0, display_rate = 10.0, time_stages = False,
+                 camera_profile_file = camera_profile.DEFAULT_PROFILE_FILE,
+                 remeasure_camera = False):
                 
         #Experiment_connection_object is a connection from the flyGrAM GUI 
         #It is used to send a "stop experiment now" signal if the user clicks the emergency stop
@@ -273,10 +428,74 @@ class experiment(object):
             self.expt_conn_obj = expt_conn_obj
         
         self.write_csv = write_csv
+        #.csv rows are streamed to disk during the experiment and flushed at 
+        #least every csv_flush_interval seconds. When writing .csvs, results 
+        #are only also kept in memory (self.results_dict) if keep_results is True
+        self.csv_flush_interval = csv_flush_interval
+        self.keep_results = keep_results or not write_csv
+        #headless mode never opens (or imports) matplotlib or OpenCV windows.
+        #Instead a status line (fps, lag, counts) can be printed every 
+        #status_interval seconds as either plain 'text' or 'json'
+        self.headless = headless
+        self.status_interval = status_interval
+        self.status_format = status_format
+        #live activity plots are redrawn in their own process at most 
+        #plot_rate times per second (see live_display.py)
+        self.plot_rate = plot_rate
+        #the annotated tracking mosaic is shown by its own thread at most
+        #display_rate times per second
+        self.display_rate = display_rate
+        #opt-in diagnostic: record per stage latency histograms (camera read, 
+        #undistortion, video writing, queue transit, analysis stages, plotting,
+        #display) and write them to '<timestring>-stage_timing.json' (see 
+        #stage_timing.py)
+        self.time_stages = time_stages
+        #measured fps, frame size and warm-up of live cameras are saved in
+        #camera_profile_file and reused on every run (remeasure_camera 
+        #measures the camera again, see camera_profile.py)
+        self.camera_profile_file = camera_profile_file
+        if headless and (roi_list == None or roi_dict == None):
+            raise ValueError('ROIs have to be loaded ahead of time (roi_list and roi_dict) to run headless!')
         self.write_video = write_video
         self.use_arduino = use_arduino
         self.default_calib_loc = "Camera_calibration_matrices.json"
         self.default_save_dir = default_save_dir        
+        #number of worker processes to spread ROI analysis over
+        #0 analyzes all ROIs one after another in the experiment process
+        self.analysis_workers = analysis_workers
+        #With IR backlighting colour channels carry no information so 
+        #the whole pipeline can run on single channel frames
+        self.grayscale = grayscale
+        #how moving flies are counted in each ROI (see roi_analysis.COUNTERS)
+        #blobs smaller than min_blob_area or larger than max_blob_area pixels are ignored
+        if counter not in roi_analysis.COUNTERS:
+            raise ValueError('Unknown counter "{}"! Choose one of: {}'.format(counter, roi_analysis.COUNTERS))
+        self.counter_kwargs = {"counter": counter, "min_area": min_blob_area, "max_area": max_blob_area}
+        #background model used to find moving flies (see background_models.BG_MODELS)
+        if bg_model not in background_models.BG_MODELS:
+            raise ValueError('Unknown background model "{}"! Choose one of: {}'.format(bg_model, background_models.BG_MODELS))
+        self.bg_model = bg_model
+        #flies are many pixels wide so motion can be detected on downscaled 
+        #frames (analysis cost drops with the square of the scale). The video 
+        #is still written at full resolution and ROIs are still set at full
+        #resolution, they (and blob area thresholds) are rescaled automatically
+        if not 0 < analysis_scale <= 1:
+            raise ValueError('analysis_scale has to be larger than 0 and at most 1!')
+        self.analysis_scale = analysis_scale
+        #optionally link blob centroids from frame to frame to estimate the 
+        #distance travelled and mean speed of the flies in each ROI (see
+        #centroid_tracker.py). max_link_distance is in full resolution pixels
+        self.track_flies = track_flies
+        self.max_link_distance = max_link_distance
+        #what to do when analysis can't keep up with the camera (see 
+        #shared_frame_buffer.frame_drop_policy). The frame ring is bounded so 
+        #memory use never grows with time no matter which policy is used
+        if max_lag is None:
+            max_lag = frame_buffer_slots // 2
+        self.drop_policy = shared_frame_buffer.frame_drop_policy(drop_policy, max_lag, every_nth)
+        #where to read frames from: a live camera, recorded video, a directory
+        #of images or a synthetic generator (see frame_sources.py)
+        self.frame_source = frame_sources.frame_source_from_spec(frame_source)
         
         #actual experiment settings        
         self.expt_dur = expt_dur
@@ -292,73 +511,136 @@ class experiment(object):
             calib_data = self.read_cam_calibration_file(self.default_calib_loc)
         
         if calib_data:
-            self.calib_mtx = calib_data["camera_matrix"]
-            self.calib_dist = calib_data["dist_coeff"]
+            #The calibration object caches the undistortion lookup tables
+            #(and saves them next to the calibration .json file)
+            self.calibration = camera_calibration.camera_calibration.from_dict(calib_data)
+            self.calib_mtx = self.calibration.camera_matrix
+            self.calib_dist = self.calibration.dist_coeff
             print("Finished loading camera calibration data!")
         else:
+            self.calibration = None
             self.calib_mtx = None
             self.calib_dist = None
 
         sys.stdout.flush()
         
-        if fps_cap == None:        
-            #Need to figure out what the effective fps of the camera is...
-            #We'll use the python timeit module to achieve this
-            fps_timer = timeit.Timer('[webcam.read() for x in range(30)]', 
-                                     'import cv2\nwebcam=cv2.VideoCapture(0)\n')        
-            #time how long it takes to read 30 frames 10 times in a row
-            self.fps = (5*30)/fps_timer.timeit(5)        
+        #The frame rate, frame size and warm-up of live cameras are measured
+        #once and kept in a camera profile (see camera_profile.py), so the
+        #camera doesn't have to be opened here at all. It is only opened by 
+        #the control_expt process, which sends back the sample frames we need
+        if self.frame_source.is_live:
+            self.camera_profile = camera_profile.get_camera_profile(self.frame_source, camera_profile_file, 
+                                                                    remeasure_camera)
+            self.frame_source.apply_profile(self.camera_profile)
+            print("Using {}".format(self.camera_profile))
+        else:
+            self.camera_profile = None
+        if fps_cap == None:
+            #measured by the camera profile, recorded and synthetic sources 
+            #know their own frame rate
+            self.fps = self.frame_source.fps
         else:
             self.fps = fps_cap        
-        #start webcam video capture instance. Use directshow instead of VFW
-        sample_cam  = cv2.VideoCapture(0)
-        #We don't want the camera to try to autogain as it messes up the image
-        sample_cam.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0)
-        sample_cam.set(cv2.CAP_PROP_GAIN, 0)        
-        #grab frames of video from the webcam
-        sample_frames = []
-        for x in range(60):
-            sample_frames.append(sample_cam.read())           
-        _, self.sample_frame = sample_frames[-1]
-
-        if calib_data:
-            self.sample_frame = correct_distortion(self.sample_frame, self.calib_mtx, self.calib_dist)
-        sample_cam.release()       
-            
-        print("Finished collecting sample video frames!")
-        sys.stdout.flush()
+        #the static 'median' background model uses the median of the sample 
+        #frames, otherwise a single sample frame is all we need
+        num_sample_frames = MEDIAN_SAMPLE_FRAMES if self.bg_model == 'median' else 1
+        if self.camera_profile:
+            raw_frame_shape = self.camera_profile.frame_shape(self.grayscale)
+            frame_dtype = np.uint8
+            sample_frames = None
+        else:
+            #recorded and synthetic sources are cheap to open and the camera
+            #process replays them from the first frame again
+            sample_cam = self.frame_source.open(grayscale=self.grayscale)
+            sample_frames = []
+            for x in range(num_sample_frames):
+                ret, sample_frame = sample_cam.read()
+                if not ret:
+                    break
+                sample_frames.append(sample_frame)
+            sample_cam.release()
+            if not sample_frames:
+                raise IOError('Could not read any frames from: {}'.format(self.frame_source))
+            raw_frame_shape = sample_frames[-1].shape
+            frame_dtype = sample_frames[-1].dtype
         
         #Need to figure out what the dimensions of the output frames will be
-        self.frame_height, self.frame_width = self.sample_frame.shape[:2]
+        #(undistortion keeps the frame size)
+        self.frame_height, self.frame_width = raw_frame_shape[:2]
+        #and of the frames the analysis loop gets
+        if self.analysis_scale != 1:
+            self.analysis_size = (max(1, int(round(self.frame_width * self.analysis_scale))),
+                                  max(1, int(round(self.frame_height * self.analysis_scale))))
+            analysis_shape = (self.analysis_size[1], self.analysis_size[0]) + tuple(raw_frame_shape[2:])
+        else:
+            self.analysis_size = None
+            analysis_shape = raw_frame_shape
+        
+        if calib_data:
+            #build (or load) the undistortion tables for this frame size
+            #so the camera process doesn't have to
+            self.calibration.get_remap_tables(self.frame_width, self.frame_height)
         
-        #Initialize the multiprocess communication pipe/queue and start the process
+        #Initialize the multiprocess communication pipe, the shared memory 
+        #frame ring and start the process
         self.parent_conn, self.child_conn = mp.Pipe()
-        self.data_q = mp.Queue()      
+        self.frame_ring = shared_frame_buffer.shared_frame_ring(analysis_shape, 
+                                                                num_slots = frame_buffer_slots,
+                                                                dtype = frame_dtype,
+                                                                block_when_full = self.drop_policy.block_when_full)      
         
-        proc_args = (self.child_conn, self.data_q, self.use_arduino,
+        proc_args = (self.child_conn, self.frame_ring, self.use_arduino,
                      self.expt_dur, self.led_freq, 
                      self.led_dur, self.stim_on_time, 
-                     self.stim_dur, self.calib_mtx, self.calib_dist, 
+                     self.stim_dur, self.calibration, 
                      self.write_video, self.frame_height, 
-                     self.frame_width, self.fps, self.default_save_dir)                 
+                     self.frame_width, self.fps, self.default_save_dir,
+                     self.frame_source, self.grayscale, self.analysis_size,
+                     self.time_stages, num_sample_frames if sample_frames is None else 0)                 
         self.control_expt_process = mp.Process(target=control_expt, args=proc_args)                                    
         #start the control_expt process!
         self.control_expt_process.start()
         
         print("Finished starting parallel experiment control process!")
         sys.stdout.flush()
+        
+        if sample_frames is None:
+            try:
+                sample_frames = receive_sample_frames(self.parent_conn, self.frame_source, raw_frame_shape,
+                                                      camera_profile_file)
+            except IOError:
+                self.control_expt_process.terminate()
+                raise
+        if calib_data:
+            sample_frames = [self.calibration.undistort(frame) for frame in sample_frames]
+        self.sample_frame = sample_frames[-1]
+        if self.bg_model == 'median':
+            self.median_background = background_models.median_background(sample_frames)
+            if self.analysis_size:
+                self.median_background = cv2.resize(self.median_background, self.analysis_size, 
+                                                    interpolation=cv2.INTER_AREA)
+        else:
+            self.median_background = None
+            
+        print("Finished collecting sample video frames!")
+        sys.stdout.flush()
                
         self.roi_list = roi_list
         self.roi_dict = roi_dict
         
         if roi_list == None or roi_dict == None:
-            self.roi_list = [('blue', 'roi1'), ('red', 'roi2'), 
-                             ('green', 'roi3'), ('purple', 'roi4')]
+            #the interactive ROI selection tools need matplotlib
+            import roi
+            #num_rois ROIs of the given shape ('rectangle', 'polygon' or 'circle')
+            roi_tools = {'rectangle': roi.set_roi, 'polygon': roi.set_polygon, 'circle': roi.set_circle}
+            if roi_shape not in roi_tools:
+                raise ValueError('Unknown ROI shape "{}"! Choose one of: {}'.format(roi_shape, roi_analysis.ROI_SHAPES))
+            self.roi_list = [(ROI_COLORS[indx % len(ROI_COLORS)], 'roi{}'.format(indx + 1)) for indx in range(num_rois)]
             
             for roi_color, roi_name in self.roi_list:                
                 if 'roi' in roi_name:
-                    setattr(self, roi_name, roi.set_roi(roi_color, background_img = self.sample_frame))
-                elif 'line' in roi_name:
+                    setattr(self, roi_name, roi_tools[roi_shape](roi_color, background_img = self.sample_frame))
+                elif line_crossing.is_line_roi(roi_name):
                     setattr(self, roi_name, roi.set_line(roi_color, background_img = self.sample_frame, line_width=5, line_mode = line_mode))                  
                 getattr(self, roi_name).wait_for_roi()
                  
@@ -385,99 +667,33 @@ class experiment(object):
             if data:
                 processed_data = {"reprojection_error": data["reprojection_error"], 
                                   "camera_matrix": np.array(data["camera_matrix"]),
-                                  "dist_coeff": np.array(data["dist_coeff"])}                             
+                                  "dist_coeff": np.array(data["dist_coeff"]),
+                                  "filepath": os.path.abspath(filepath)}                             
             return processed_data
         else:
             print("Loading camera calibration failed! Check if the file exists at: {}".format(filepath))
             
-    def get_activity_counts(self, roi_name, bg_subtractor, current_frame, roi_coords):
-        #A kernel to do morphology operations with
-        kernel1 = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3,3))  
-        #each position is in array([x,y]) format        
-        start_pos, end_pos = roi_coords        
-        #Image cropping works by img[y: y + h, x: x + w]
-        cropped_current_frame = current_frame[start_pos[1]:end_pos[1], start_pos[0]:end_pos[0]]            
-        #Apply the appropriate background subtractor to the cropped current frame of the video
-        cropped_fgmask = bg_subtractor.apply(cropped_current_frame)      
-        # Apply a medianblur filter and then morphological dilate to 
-        # remove noise and consolidate detections        
-        filtered = cv2.medianBlur(cropped_fgmask,7)                     
-        dilate = cv2.dilate(filtered, kernel1)
-           
-        image, contours, hierarchy = cv2.findContours(dilate, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)      
-        cv2.drawContours(cropped_current_frame, contours, -1, (255,0,0), 2)    
-        
-        return((len(contours), cropped_current_frame)) 
+    def get_activity_counts(self, roi_name, bg_subtractor, current_frame, roi_coords, annotate=True):
+        #see roi_analysis.py, the analysis is shared with the ROI worker processes
+        return roi_analysis.get_activity_counts(bg_subtractor, current_frame, roi_coords,
+                                                annotate=annotate, **self.counter_kwargs)
         
     def shutdown_expt_manager(self):
         self.parent_conn.send('Shutdown!')
         
-    def init_activity_plots(self):
-        #initialize matplotlib plots for raw group activity
-        fig, axes = plt.subplots(2,2, sharex='col', sharey='row')    
-        fig.patch.set_facecolor('white')                 
-        fig.suptitle('{} Hz {} Pulse width - {}'.format(self.led_freq, self.led_dur, self.expt_timestring), weight='bold')       
-        for indx, ax in enumerate(chain(*axes)):
-            ax.set_xlim(0,self.expt_dur)
-            ax.set_ylim(-0.5,20)          
-            ax.tick_params(top="off",right="off")
-            ax.spines['right'].set_visible(False)
-            ax.spines['top'].set_visible(False)   
-            ax.axvspan(self.stim_on_time, self.stim_on_time+self.stim_dur, facecolor='r', alpha=0.25, edgecolor = 'none')        
-            ax.tick_params(axis='x', pad=5)     
-            ax.tick_params(axis='y', pad=5)            
-            #make only every other axis label visible
-            for label in ax.xaxis.get_ticklabels()[::2]:
-                label.set_visible(False)           
-            ax.hold(True)            
-        fig.text(0.5, 0.04, 'Time elapsed (sec)', ha='center', va='center', weight='bold')
-        fig.text(0.06, 0.5, 'Number of active flies', ha='center', va='center', rotation='vertical', weight='bold')
-        fig.show()    
-        return fig, axes
-        
-    #update plots
-    @counted
-    def update_plots(self, axes, lines, backgrounds):
-        key_list = sorted([k for k in self.results_dict.keys() if 'roi' in k])
-        # Because the matplotlib subplots are in the following order:
-        # 1, 2
-        # 3, 4
-        # and because our ROIs are set in the following order physically:
-        # 1, 3
-        # 2, 4
-        # We need to permute the dictionary key_list so that the correct order is being plotted
-        pkey_list = [key_list[i] for i in [0,2,1,3]]                                     
-        #restore backgrounds
-        for indx, ax in enumerate(chain(*axes)):
-            ax.figure.canvas.restore_region(backgrounds[indx]) 
-        #update data
-        for indx, key in enumerate(pkey_list):
-            lines[indx].set_data(zip(*self.plotting_dict[key]))
-        #draw just the lines
-        for indx, ax in enumerate(chain(*axes)):
-            ax.draw_artist(lines[indx]) 
-        #Use blit to only draw differences
-        for ax in chain(*axes):
-            ax.figure.canvas.blit(ax.bbox) 
-                  
-    def show_tracking(self, roi_frames):
-        #Image shapes are in the order of h,w,d
-        hw = np.array([(proc_frame.shape[0], proc_frame.shape[1]) for proc_frame in roi_frames])
-        max_height, max_width = hw.reshape([4,2]).max(axis=0)                        
-        stitched = np.zeros((max_height*2, max_width*2, 3), np.uint8)               
-        x = 0
-        y = 0
-        #stich together individual arena roi tracked videos
-        for indx,proc_frame in enumerate(roi_frames):    
-            h,w,d = proc_frame.shape
-            stitched[y:y+h,x:x+w,:d] = proc_frame   
-            if indx % 2 == 0:
-                y += max_height
-            else:
-                y -= max_height
-                x += max_width               
-        cv2.imshow('Annotated', stitched) 
-        cv2.waitKey(1)
+    def print_status(self, time_stamp, fps, lag, roi_counts):
+        """
+        Periodic status line for headless experiments
+        """
+        if self.status_format == 'json':
+            status = {"time": round(time_stamp, 3), "fps": round(fps, 2), "lag": lag,
+                      "dropped": self.num_dropped_frames,
+                      "counts": dict(zip(self.roi_list, roi_counts))}
+            print(json.dumps(status, sort_keys=True))
+        else:
+            counts = ' '.join('{}: {}'.format(roi_name, count) for roi_name, count in zip(self.roi_list, roi_counts))
+            print('Time: {:.1f} sec fps: {:.1f} lag: {} dropped: {} | {}'.format(time_stamp, fps, lag, self.num_dropped_frames, counts))
+        sys.stdout.flush()
 
     def start_expt(self):  
         if self.use_arduino:
@@ -495,26 +711,114 @@ class experiment(object):
         #give a bit of time for the child process to get started
         time.sleep(0.25)
         
-        # Implement a K-Nearest Neighbors background subtraction
+        #ROIs and blob areas are defined at full resolution, rescale them 
+        #to the resolution of the analyzed frames
+        analysis_roi_dict = {roi_name:roi_analysis.scale_roi_coords(self.roi_dict[roi_name], self.analysis_scale) 
+                             for roi_name in self.roi_list}
+        analysis_counter_kwargs = roi_analysis.scale_counter_kwargs(self.counter_kwargs, self.analysis_scale)
+        #kernels, crop slices and output buffers for every ROI are only
+        #built once so the analysis loop doesn't allocate new images each frame
+        #Line ROIs (see roi.set_line) get a much cheaper 1-D beam crossing
+        #detector instead, which counts crossings rather than active flies
+        self.line_list = [roi_name for roi_name in self.roi_list if line_crossing.is_line_roi(roi_name)]
+        area_roi_list = [roi_name for roi_name in self.roi_list if roi_name not in self.line_list]
+        #activity of every (non line) ROI gets its own subplot
+        self.plot_list = area_roi_list
+        if self.track_flies:
+            #distances are always reported in full resolution pixels
+            track_kwargs = {"max_distance": self.max_link_distance * self.analysis_scale, 
+                            "px_scale": 1.0/self.analysis_scale}
+        else:
+            track_kwargs = None
+        self.roi_plans = {roi_name:roi_analysis.roi_plan(analysis_roi_dict[roi_name], self.frame_ring.frame_shape, 
+                                                         track_kwargs=track_kwargs, **analysis_counter_kwargs) 
+                          for roi_name in area_roi_list}
+        self.roi_plans.update({line_name:line_crossing.line_crossing_detector(analysis_roi_dict[line_name], self.frame_ring.frame_shape)
+                               for line_name in self.line_list})
+        
+        # Implement a K-Nearest Neighbors (or other, see background_models.py) 
+        # background subtraction
         # Most efficient when number of foreground pixels is low (and image area is small)
         # So we will create one background subtractor for each ROI
-        self.bg_sub_dict = {roi_name:cv2.createBackgroundSubtractorKNN(5,300,False) for roi_name in self.roi_list}
+        # When using analysis workers, each worker creates and keeps the
+        # background subtractors for its own ROIs instead (line ROIs are
+        # cheap enough to always be analyzed right here)
+        if self.analysis_workers and area_roi_list:
+            self.analysis_pool = roi_analysis.roi_analysis_pool(area_roi_list, analysis_roi_dict, 
+                                                                self.frame_ring, self.analysis_workers,
+                                                                analysis_counter_kwargs, self.bg_model,
+                                                                self.median_background, track_kwargs,
+                                                                self.time_stages)
+            self.bg_sub_dict = None
+            print("Started {} ROI analysis worker processes!".format(self.analysis_pool.num_workers))
+        else:
+            self.analysis_pool = None
+            background = self.median_background
+            self.bg_sub_dict = {roi_name:roi_analysis.create_bg_subtractor(self.bg_model, None if background is None else self.roi_plans[roi_name].crop(background)) 
+                                for roi_name in area_roi_list}
+            self.bg_sub_dict.update({line_name:None for line_name in self.line_list})
+        self.timer = stage_timer() if self.time_stages else None
+        if self.timer:
+            for roi_name in area_roi_list:
+                self.roi_plans[roi_name].timer = self.timer
         
         prev_time_stamp = 0        
         self.max_q_size = 0               
+        #[timestamp, reason] of every frame that was not analyzed, either
+        #because the camera process found every slot of the shared frame ring 
+        #still waiting to be analyzed ('overrun') or because the drop policy
+        #skipped it while the analysis was lagging ('skipped')
+        self.dropped_frames = []
+        self.num_dropped_frames = 0
         #setup a dictionary of lists for analysis results
-        self.plotting_dict = {}
-        #setup a ditionary of deques for plotting
         self.results_dict = {}      
         for roi_name in self.roi_list:
             self.results_dict[roi_name] = list()
-            self.plotting_dict[roi_name] = deque(maxlen=100)
+        #[timestamp, position, direction] of every line crossing
+        self.crossings_dict = {line_name:list() for line_name in self.line_list}
+        #roi_name -> total distance, mean speed and number of links (when tracking)
+        self.tracking_summary = {}
+        track_flies = self.track_flies
+        
+        #stream results to the .csv files as the experiment runs so nothing 
+        #is lost on a crash or emergency stop (see results_writer.py)
+        if self.write_csv:
+            csv_writer = streaming_csv_writer(self.csv_flush_interval)
+            for roi_name in self.roi_list:
+                count_header = "Number of crossings" if roi_name in self.line_list else "Number of active flies"
+                header = ["Time Elapsed (sec)", count_header, "Stimulation"]
+                if track_flies and roi_name not in self.line_list:
+                    header.append("Distance moved (px)")
+                csv_writer.add_table(roi_name, "{}/{}-{}.csv".format(self.save_dir, self.expt_timestring, roi_name), header)
+            if track_flies:
+                csv_writer.add_table('tracking_summary', "{}/{}-tracking_summary.csv".format(self.save_dir, self.expt_timestring),
+                                     ["ROI", "Total distance (px)", "Mean speed (px/sec)", "Number of links"])
+            for line_name in self.line_list:
+                csv_writer.add_table(line_name + '_crossings', "{}/{}-{}_crossings.csv".format(self.save_dir, self.expt_timestring, line_name),
+                                     ["Time Elapsed (sec)", "Position (px)", "Direction", "Stimulation"])
+            #record exactly which frames never made it into the roi .csv files
+            csv_writer.add_table('dropped_frames', "{}/{}-dropped_frames.csv".format(self.save_dir, self.expt_timestring),
+                                 ["Time Elapsed (sec)", "Reason"])
+            csv_write_rows = csv_writer.write_rows
+        keep_results = self.keep_results
+        write_csv = self.write_csv
             
-        #initialize matplotlib plots for raw group activity
-        act_fig, act_axes = self.init_activity_plots()      
-        #do an initial subplot background save
-        backgs = [ax.figure.canvas.copy_from_bbox(ax.bbox) for ax in chain(*act_axes)]
-        lns = [ax.plot([],[])[0] for ax in chain(*act_axes)]        
+        headless = self.headless
+        if not headless:
+            #live plots of raw group activity are drawn by their own process
+            #and only get the counts of the plotted ROIs
+            live_plots = live_plot_renderer(self.plot_list, '{} Hz {} Pulse width - {}'.format(self.led_freq, self.led_dur, self.expt_timestring),
+                                            self.expt_dur, self.stim_on_time, self.stim_dur, self.plot_rate,
+                                            time_stages=self.time_stages)
+            live_plots_update = live_plots.update
+            plot_indxs = [self.roi_list.index(roi_name) for roi_name in self.plot_list]
+            display = tracking_display(self.display_rate, time_stages=self.time_stages)
+            display_wants_frame = display.wants_frame
+        
+        status_interval = self.status_interval
+        print_status = self.print_status
+        last_status_time = clock()
+        frames_since_status = 0
                
         msg = None
         
@@ -523,18 +827,25 @@ class experiment(object):
         if hasattr(self, 'expt_conn_obj'):
             expt_conn_obj_poll = self.expt_conn_obj.poll
             expt_conn_obj_recv = self.expt_conn_obj.recv
-        data_q_get = self.data_q.get
-        np_ndarray = np.ndarray
-        data_q_qsize = self.data_q.qsize
+        frame_ring_get_slot = self.frame_ring.get_slot
+        frame_ring_frames = self.frame_ring.frames
+        frame_ring_release = self.frame_ring.release
+        frame_ring_lag = self.frame_ring.slots_in_use
+        skip_frame = self.drop_policy.skip_frame
         sys_stdout_flush = sys.stdout.flush
-        get_activity_counts = self.get_activity_counts
         bg_sub_dict = self.bg_sub_dict
-        roi_dict  = self.roi_dict
         roi_list = self.roi_list    
-        show_tracking = self.show_tracking
-        update_plots = self.update_plots
+        analysis_pool = self.analysis_pool
+        roi_plans = self.roi_plans
+        line_list = self.line_list
+        pool_roi_list = analysis_pool.roi_list if analysis_pool else []
         
-        #profiler.enable()
+        #per stage latencies (see stage_timing.py). The camera process, the
+        #analysis workers and the display/plot renderers keep their own 
+        #timers which are merged into this one at the end of the experiment
+        timer = self.timer
+        #clock() time the camera's capture timestamps count from (live sources only)
+        clock_start = None
        
         while True:           
             if hasattr(self, 'expt_conn_obj'):
@@ -542,69 +853,187 @@ class experiment(object):
                     msg = expt_conn_obj_recv() 
                 if msg == 'Shutdown!':
                     self.shutdown_expt_manager()
+                    #emergency stop: finish the .csv files right away, the GUI 
+                    #only waits a few seconds before it terminates this process
+                    if write_csv:
+                        csv_writer.close()
+                        write_csv = False
+                        print("CSVs written to data folder!")
+                        sys_stdout_flush()
                     
-            time_stamp, frame, stim_bool = data_q_get()   
+            #slot is the index of the frame in the shared frame ring or a message
+            time_stamp, slot, stim_bool = frame_ring_get_slot()   
             
             #check if the experiment data collection has completed
-            if type(frame) == str:
-                if frame == 'stop':
+            if type(slot) == str:
+                if slot == shared_frame_buffer.OVERRUN_MSG:
+                    self.num_dropped_frames += 1
+                    if keep_results:
+                        self.dropped_frames.append([time_stamp, 'overrun'])
+                    if write_csv:
+                        csv_write_rows([('dropped_frames', [time_stamp, 'overrun'])])
+                    print('Frame ring overrun! Dropped the frame captured at: {} sec'.format(time_stamp))
+                    sys_stdout_flush()
+                elif slot == CLOCK_START_MSG:
+                    clock_start = time_stamp
+                elif slot == 'stop':
                     #let's close everything down
-                    cv2.destroyAllWindows()
+                    if not headless:
+                        display.close()
+                        live_plots.close()
+                        if timer:
+                            timer.merge(display.timer)
+                            timer.merge(live_plots.timer)
+                    if analysis_pool:
+                        self.tracking_summary.update(analysis_pool.close())
+                        if timer:
+                            timer.merge(analysis_pool.timer)
+                    #the camera process sends back its timer as it shuts down
+                    if timer and self.parent_conn.poll(TIMER_TIMEOUT):
+                        timer.merge(self.parent_conn.recv())
                     #clean up the expt control process
-                    self.data_q.close()
-                    self.data_q.join_thread()
+                    self.frame_ring.close()
+                    self.frame_ring.join_thread()
                     self.child_conn.close()
                     self.parent_conn.close()
                     self.control_expt_process.terminate()
                     break
             
-            elif type(frame) == np_ndarray:                
+            else:
+                #frame is a view into the shared frame ring and is only valid
+                #until frame_ring_release() is called
+                frame = frame_ring_frames[slot]
+                if timer:
+                    analysis_start = clock()
+                    if clock_start is not None:
+                        timer.record('queue_transit', analysis_start - clock_start - time_stamp)
+                
+                #number of frames still waiting behind this one
+                lag = frame_ring_lag() - 1
+                if skip_frame(lag):
+                    self.num_dropped_frames += 1
+                    if keep_results:
+                        self.dropped_frames.append([time_stamp, 'skipped'])
+                    if write_csv:
+                        csv_write_rows([('dropped_frames', [time_stamp, 'skipped'])])
+                    frame_ring_release()
+                    continue
                 #print frame.dtype, frame.size
                 #print (time_stamp, stim_bool)            
-                fps = 1/(time_stamp-prev_time_stamp)
+                #replayed frames can be analyzed faster than they were recorded
+                #so guard against the very first (t = 0) frame
+                fps = 1/(time_stamp-prev_time_stamp) if time_stamp > prev_time_stamp else float('inf')
                 prev_time_stamp = time_stamp           
-                print('Lagged frames: {} fps: {}'.format(int(data_q_qsize()),fps))
-                sys_stdout_flush()
+                if not headless:
+                    print('Lagged frames: {} fps: {}'.format(lag,fps))
+                    sys_stdout_flush()
                 
-                if int(data_q_qsize() > self.max_q_size):
-                    self.max_q_size = data_q_qsize()
+                if lag > self.max_q_size:
+                    self.max_q_size = lag
         
+                #only annotate frames that will actually be displayed
+                show_frame = not headless and display_wants_frame()
                 #order of result sublists should be ['line1', 'line2', 'roi1', 'roi2', 'roi3', 'roi4']   
-                results = [get_activity_counts(roi_name, bg_sub_dict[roi_name], frame, roi_dict[roi_name]) for roi_name in roi_list]           
-                roi_counts, roi_frames = zip(*results)     
+                if analysis_pool:
+                    #workers draw their annotations straight into the shared frame
+                    pool_counts = dict(zip(pool_roi_list, analysis_pool.analyze(slot, show_frame, time_stamp)))
+                    roi_counts = [pool_counts[roi_name] if roi_name in pool_counts 
+                                  else roi_plans[roi_name].process(None, frame, show_frame)[0] for roi_name in roi_list]
+                    if show_frame:
+                        roi_frames = [roi_plans[roi_name].crop(frame) for roi_name in roi_list]
+                    if track_flies:
+                        roi_distances = dict(zip(pool_roi_list, analysis_pool.distances))
+                else:
+                    results = [roi_plans[roi_name].process(bg_sub_dict[roi_name], frame, show_frame, time_stamp) for roi_name in roi_list]           
+                    roi_counts, roi_frames = zip(*results)     
+                    if track_flies:
+                        roi_distances = {roi_name:roi_plans[roi_name].tracker.last_distance for roi_name in roi_list
+                                         if roi_name not in line_list}
+                if timer:
+                    analysis_end = clock()
+                    timer.record('analysis', analysis_end - analysis_start)
                                
-                for roi_indx, roi_name in enumerate(roi_list):
-                    #append roi_counts to the results dictionary
-                    self.results_dict[roi_name].append([time_stamp, roi_counts[roi_indx], stim_bool])
-                    #append roi_counts to the plotting deque
-                    self.plotting_dict[roi_name].append([time_stamp, roi_counts[roi_indx]])
+                if keep_results:
+                    for roi_indx, roi_name in enumerate(roi_list):
+                        #append roi_counts to the results dictionary
+                        self.results_dict[roi_name].append([time_stamp, roi_counts[roi_indx], stim_bool])
+                if write_csv:
+                    if track_flies:
+                        csv_write_rows([(roi_name, [time_stamp, roi_counts[roi_indx], stim_bool] + 
+                                                   ([roi_distances[roi_name]] if roi_name in roi_distances else []))
+                                        for roi_indx, roi_name in enumerate(roi_list)])
+                    else:
+                        csv_write_rows([(roi_name, [time_stamp, roi_counts[roi_indx], stim_bool]) for roi_indx, roi_name in enumerate(roi_list)])
+                for line_name in line_list:
+                    for position, direction in roi_plans[line_name].pop_events():
+                        if keep_results:
+                            self.crossings_dict[line_name].append([time_stamp, position, direction])
+                        if write_csv:
+                            csv_write_rows([(line_name + '_crossings', [time_stamp, position, direction, stim_bool])])
+                
+                if headless:
+                    frame_ring_release()
+                    if status_interval:
+                        frames_since_status += 1
+                        now = clock()
+                        if now - last_status_time >= status_interval:
+                            print_status(time_stamp, frames_since_status/(now - last_status_time), 
+                                         lag, roi_counts)
+                            frames_since_status = 0
+                            last_status_time = now
+                    continue
                 
-                #only display every 3rd tracked frame
-                #Results in massive speedup
-                if update_plots.calls % 3 == 0:
-                    show_tracking(roi_frames)
-                                       
-                #resave the backgrounds with drawn data but only if update_plots has been called near the plotting_dict deque length
-                if update_plots.calls % 99 == 0:
-                    backgs = [ax.figure.canvas.copy_from_bbox(ax.bbox) for ax in chain(*act_axes)]           
-                update_plots(act_axes, lns, backgs)
+                #the mosaic is stitched at most display_rate times per second
+                #and shown by the display process
+                if show_frame:
+                    if timer:
+                        display_start = clock()
+                        display.show(roi_frames)
+                        timer.record('display', clock() - display_start)
+                    else:
+                        display.show(roi_frames)
+                #We are done with the frame (and the roi_frames views into it)
+                #so hand the slot back to the camera process
+                frame_ring_release()
+                #the renderer redraws at its own pace, this never blocks
+                if timer:
+                    plot_start = clock()
+                    live_plots_update(time_stamp, [roi_counts[indx] for indx in plot_indxs])
+                    timer.record('plotting', clock() - plot_start)
+                else:
+                    live_plots_update(time_stamp, [roi_counts[indx] for indx in plot_indxs])
                 
-        #profiler.disable()
-        #profiler.dump_stats(os.path.join(desktop_path,"Stats.dmp"))
+        if self.num_dropped_frames:
+            print("{} frames were dropped or skipped during the experiment!".format(self.num_dropped_frames))
         
-        #update plots one more time after experiment loop has finished so user can see overall activity results
-        update_plots(act_axes,lns,backgs)
      
-        #Okay we've finished analyzing all them data. Time to save it out.   
-        if self.write_csv:
-            import csv
-            results_keys = sorted(self.results_dict.keys())
-            
-            for key in results_keys:        
-                with open("{}/{}-{}.csv".format(self.save_dir, self.expt_timestring, key), "wb") as outfile:
-                    writer = csv.writer(outfile)
-                    writer.writerow(["Time Elapsed (sec)", "Number of active flies", "Stimulation"])
-                    writer.writerows(self.results_dict[key])                
+        if track_flies:
+            #with analysis workers, the summaries were sent back by the workers
+            if not analysis_pool:
+                for roi_name in roi_list:
+                    tracker = getattr(roi_plans[roi_name], 'tracker', None)
+                    if tracker:
+                        self.tracking_summary[roi_name] = tracker.summary()
+            for roi_name in sorted(self.tracking_summary):
+                summary = self.tracking_summary[roi_name]
+                print("{}: flies travelled {:.1f} px at a mean speed of {:.1f} px/sec".format(roi_name, summary["total_distance"], 
+                                                                                              summary["mean_speed"]))
+                if write_csv:
+                    csv_writer.write_row('tracking_summary', [roi_name, summary["total_distance"], 
+                                                              summary["mean_speed"], summary["num_links"]])
+     
+        if timer:
+            print("Stage latencies:")
+            for line in timer.summary_lines():
+                print(line)
+            timer.write_json("{}/{}-stage_timing.json".format(self.save_dir, self.expt_timestring),
+                             frame_source=str(self.frame_source), fps=self.fps, frame_shape=list(self.frame_ring.frame_shape),
+                             num_rois=len(roi_list), analysis_workers=self.analysis_workers,
+                             dropped_frames=self.num_dropped_frames, max_lag=self.max_q_size)
+     
+        #Okay we've finished analyzing all them data. Finish writing it out.   
+        if write_csv:
+            csv_writer.close()
             print("CSVs written to data folder!")
         else:
             print("Experiment is complete! Ready for the next one!")
@@ -612,8 +1041,9 @@ class experiment(object):
 if __name__ == '__main__':     
     
     #fps cap of 30 will result in stable performance
-    #higher fps cap is possible (with a better camera) but will 
-    #incur a linearly increasing (with time) system memory cost.
+    #higher fps cap is possible (with a better camera). If analysis can't keep
+    #up, frames are dropped according to drop_policy (memory use is bounded by
+    #frame_buffer_slots) and the dropped frames are written to a .csv
 
 #    #experiment relevant options
 #    expt_dur: duration of the entire experiment (in seconds)
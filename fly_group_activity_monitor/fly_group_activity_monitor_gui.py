@@ -28,7 +28,6 @@ SOFTWARE.
 
 import sys
 import os
-import time
 from functools import partial
 import multiprocessing as mp
 import numpy as np
@@ -48,52 +47,72 @@ elif sys.version_info[0] >= 3:
     import tkinter.messagebox as messagebox
     
 import fly_activity_experiment_manager as fly_expt_man
+import frame_sources
+import camera_calibration
+import camera_profile
+import roi_analysis
 import roi
 
+#number of camera devices offered in the camera selection menu
+MAX_CAMERA_DEVICES = 4
+#seconds an emergency stopped experiment gets to close its .csv files
+#(and video) before it is terminated
+EMERGENCY_STOP_TIMEOUT = 5
+#milliseconds between checks whether an emergency stopped experiment has exited
+EMERGENCY_STOP_POLL = 100
+
 #getting multiprocess to work with class methods is too much of a pain
 #so we define the run_expt and preview_camera function outside of the class
 #see: http://stackoverflow.com/questions/8804830/python-multiprocessing-pickling-error
 def run_expt(expt_conn, write_video, write_csv, use_arduino, expt_dur, 
              led_freq, led_dur, stim_on_time, stim_dur, fps_cap, roi_list, 
-             roi_dict, gui_cam_calib_data, default_save_dir):
+             roi_dict, gui_cam_calib_data, default_save_dir, frame_source=None,
+             grayscale=False):
     
     expt = fly_expt_man.experiment(expt_conn, write_video, write_csv, 
                                    use_arduino, expt_dur, led_freq, led_dur,
                                    stim_on_time, stim_dur, fps_cap, roi_list, 
-                                   roi_dict, gui_cam_calib_data, default_save_dir)
+                                   roi_dict, gui_cam_calib_data, default_save_dir,
+                                   frame_source=frame_source, grayscale=grayscale)
     
     expt.start_expt()
     
 def correct_distortion(raw_frame, calibration_data):
-    mtx = calibration_data["camera_matrix"]
-    dist = calibration_data["dist_coeff"]          
-    h,  w = raw_frame.shape[:2]           
-    #apply undistortion
-    newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx,dist,(w,h),1,(w,h))
-    unwarped = cv2.undistort(raw_frame, mtx, dist, None, newcameramtx)         
+    #undistortion tables are loaded from next to the calibration .json file
+    #if they have already been built for this frame size
+    calibration = camera_calibration.camera_calibration.from_dict(calibration_data)
+    unwarped = calibration.undistort(raw_frame)
     # crop the image
     #x,y,w,h = roi
     #unwarped = unwarped[y:y+h, x:x+w]    
     return unwarped
 
-def preview_camera(calibration_data = None):   
-    cam = cv2.VideoCapture(0)
+def preview_camera(calibration_data = None, frame_source = None):   
+    frame_source = frame_sources.frame_source_from_spec(frame_source)
+    cam = frame_source.open()
+    if calibration_data:
+        calibration = camera_calibration.camera_calibration.from_dict(calibration_data)
+    #play back recorded and synthetic sources at their nominal frame rate
+    wait_ms = 1 if frame_source.is_live else max(1, int(1000/frame_source.fps))
     
     while True:
         ret, frame = cam.read()
         if ret:                    
             if calibration_data:            
-                unwarped = correct_distortion(frame, calibration_data)           
+                unwarped = calibration.undistort(frame)           
                 #image comparisons
                 cv2.imshow('Calibrated camera preview: press "Esc" to close',unwarped) 
             else:
                 cv2.imshow('Camera preview: press "Esc" to close', frame)
-            key = cv2.waitKey(1) & 0xff
+            key = cv2.waitKey(wait_ms) & 0xff
             if key == 27:
                 break
-        else:
+        elif frame_source.is_live:
             print("Could not find a valid camera! Try checking camera!")
             break
+        else:
+            print("Reached the end of the frame source: {}".format(frame_source))
+            break
     cam.release()
     cv2.destroyAllWindows()
     
@@ -170,15 +189,17 @@ def calibrate_camera(perform_save, num_samples = 200):
             "camera_matrix": mtx.tolist(),
             "dist_coeff": dist.tolist()}
     
+    fname = None
     if perform_save:
-        fname = "Camera_calibration_matrices.json"
+        fname = os.path.abspath("Camera_calibration_matrices.json")
         
         with open(fname, "w") as f:
             json.dump(data, f)        
         
     calibration_data = {"reprojection_error": data["reprojection_error"], 
                         "camera_matrix": np.array(data["camera_matrix"]),
-                        "dist_coeff": np.array(data["dist_coeff"])}
+                        "dist_coeff": np.array(data["dist_coeff"]),
+                        "filepath": fname}
                         
     return calibration_data
 
@@ -223,7 +244,12 @@ class Application(tk.Frame):
         
         self.write_vid = tk.IntVar()
         self.write_csv = tk.IntVar()
+        self.grayscale = tk.IntVar()
         self.fps_cap = tk.StringVar()
+        
+        self.num_rois = tk.StringVar()
+        self.roi_shape = tk.StringVar()
+        self.camera_device = tk.StringVar()
     
         self.expt_dur.set("1200")
         self.stim_on_time.set("300")
@@ -235,9 +261,16 @@ class Application(tk.Frame):
         
         self.write_vid.set("1")
         self.write_csv.set("1")
+        self.grayscale.set("0")
         self.fps_cap.set("30")
         
+        self.num_rois.set("4")
+        self.roi_shape.set("rectangle")
+        self.camera_device.set("0")
+        
         self.expt_running = None
+        #frames come from the first attached camera unless told otherwise
+        self.frame_source = frame_sources.camera_source(0)
     
     def dir_list_init(self, dir_list):
         if sys.platform == 'win32' or sys.platform == "darwin":
@@ -248,6 +281,11 @@ class Application(tk.Frame):
             dir_list.insert(0, desktop_path)
     
     #============ work horse functions =================
+    def handle_camera_select(self, device):
+        #preview, ROI setting and experiments all use the selected camera
+        self.frame_source = frame_sources.camera_source(int(device))
+        
+
     def choose_dir(self, root):
         dir_path = filedialog.askdirectory(parent=root, title='Select the directory where you wish to activity assay data to:', mustexist=True)
         return dir_path
@@ -257,16 +295,23 @@ class Application(tk.Frame):
         return file_path
         
     def get_preview_img(self):
-        cam = cv2.VideoCapture(0)       
+        cam = self.frame_source.open()
+        if self.frame_source.is_live:
+            #the saved camera profile says how many autogain frames have to be
+            #discarded (cameras without a profile are measured with this handle)
+            self.frame_source.apply_profile(camera_profile.get_camera_profile(self.frame_source, cam=cam))
         preview_img = None
-        for x in range(30):
-            ret, preview_img = cam.read()        
+        #discard autogain frames from live cameras before grabbing the preview
+        for x in range(max(1, self.frame_source.warmup_frames)):
+            ret, frame = cam.read()
+            if ret:
+                preview_img = frame
         cam.release()
         
         return preview_img
         
     def save_rois(self):     
-        data = {roi_name: [list(coord) for coord in self.roi_dict[roi_name]] for roi_name in self.roi_list}                   
+        data = {roi_name: [np.asarray(coord).tolist() for coord in self.roi_dict[roi_name]] for roi_name in self.roi_list}                   
         fname = "FlyActivityAssay_ROIs.json"   
 
         if os.path.exists(fname):
@@ -291,7 +336,7 @@ class Application(tk.Frame):
                     data = json.load(data_file)                       
                     try:
                         #regenerate the roi names that exist in the data_file
-                        self.roi_list = sorted([str(roi_key) for roi_key in data.keys()])            
+                        self.roi_list = sorted([str(roi_key) for roi_key in data.keys()], key=roi_analysis.roi_sort_key)            
                         #regenerate the roi dictionary that allows lookup of roi coordinates
                         self.roi_dict = {roi_name:tuple([np.array(element) for element in data[roi_name]]) for roi_name in self.roi_list}
                         print("ROI.json file was successfully loaded!")
@@ -324,7 +369,8 @@ class Application(tk.Frame):
                     try:
                         self.calibration_data = {"reprojection_error": data["reprojection_error"], 
                                                  "camera_matrix": np.array(data["camera_matrix"]),
-                                                 "dist_coeff": np.array(data["dist_coeff"])}                                          
+                                                 "dist_coeff": np.array(data["dist_coeff"]),
+                                                 "filepath": os.path.abspath(filepath)}                                          
                         print("Camera calibration .json file was successfully loaded!")
                         sys.stdout.flush()
                     except:
@@ -378,7 +424,7 @@ class Application(tk.Frame):
         if calibration_data == None:
             if hasattr(self, 'calibration_data'):
                 calibration_data = self.calibration_data
-        cam_preview_proc = mp.Process(target=preview_camera, args=(calibration_data,))   
+        cam_preview_proc = mp.Process(target=preview_camera, args=(calibration_data, self.frame_source))   
         cam_preview_proc.start()
         
     def handle_view_calib_details(self, root):
@@ -405,10 +451,16 @@ class Application(tk.Frame):
         dir_list.insert(0, dir_path)   
     
     def handle_set_rois(self, save_roi_btn):
-        #Hardcoded 4 ROIs, perhaps in the future user will be able to add
-        #a customized number of them...
-        roi_list = [('blue', 'roi1'), ('red', 'roi2'), 
-                    ('green', 'roi3'), ('purple', 'roi4')]
+        try:
+            num_rois = int(self.num_rois.get())
+        except ValueError:
+            print("The number of ROIs has to be a whole number!")
+            sys.stdout.flush()
+            return
+        roi_colors = fly_expt_man.ROI_COLORS
+        roi_list = [(roi_colors[indx % len(roi_colors)], 'roi{}'.format(indx + 1)) for indx in range(num_rois)]
+        roi_tools = {'rectangle': roi.set_roi, 'polygon': roi.set_polygon, 'circle': roi.set_circle}
+        set_roi = roi_tools[self.roi_shape.get()]
                     
         preview_img = self.get_preview_img()
         
@@ -416,7 +468,7 @@ class Application(tk.Frame):
             preview_img = correct_distortion(preview_img, self.calibration_data)
                     
         for roi_color, roi_name in roi_list:
-            setattr(self, roi_name, roi.set_roi(roi_color, preview_img))
+            setattr(self, roi_name, set_roi(roi_color, preview_img))
             getattr(self, roi_name).wait_for_roi()     
             
         self.roi_dict = {roi_name:getattr(getattr(self, roi_name), 'roi') for roi_color, roi_name in roi_list}
@@ -451,7 +503,8 @@ class Application(tk.Frame):
                                  float(self.led_dur.get()), float(self.stim_on_time.get()),
                                  float(self.stim_dur.get()), float(self.fps_cap.get()), 
                                  self.roi_list, self.roi_dict, 
-                                 self.calibration_data, default_save_dir)                                
+                                 self.calibration_data, default_save_dir,
+                                 self.frame_source, bool(self.grayscale.get()))                                
                     self.expt_proc = mp.Process(target=run_expt, args=expt_args)   
                     self.expt_proc.start()
                     self.expt_running = True                                    
@@ -464,10 +517,19 @@ class Application(tk.Frame):
             
     def handle_emergency_stop(self):
         self.gui_conn.send('Shutdown!')
-        time.sleep(1)
+        #don't join() here, that would freeze the GUI while the experiment
+        #closes its files. Check back on it from the Tk event loop instead
+        num_polls = int(EMERGENCY_STOP_TIMEOUT * 1000 / EMERGENCY_STOP_POLL)
+        self.after(EMERGENCY_STOP_POLL, self.finish_emergency_stop, num_polls)
+
+    def finish_emergency_stop(self, polls_left):
+        if self.expt_proc.is_alive() and polls_left > 0:
+            self.after(EMERGENCY_STOP_POLL, self.finish_emergency_stop, polls_left - 1)
+            return
         self.expt_conn.close()
         self.gui_conn.close()
-        self.expt_proc.terminate()
+        if self.expt_proc.is_alive():
+            self.expt_proc.terminate()
     
     #================= GUI widgets ========================
     def create_widgets(self):
@@ -596,6 +658,14 @@ class Application(tk.Frame):
         write_csv_checkbox.var = self.write_csv
         write_csv_checkbox.pack(side=tk.LEFT, padx=50)
         
+        grayscale_checkbox = tk.Checkbutton(other_opt_frame, 
+                                            text="Grayscale (IR) mode?", 
+                                            variable=self.grayscale)
+        grayscale_checkbox.var = self.grayscale
+        grayscale_checkbox.pack(side=tk.LEFT)
+        grayscale_tooltip_txt = "Capture, analyze and record single channel\nvideo. Much faster and loses nothing\nwhen flies are IR backlit."
+        create_tool_tip(grayscale_checkbox, grayscale_tooltip_txt)
+        
         #+++++++++++++++++++++++ fps cap frame +++++++++++++++++++++++++
         fps_cap_frame = tk.Frame(other_opt_frame)
         fps_cap_frame.pack(side=tk.RIGHT, fil=tk.X,  pady=10)
@@ -608,6 +678,20 @@ class Application(tk.Frame):
         
         fps_cap_label.pack(side=tk.TOP)
         fps_cap_entry.pack(side=tk.TOP)
+        
+        #+++++++++++++++++++++++ camera frame +++++++++++++++++++++++++
+        camera_frame = tk.Frame(other_opt_frame)
+        camera_frame.pack(side=tk.RIGHT, fil=tk.X, pady=10, padx=30)
+        
+        camera_label = tk.Label(camera_frame, text = "Camera:")
+        camera_menu = tk.OptionMenu(camera_frame, self.camera_device, 
+                                    *[str(device) for device in range(MAX_CAMERA_DEVICES)],
+                                    command=self.handle_camera_select)
+        camera_tooltip_txt = "Camera device to use. To run several\ncameras at once use multi_camera_experiment.py"
+        create_tool_tip(camera_menu, camera_tooltip_txt)
+        
+        camera_label.pack(side=tk.TOP)
+        camera_menu.pack(side=tk.TOP)
             
         #------------------- Bottom Frame ------------------------------
         #Preview video, set ROIs, halt Experiment    
@@ -640,6 +724,16 @@ class Application(tk.Frame):
         roi_tooltip_txt = "Set the regions of interest\n to quantitate activity over.\nAfter setting ROIs, the option\n to save them will appear."
         create_tool_tip(set_roi_btn, roi_tooltip_txt)
         
+        num_rois_label = tk.Label(roi_frame, text = "Number:")
+        num_rois_label.pack(side=tk.LEFT)
+        num_rois_entry = tk.Entry(roi_frame, textvariable=self.num_rois, 
+                                  justify=tk.CENTER, width=4)
+        num_rois_entry.pack(side=tk.LEFT)
+        roi_shape_menu = tk.OptionMenu(roi_frame, self.roi_shape, *roi_analysis.ROI_SHAPES)
+        roi_shape_menu.pack(side=tk.LEFT, padx=5)
+        roi_shape_tooltip_txt = "Number and shape of the ROIs\nto set. Polygon vertices are\nadded by clicking, circles are\ndrawn from their center."
+        create_tool_tip(roi_shape_menu, roi_shape_tooltip_txt)
+        
         load_roi_btn = tk.Button(roi_frame, text="Load ROIs", pady=2, 
                                  command=partial(self.load_rois, self.master, "Please select the ROIs.json file you wish to load "))
         load_roi_btn.pack(side=tk.RIGHT, fill=tk.X,expand=1, pady=15)
@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+"""
+Frame sources that the experiment manager and GUI can read video frames from.
+
+A frame source is a small, picklable description of where frames come from
+(a live camera, a recorded .avi/.mp4, a directory of images or a synthetic
+generator). Calling open() on a source returns a frame_reader which behaves
+like a cv2.VideoCapture (read(), set(), release()) so the same camera loop in
+control_expt() can consume any of them.
+
+synthetic_arena_source renders multi arena recordings with known ground
+truth (how many flies moved in every arena in every frame) for benchmarking
+and validating the whole counting pipeline.
+
+Live sources are paced by the fps cap in control_expt(). Recorded and synthetic
+sources are not live: they are read as fast as the CPU allows and report the
+timestamp of each frame from the source's own frame rate instead of the
+wall clock, so replayed sessions go through exactly the same analysis path.
+
+Sources can also be opened in grayscale mode (open(grayscale=True)). With IR
+backlighting the colour channels carry no information, so frames are then
+converted to single channel once, right when they are read (image and
+synthetic sources produce single channel frames directly).
+"""
+import os
+import glob
+
+import numpy as np
+import cv2
+
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mov', '.mkv')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+class frame_reader(object):
+    """
+    An opened frame source. Wraps the underlying capture object and keeps
+    track of how many frames have been read so that non-live sources can
+    report a timestamp for the most recently read frame.
+
+    If grayscale is True, every frame read is single channel (h, w)
+    """
+    def __init__(self, source, capture, grayscale=False):
+        self.source = source
+        self.capture = capture
+        self.grayscale = grayscale
+        self.frame_count = 0
+
+    @property
+    def is_live(self):
+        return self.source.is_live
+
+    @property
+    def fps(self):
+        return self.source.fps
+
+    @property
+    def frame_time(self):
+        """
+        Time (in seconds) of the most recently read frame relative to the
+        first frame of the source. Returns None for live sources, where the
+        wall clock should be used instead.
+        """
+        if self.source.is_live or self.frame_count == 0:
+            return None
+        return (self.frame_count - 1)/float(self.source.fps)
+
+    def read(self):
+        ret, frame = self.capture.read()
+        if ret:
+            self.frame_count += 1
+            if self.grayscale and frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return ret, frame
+
+    def set(self, prop_id, value):
+        #Only real cv2.VideoCapture objects understand capture properties
+        if hasattr(self.capture, 'set'):
+            return self.capture.set(prop_id, value)
+        return False
+
+    def release(self):
+        self.capture.release()
+
+class frame_source(object):
+    """
+    Base class for all frame sources.
+
+    is_live: whether frames arrive in real time (and should be fps capped)
+    fps: nominal frame rate of the source
+    warmup_frames: number of frames to discard right after opening
+    """
+    is_live = False
+    fps = 30.0
+    warmup_frames = 0
+
+    def open(self, grayscale=False):
+        return frame_reader(self, self._open_capture(grayscale), grayscale)
+
+    def _open_capture(self, grayscale=False):
+        """
+        Returns an object with read() and release() methods. Captures that can
+        produce single channel frames directly should do so if grayscale is True.
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.description)
+
+    @property
+    def description(self):
+        return ''
+
+class camera_source(frame_source):
+    """
+    Live camera attached to the computer. 'device' is the cv2.VideoCapture
+    device index.
+    """
+    is_live = True
+
+    def __init__(self, device=0, warmup_frames=30, fps=None):
+        self.device = device
+        #We don't want the camera to try to autogain as it messes up the image
+        #So by default we discard the first few frames after opening the camera
+        #(a measured camera profile knows how many are really needed)
+        self.warmup_frames = warmup_frames
+        self.fps = fps
+
+    @property
+    def description(self):
+        return 'device={}'.format(self.device)
+
+    def _open_capture(self, grayscale=False):
+        cam = cv2.VideoCapture(self.device)
+        if not cam.isOpened():
+            raise IOError('Could not open camera device: {}'.format(self.device))
+        #We don't want the camera to try to autogain as it messes up the image
+        cam.set(cv2.CAP_PROP_AUTO_EXPOSURE, 0)
+        cam.set(cv2.CAP_PROP_GAIN, 0)
+        return cam
+
+    def apply_profile(self, profile):
+        """
+        Use the frame rate and warm-up measured in a camera_profile.camera_profile
+        """
+        self.fps = profile.fps
+        self.warmup_frames = profile.warmup_frames
+
+class video_file_source(frame_source):
+    """
+    Previously recorded video file (i.e. the 'video--<timestring>.avi' files
+    written by control_expt). If fps is not given, it is read from the file.
+    """
+    def __init__(self, filepath, fps=None):
+        self.filepath = os.path.abspath(filepath)
+        if not os.path.isfile(self.filepath):
+            raise IOError('Could not find video file: {}'.format(self.filepath))
+        self.fps = fps
+        if self.fps is None:
+            probe = cv2.VideoCapture(self.filepath)
+            self.fps = probe.get(cv2.CAP_PROP_FPS) or 30.0
+            probe.release()
+
+    @property
+    def description(self):
+        return self.filepath
+
+    def _open_capture(self, grayscale=False):
+        cap = cv2.VideoCapture(self.filepath)
+        if not cap.isOpened():
+            raise IOError('Could not open video file: {}'.format(self.filepath))
+        return cap
+
+class _image_sequence_capture(object):
+    """
+    Minimal cv2.VideoCapture stand-in that reads a list of image files in order
+    """
+    def __init__(self, image_paths, grayscale=False):
+        self.image_paths = image_paths
+        self.read_flag = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+        self.indx = 0
+
+    def read(self):
+        if self.indx >= len(self.image_paths):
+            return False, None
+        frame = cv2.imread(self.image_paths[self.indx], self.read_flag)
+        self.indx += 1
+        return frame is not None, frame
+
+    def release(self):
+        self.indx = len(self.image_paths)
+
+class image_dir_source(frame_source):
+    """
+    Directory of still images that are played back in sorted filename order
+    at the specified nominal fps.
+    """
+    def __init__(self, directory, pattern='*', fps=30.0):
+        self.directory = os.path.abspath(directory)
+        self.fps = float(fps)
+        self.image_paths = sorted([path for path in glob.glob(os.path.join(self.directory, pattern))
+                                   if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS])
+        if not self.image_paths:
+            raise IOError('Could not find any images in: {}'.format(self.directory))
+
+    @property
+    def description(self):
+        return self.directory
+
+    def _open_capture(self, grayscale=False):
+        return _image_sequence_capture(self.image_paths, grayscale)
+
+class _synthetic_capture(object):
+    """
+    Renders IR backlit looking frames (bright background) with dark blobs that
+    drift around and bounce off the edges of the frame.
+    """
+    def __init__(self, frame_height, frame_width, num_frames, num_blobs,
+                 blob_radius, blob_speed, seed, grayscale=False):
+        self.frame_height = frame_height
+        self.frame_width = frame_width
+        self.num_frames = num_frames
+        self.blob_radius = blob_radius
+        self.indx = 0
+
+        rng = np.random.RandomState(seed)
+        lower = np.array([blob_radius, blob_radius])
+        upper = np.array([frame_width - blob_radius, frame_height - blob_radius])
+        self.positions = rng.uniform(lower, upper, size=(num_blobs, 2))
+        angles = rng.uniform(0, 2*np.pi, size=num_blobs)
+        self.velocities = blob_speed * np.column_stack((np.cos(angles), np.sin(angles)))
+        self.lower = lower
+        self.upper = upper
+        if grayscale:
+            self.background = np.full((frame_height, frame_width), 200, np.uint8)
+        else:
+            self.background = np.full((frame_height, frame_width, 3), 200, np.uint8)
+
+    def read(self):
+        if self.num_frames is not None and self.indx >= self.num_frames:
+            return False, None
+        self.positions += self.velocities
+        #bounce blobs off of the frame edges
+        out_of_bounds = (self.positions < self.lower) | (self.positions > self.upper)
+        self.velocities[out_of_bounds] *= -1
+        np.clip(self.positions, self.lower, self.upper, out=self.positions)
+
+        frame = self.background.copy()
+        for x, y in self.positions.astype(int):
+            cv2.circle(frame, (x, y), self.blob_radius, (40, 40, 40), -1)
+        self.indx += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+class synthetic_source(frame_source):
+    """
+    Synthetic frame generator that needs no camera or recorded data.
+    num_frames=None will generate frames forever.
+    """
+    def __init__(self, frame_height=480, frame_width=640, num_frames=1800,
+                 num_blobs=20, blob_radius=6, blob_speed=2.0, fps=30.0, seed=0):
+        self.frame_height = frame_height
+        self.frame_width = frame_width
+        self.num_frames = num_frames
+        self.num_blobs = num_blobs
+        self.blob_radius = blob_radius
+        self.blob_speed = blob_speed
+        self.fps = float(fps)
+        self.seed = seed
+
+    @property
+    def description(self):
+        return '{}x{}, {} blobs'.format(self.frame_width, self.frame_height, self.num_blobs)
+
+    def _open_capture(self, grayscale=False):
+        return _synthetic_capture(self.frame_height, self.frame_width,
+                                  self.num_frames, self.num_blobs,
+                                  self.blob_radius, self.blob_speed, self.seed,
+                                  grayscale)
+
+class _arena_simulation(object):
+    """
+    Flies walking around inside circular arenas laid out in a grid. Every
+    fly is either walking or standing still and switches between the two at
+    random (p_start, p_stop per frame), so the number of moving flies in each
+    arena changes over time. Only the simulation's own random state is used,
+    so the same seed always gives the same fly trajectories.
+    """
+    def __init__(self, frame_height, frame_width, arena_rows, arena_cols, flies_per_arena,
+                 fly_length, fly_speed, p_start, p_stop, seed):
+        cell_height = frame_height / float(arena_rows)
+        cell_width = frame_width / float(arena_cols)
+        self.arena_radius = int(0.45 * min(cell_height, cell_width))
+        xs = (np.arange(arena_cols) + 0.5) * cell_width
+        ys = (np.arange(arena_rows) + 0.5) * cell_height
+        #arenas are numbered row by row (like roi_analysis.plate_rois())
+        self.arena_centers = np.array([[x, y] for y in ys for x in xs])
+        num_arenas = len(self.arena_centers)
+        self.fly_arena = np.repeat(np.arange(num_arenas), flies_per_arena)
+        num_flies = len(self.fly_arena)
+        self.num_arenas = num_arenas
+        self.fly_speed = fly_speed
+        self.p_start = p_start
+        self.p_stop = p_stop
+        #flies can walk up to their own length away from the arena wall
+        self.max_radius = max(1.0, self.arena_radius - fly_length)
+
+        self.rng = np.random.RandomState(seed)
+        radii = self.max_radius * np.sqrt(self.rng.uniform(0, 1, num_flies))
+        angles = self.rng.uniform(0, 2*np.pi, num_flies)
+        self.offsets = np.column_stack((radii * np.cos(angles), radii * np.sin(angles)))
+        self.headings = self.rng.uniform(0, 2*np.pi, num_flies)
+        self.moving = self.rng.uniform(0, 1, num_flies) < 0.5
+
+    @property
+    def positions(self):
+        return self.arena_centers[self.fly_arena] + self.offsets
+
+    def step(self):
+        """
+        Advance the simulation by one frame. Returns the number of flies that
+        moved in every arena during this frame.
+        """
+        num_flies = len(self.fly_arena)
+        switch = self.rng.uniform(0, 1, num_flies)
+        self.moving = np.where(self.moving, switch >= self.p_stop, switch < self.p_start)
+        #still flies keep their heading so they don't show up as motion
+        turns = self.rng.normal(0, 0.3, num_flies)
+        self.headings[self.moving] += turns[self.moving]
+        steps = self.fly_speed * np.column_stack((np.cos(self.headings), np.sin(self.headings)))
+        self.offsets[self.moving] += steps[self.moving]
+        #flies that walk into the arena wall turn around
+        radii = np.sqrt((self.offsets**2).sum(axis=1))
+        outside = radii > self.max_radius
+        if outside.any():
+            self.offsets[outside] *= (self.max_radius / radii[outside])[:, np.newaxis]
+            self.headings[outside] += np.pi
+        return np.bincount(self.fly_arena[self.moving], minlength=self.num_arenas)
+
+class _synthetic_arena_capture(object):
+    """
+    Renders IR backlit looking arenas (bright background, slightly darker
+    arena floors) with dark elongated flies and a bit of sensor noise.
+    """
+    def __init__(self, simulation, frame_height, frame_width, num_frames, fly_length,
+                 noise, seed, grayscale=False):
+        self.simulation = simulation
+        self.num_frames = num_frames
+        self.fly_axes = (max(1, int(fly_length / 2)), max(1, int(fly_length / 5)))
+        self.indx = 0
+        background = np.full((frame_height, frame_width), 215, np.uint8)
+        for x, y in simulation.arena_centers.astype(int):
+            cv2.circle(background, (x, y), simulation.arena_radius, 180, -1)
+            cv2.circle(background, (x, y), simulation.arena_radius, 120, 2)
+        if not grayscale:
+            background = cv2.cvtColor(background, cv2.COLOR_GRAY2BGR)
+        self.background = background
+        self.frame = np.empty_like(background)
+        #a few precomputed noise frames are cycled through so rendering stays cheap
+        #(and doesn't touch the simulation's random state)
+        noise_rng = np.random.RandomState(seed + 1)
+        self.noise_frames = [noise_rng.normal(0, noise, background.shape).astype(np.int16) if noise else None
+                             for x in range(8)]
+        self.work = np.empty(background.shape, np.int16)
+        #moving flies per arena of the most recently rendered frame
+        self.moving_counts = None
+
+    def read(self):
+        if self.num_frames is not None and self.indx >= self.num_frames:
+            return False, None
+        self.moving_counts = self.simulation.step()
+        frame = self.frame
+        np.copyto(frame, self.background)
+        color = (30, 30, 30) if frame.ndim == 3 else 30
+        for (x, y), heading in zip(self.simulation.positions, self.simulation.headings):
+            cv2.ellipse(frame, (int(x), int(y)), self.fly_axes, np.degrees(heading), 0, 360, color, -1)
+        noise = self.noise_frames[self.indx % len(self.noise_frames)]
+        if noise is not None:
+            np.add(frame, noise, out=self.work, dtype=np.int16)
+            np.clip(self.work, 0, 255, out=self.work)
+            frame = self.work.astype(np.uint8)
+        else:
+            frame = frame.copy()
+        self.indx += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+class synthetic_arena_source(frame_source):
+    """
+    Synthetic multi arena recording with known ground truth, for benchmarks
+    and validation of the counting pipeline.
+
+    arena_rows, arena_cols: grid of circular arenas (see arena_layout())
+    flies_per_arena: fly density
+    fly_length: body length of a fly in pixels, fly_speed: pixels per frame
+    p_start, p_stop: per frame probability that a still fly starts walking
+                     (or a walking fly stops)
+    noise: standard deviation of the sensor noise in gray levels
+
+    ground_truth() gives the number of flies that moved in every arena in
+    every frame, the n-th frame read corresponds to the n-th row.
+    """
+    def __init__(self, frame_height=480, frame_width=640, num_frames=1800,
+                 arena_rows=2, arena_cols=2, flies_per_arena=10, fly_length=10,
+                 fly_speed=2.0, p_start=0.05, p_stop=0.05, noise=2.0, fps=30.0, seed=0):
+        self.frame_height = frame_height
+        self.frame_width = frame_width
+        self.num_frames = num_frames
+        self.arena_rows = arena_rows
+        self.arena_cols = arena_cols
+        self.flies_per_arena = flies_per_arena
+        self.fly_length = fly_length
+        self.fly_speed = fly_speed
+        self.p_start = p_start
+        self.p_stop = p_stop
+        self.noise = noise
+        self.fps = float(fps)
+        self.seed = seed
+
+    @property
+    def description(self):
+        return '{}x{}, {}x{} arenas, {} flies per arena'.format(self.frame_width, self.frame_height,
+                                                                 self.arena_rows, self.arena_cols,
+                                                                 self.flies_per_arena)
+
+    def _simulation(self):
+        return _arena_simulation(self.frame_height, self.frame_width, self.arena_rows, self.arena_cols,
+                                 self.flies_per_arena, self.fly_length, self.fly_speed,
+                                 self.p_start, self.p_stop, self.seed)
+
+    def arena_layout(self):
+        """
+        (rows, cols, first_center, last_center, radius) of the arenas, as
+        taken by roi_analysis.plate_rois()
+        """
+        simulation = self._simulation()
+        centers = simulation.arena_centers
+        return self.arena_rows, self.arena_cols, centers[0], centers[-1], simulation.arena_radius
+
+    def ground_truth(self, num_frames=None):
+        """
+        (num_frames, num_arenas) array of the number of moving flies in every
+        arena in every frame (without rendering any frames)
+        """
+        if num_frames is None:
+            num_frames = self.num_frames
+        simulation = self._simulation()
+        return np.array([simulation.step() for x in range(num_frames)])
+
+    def _open_capture(self, grayscale=False):
+        return _synthetic_arena_capture(self._simulation(), self.frame_height, self.frame_width,
+                                        self.num_frames, self.fly_length, self.noise, self.seed,
+                                        grayscale)
+
+def frame_source_from_spec(spec):
+    """
+    Convenience function that turns a simple specification into a frame source
+        an int (or a string of digits) -> live camera device
+        'synthetic' -> synthetic frame generator
+        'synthetic_arena' -> synthetic arenas with ground truth
+        path to a directory -> directory of images
+        path to a video file -> recorded video
+    Frame source instances are passed through unchanged.
+    """
+    if isinstance(spec, frame_source):
+        return spec
+    if spec is None:
+        return camera_source(0)
+    if isinstance(spec, int) or str(spec).isdigit():
+        return camera_source(int(spec))
+    if spec == 'synthetic':
+        return synthetic_source()
+    if spec == 'synthetic_arena':
+        return synthetic_arena_source()
+    if os.path.isdir(spec):
+        return image_dir_source(spec)
+    if os.path.splitext(spec)[1].lower() in VIDEO_EXTENSIONS:
+        return video_file_source(spec)
+    raise ValueError('Could not determine what kind of frame source "{}" is!'.format(spec))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Cheap 1-D beam crossing detector for the line ROIs set with roi.set_line().
+
+A line ROI is a thin strip across the arena. Instead of running background
+subtraction and contour finding on it, the strip is split lengthwise into two
+'beams' (the half on either side of the line) and each beam is collapsed to a
+1-D intensity profile along the line. Positions where a beam profile differs
+from its (slowly updated) baseline by more than threshold are occupied.
+
+Runs of occupied positions are flies on the line. Each run is followed from
+frame to frame by overlap with the runs of the previous frame and remembers
+which beam it was on when it appeared. When it leaves the line, it counts as
+a crossing if it left on the other beam than the one it entered on.
+
+Beam 'A' is on the left of a vertical line (top of a horizontal one), so
+crossings are reported as 'left_to_right'/'right_to_left' or
+'top_to_bottom'/'bottom_to_top'.
+
+Strips thinner than MIN_THICKNESS pixels (i.e. the default 3 pixel wide
+lines analyzed at a quarter of the camera resolution) are widened around
+their center so they still have two beams.
+"""
+import math
+
+import numpy as np
+import cv2
+
+DIRECTIONS = {'vertical': ('left_to_right', 'right_to_left'),
+              'horizontal': ('top_to_bottom', 'bottom_to_top')}
+#a strip has to be at least this wide (across the line) for two beams
+MIN_THICKNESS = 2
+
+def is_line_roi(roi_name):
+    #same naming convention as the experiment's interactive ROI selection
+    #('line1', 'line2'...), so i.e. 'outline1' or 'baseline' are not lines
+    return roi_name.startswith('line')
+
+def widen_strip(start, end, size):
+    """
+    (start, end) of a strip across the line widened around its center to
+    MIN_THICKNESS pixels if it is thinner, kept inside 0 to size if possible
+    """
+    if end - start >= MIN_THICKNESS:
+        return start, end
+    start = max(0, min(size - MIN_THICKNESS, int(math.floor((start + end - MIN_THICKNESS) / 2.0))))
+    return start, start + MIN_THICKNESS
+
+def find_runs(occupied):
+    """
+    (start, end) index pairs (end exclusive) of every run of True in a 1-D bool array
+    """
+    edges = np.diff(np.concatenate(([0], occupied.view(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+class _line_track(object):
+    def __init__(self, start, end, side):
+        self.start = start
+        self.end = end
+        self.entry_side = side
+        self.side = side
+
+class line_crossing_detector(object):
+    """
+    Crossing detector for one line ROI. Has the same process() interface as
+    roi_analysis.roi_plan so it can be used in its place (the background
+    subtractor argument is ignored).
+
+    roi_coords: (start_pos, end_pos) of the line strip, each in array([x,y]) format
+    frame_shape: shape of the frames the strip will be cropped from
+    threshold: difference (in gray levels) from the baseline that counts as occupied
+    min_size: runs shorter than this (in pixels along the line) are ignored
+    alpha: how quickly the baseline follows slow lighting changes
+    """
+    def __init__(self, roi_coords, frame_shape, threshold=40, min_size=2, alpha=0.05):
+        start_pos, end_pos = roi_coords
+        x_start, y_start = int(start_pos[0]), int(start_pos[1])
+        x_end, y_end = int(end_pos[0]), int(end_pos[1])
+        #the line runs along the long side of the strip
+        self.line_mode = 'vertical' if x_end - x_start <= y_end - y_start else 'horizontal'
+        #strips scaled down for reduced resolution analysis (see
+        #roi_analysis.scale_roi_coords()) can end up too thin to split in two beams
+        if self.line_mode == 'vertical':
+            x_start, x_end = widen_strip(x_start, x_end, frame_shape[1])
+        else:
+            y_start, y_end = widen_strip(y_start, y_end, frame_shape[0])
+        #Image cropping works by img[y: y + h, x: x + w]
+        self.y_slice = slice(max(0, y_start), y_end)
+        self.x_slice = slice(max(0, x_start), x_end)
+        height = len(range(*self.y_slice.indices(frame_shape[0])))
+        width = len(range(*self.x_slice.indices(frame_shape[1])))
+        self.offset = self.y_slice.start if self.line_mode == 'vertical' else self.x_slice.start
+        thickness = width if self.line_mode == 'vertical' else height
+        if thickness < MIN_THICKNESS:
+            raise ValueError('Line ROIs have to be at least {} pixels wide to tell crossing directions apart!'.format(MIN_THICKNESS))
+        self.beam_width = thickness // 2
+        self.thickness = thickness
+        self.threshold = threshold
+        self.min_size = min_size
+        self.alpha = alpha
+        self.baseline = None
+        self.tracks = []
+        self.events = []
+
+    def crop(self, frame):
+        return frame[self.y_slice, self.x_slice]
+
+    def beam_profiles(self, cropped_frame):
+        """
+        (2, line length) mean intensity of beam A and beam B at every position along the line
+        """
+        if cropped_frame.ndim == 3:
+            cropped_frame = cv2.cvtColor(cropped_frame, cv2.COLOR_BGR2GRAY)
+        #make axis 0 run along the line and axis 1 across it
+        if self.line_mode == 'horizontal':
+            cropped_frame = cropped_frame.T
+        beam_width = self.beam_width
+        return np.vstack((cropped_frame[:, :beam_width].mean(axis=1),
+                          cropped_frame[:, self.thickness - beam_width:].mean(axis=1)))
+
+    def update(self, cropped_frame):
+        """
+        Process one (cropped) frame, returns the list of (position, direction)
+        crossings that were completed in this frame
+        """
+        profiles = self.beam_profiles(cropped_frame)
+        if self.baseline is None:
+            self.baseline = profiles.copy()
+        diff = np.abs(profiles - self.baseline)
+        beam_occupied = diff > self.threshold
+        occupied = beam_occupied[0] | beam_occupied[1]
+        #only let the baseline follow where no fly is on the line
+        free = ~occupied
+        self.baseline[:, free] += self.alpha * (profiles[:, free] - self.baseline[:, free])
+
+        runs = [(start, end) for start, end in find_runs(occupied) if end - start >= self.min_size]
+        new_tracks = []
+        matched = set()
+        for start, end in runs:
+            side = 0 if diff[0, start:end].sum() >= diff[1, start:end].sum() else 1
+            #a run continues every track it overlaps, if it overlaps none a fly just stepped onto the line
+            overlapping = [track for track in self.tracks if track.start < end and start < track.end]
+            track = _line_track(start, end, overlapping[0].entry_side if overlapping else side)
+            track.side = side
+            new_tracks.append(track)
+            matched.update(id(prev_track) for prev_track in overlapping)
+
+        crossings = []
+        for track in self.tracks:
+            if id(track) not in matched and track.side != track.entry_side:
+                position = self.offset + (track.start + track.end) / 2.
+                crossings.append((position, DIRECTIONS[self.line_mode][track.entry_side]))
+        self.tracks = new_tracks
+        self.events.extend(crossings)
+        return crossings
+
+    def pop_events(self):
+        """
+        All (position, direction) crossings since the last call
+        """
+        events, self.events = self.events, []
+        return events
+
+    def process(self, bg_subtractor, current_frame, annotate=True, time_stamp=None):
+        """
+        Returns the number of crossings completed in this frame and the cropped
+        frame (with flies on the line marked if annotate is True)
+        """
+        cropped_current_frame = self.crop(current_frame)
+        crossings = self.update(cropped_current_frame)
+        if annotate:
+            for track in self.tracks:
+                if self.line_mode == 'vertical':
+                    corners = (0, int(track.start)), (self.thickness - 1, int(track.end) - 1)
+                else:
+                    corners = (int(track.start), 0), (int(track.end) - 1, self.thickness - 1)
+                cv2.rectangle(cropped_current_frame, corners[0], corners[1], (255,0,0), 1)
+        return len(crossings), cropped_current_frame
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Live displays of a running experiment that are kept out of the analysis loop.
+
+Redrawing the matplotlib activity plots for every analyzed frame used to be
+done right in the experiment loop, so a slow redraw held up the analysis.
+Now the experiment loop only collects the (timestamp, counts) of every frame
+in a live_plot_renderer and, at most plot_rate times per second, sends the
+batch collected since the last send to a renderer process. The renderer
+redraws the plots at a fixed rate (5 Hz by default) no matter how fast the
+camera runs. If a redraw takes longer than the period, all batches that piled
+up in the mean time are applied at once and only one redraw is done (renders
+are skipped, data is not), so the renderer falling behind never slows down
+the analysis loop.
+
+The annotated tracking mosaic (the ROI crops stitched into one image) is
+shown by a tracking_display. Its layout and canvases are made once for the
+ROI set, and all HighGUI calls (imshow(), waitKey(), destroyWindow()) run on
+the main thread of a display process that owns the window (HighGUI windows
+can only be used from the main thread on macOS). The analysis loop asks
+wants_frame() before annotating a frame, so frames are only annotated and
+stitched at most max_rate times per second. The mosaic is stitched straight
+into one of three canvases in shared memory and replaces any mosaic the
+display process has not picked up yet (triple buffering), so only the latest
+frame is ever shown and the analysis loop never waits on the display.
+
+matplotlib is only ever imported in the renderer process.
+"""
+import sys
+import math
+import multiprocessing as mp
+from collections import deque
+
+import numpy as np
+import cv2
+
+from capture_scheduler import clock
+from stage_timing import stage_timer
+
+#If we are using python 2.7 or under
+if sys.version_info[0] < 3:
+    import Queue as queue
+#If we are using python 3.0 or above
+elif sys.version_info[0] >= 3:
+    import queue
+
+#seconds to wait for the renderer's final redraw and the display process (and their
+#stage timers) on close()
+TIMER_TIMEOUT = 2.0
+
+def grid_shape(num_cells):
+    """
+    (rows, cols) of the most square grid that fits num_cells
+    """
+    num_rows = max(1, int(math.ceil(math.sqrt(num_cells))))
+    num_cols = max(1, int(math.ceil(num_cells / float(num_rows))))
+    return num_rows, num_cols
+
+def mosaic_layout(frame_shapes):
+    """
+    Lay out frames of the given shapes in a grid that is filled column by
+    column, with every cell as large as the largest frame.
+    Returns the (y, x) upper left corner of every frame and the (h, w) of the mosaic
+    """
+    num_rows, num_cols = grid_shape(len(frame_shapes))
+    cell_height = max(shape[0] for shape in frame_shapes)
+    cell_width = max(shape[1] for shape in frame_shapes)
+    corners = [((indx % num_rows)*cell_height, (indx // num_rows)*cell_width) for indx in range(len(frame_shapes))]
+    return corners, (num_rows*cell_height, num_cols*cell_width)
+
+def init_activity_plots(plot_list, title, expt_dur, stim_on_time, stim_dur):
+    """
+    One subplot for every ROI in plot_list, laid out in a grid that is filled
+    column by column (ROIs 1, 2 in the first column and so on).
+    Returns the figure and its axes in plot_list order.
+    """
+    import matplotlib.pyplot as plt
+    num_rows, num_cols = grid_shape(len(plot_list))
+    #initialize matplotlib plots for raw group activity
+    fig, axes = plt.subplots(num_rows, num_cols, sharex='col', sharey='row', squeeze=False)
+    fig.patch.set_facecolor('white')
+    fig.suptitle(title, weight='bold')
+    grid_axes = [axes[row][col] for col in range(num_cols) for row in range(num_rows)]
+    plot_axes = grid_axes[:len(plot_list)]
+    for ax in grid_axes[len(plot_list):]:
+        ax.set_visible(False)
+    for indx, ax in enumerate(plot_axes):
+        ax.set_xlim(0,expt_dur)
+        ax.set_ylim(-0.5,20)
+        ax.tick_params(top="off",right="off")
+        ax.spines['right'].set_visible(False)
+        ax.spines['top'].set_visible(False)
+        ax.axvspan(stim_on_time, stim_on_time+stim_dur, facecolor='r', alpha=0.25, edgecolor = 'none')
+        ax.tick_params(axis='x', pad=5)
+        ax.tick_params(axis='y', pad=5)
+        #make only every other axis label visible
+        for label in ax.xaxis.get_ticklabels()[::2]:
+            label.set_visible(False)
+    fig.text(0.5, 0.04, 'Time elapsed (sec)', ha='center', va='center', weight='bold')
+    fig.text(0.06, 0.5, 'Number of active flies', ha='center', va='center', rotation='vertical', weight='bold')
+    fig.show()
+    return fig, plot_axes
+
+def tracking_display_loop(canvas_buffer, mosaic_shape, ready, lock, new_frame, stop, window_name,
+                          timer_q=None):
+    """
+    Display process loop. Shows the canvas (of the 3 in canvas_buffer) whose
+    index the analysis loop last put in ready whenever new_frame is set, until
+    stop is set. If timer_q is given imshow()/waitKey() are timed and the
+    stage_timer is put in timer_q at the end.
+    """
+    timer = stage_timer() if timer_q is not None else None
+    canvases = np.frombuffer(canvas_buffer, dtype=np.uint8).reshape((3,) + mosaic_shape)
+    #the canvas being shown, the analysis loop starts out stitching into 0
+    #with 1 ready
+    front = 2
+    frames_shown = 0
+    while not stop.is_set():
+        #keep the window responsive even when no new frames arrive
+        if not new_frame.wait(0.1):
+            if frames_shown:
+                cv2.waitKey(1)
+            continue
+        with lock:
+            front, ready.value = ready.value, front
+            new_frame.clear()
+        if stop.is_set():
+            break
+        if timer:
+            render_start = clock()
+        cv2.imshow(window_name, canvases[front])
+        cv2.waitKey(1)
+        if timer:
+            timer.record('display_render', clock() - render_start)
+        frames_shown += 1
+    if frames_shown:
+        cv2.destroyWindow(window_name)
+        cv2.waitKey(1)
+    if timer_q is not None:
+        timer_q.put(timer)
+
+def plot_render_loop(update_q, plot_list, title, expt_dur, stim_on_time, stim_dur, plot_rate, history,
+                     timer_q=None):
+    """
+    Renderer process loop. Receives batches of (timestamp, count, count, ...)
+    updates (counts in plot_list order) and redraws at most plot_rate times
+    per second. None ends the loop after a final redraw. If timer_q is given
+    redraws are timed and the stage_timer is put in timer_q at the end.
+    """
+    timer = stage_timer() if timer_q is not None else None
+    fig, axes = init_activity_plots(plot_list, title, expt_dur, stim_on_time, stim_dur)
+    canvas = fig.canvas
+    lines = [ax.plot([],[])[0] for ax in axes]
+    #most recent 'history' points of every ROI
+    plot_data = [deque(maxlen=history) for roi_name in plot_list]
+    canvas.draw()
+    backgrounds = [canvas.copy_from_bbox(ax.bbox) for ax in axes]
+
+    def save_backgrounds(event):
+        #the window was resized (or otherwise fully redrawn)
+        backgrounds[:] = [canvas.copy_from_bbox(ax.bbox) for ax in axes]
+    canvas.mpl_connect('draw_event', save_backgrounds)
+
+    period = 1.0/plot_rate
+    next_render = clock()
+    finished = False
+    while not finished:
+        batches = []
+        try:
+            batches.append(update_q.get(True, max(0, next_render - clock())))
+            #grab everything else that has piled up in the mean time
+            while True:
+                batches.append(update_q.get_nowait())
+        except queue.Empty:
+            pass
+        for batch in batches:
+            if batch is None:
+                finished = True
+                continue
+            for update in batch:
+                time_stamp = update[0]
+                for data, count in zip(plot_data, update[1:]):
+                    data.append((time_stamp, count))
+        now = clock()
+        if now < next_render and not finished:
+            continue
+        #redraw just the lines on top of the saved backgrounds and blit
+        if timer:
+            render_start = clock()
+        for ax, line, background, data in zip(axes, lines, backgrounds, plot_data):
+            canvas.restore_region(background)
+            if data:
+                line.set_data(*zip(*data))
+            ax.draw_artist(line)
+            canvas.blit(ax.bbox)
+        canvas.flush_events()
+        if timer:
+            timer.record('plot_render', clock() - render_start)
+        #stay on the fixed schedule, skipping the renders we were too slow for
+        next_render += period * max(1, math.ceil((now - next_render) / period))
+    if timer_q is not None:
+        timer_q.put(timer)
+
+class live_plot_renderer(object):
+    """
+    Analysis loop side of the live activity plots.
+
+    plot_list: names of the ROIs that get a subplot
+    title, expt_dur, stim_on_time, stim_dur: see init_activity_plots()
+    plot_rate: plots are redrawn (and updates sent) at most this many times per second
+    history: number of most recent points shown for every ROI
+    time_stages: time the redraws, the renderer's stage_timer is in self.timer after close()
+    """
+    def __init__(self, plot_list, title, expt_dur, stim_on_time, stim_dur, plot_rate=5.0, history=100,
+                 time_stages=False):
+        self.send_interval = 1.0/plot_rate
+        self.pending = []
+        self.next_send = clock()
+        self.update_q = mp.Queue()
+        self.timer_q = mp.Queue() if time_stages else None
+        self.timer = None
+        self.process = mp.Process(target=plot_render_loop,
+                                  args=(self.update_q, list(plot_list), title, expt_dur,
+                                        stim_on_time, stim_dur, plot_rate, history, self.timer_q))
+        self.process.daemon = True
+        self.process.start()
+
+    def update(self, time_stamp, counts):
+        """
+        Add the counts (in plot_list order) of one frame. Never blocks.
+        """
+        self.pending.append((time_stamp,) + tuple(counts))
+        now = clock()
+        if now >= self.next_send:
+            self.update_q.put_nowait(self.pending)
+            self.pending = []
+            self.next_send = now + self.send_interval
+
+    def close(self):
+        """
+        Send the remaining updates, wait for the final redraw and stop the renderer
+        """
+        if self.pending:
+            self.update_q.put_nowait(self.pending)
+            self.pending = []
+        self.update_q.put_nowait(None)
+        if self.timer_q is not None:
+            #get before join(), the renderer can't exit until its timer is taken.
+            #Timers are only diagnostics, so never hold up the end of the
+            #experiment (and the closing of its .csv files) for long
+            try:
+                self.timer = self.timer_q.get(True, TIMER_TIMEOUT)
+            except queue.Empty:
+                pass
+        self.process.join(TIMER_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.update_q.close()
+
+class tracking_display(object):
+    """
+    Shows the annotated ROI crops of the experiment as one mosaic image.
+
+    max_rate: frames are shown at most this many times per second
+    window_name: name of the OpenCV window
+    time_stages: time imshow()/waitKey() of the display process, its
+                 stage_timer is in self.timer after close()
+
+    The display process is started by the first show(), once the size of
+    the mosaic (and so of its shared canvases) is known.
+    """
+    def __init__(self, max_rate=10.0, window_name='Annotated', time_stages=False):
+        self.interval = 1.0/max_rate
+        self.window_name = window_name
+        self.next_show = clock()
+        self.layout = None
+        #canvases in shared memory: the one being stitched (back) is owned by
+        #the analysis loop, the index of the latest stitched one is in
+        #self.ready and the one being shown belongs to the display process
+        self.canvases = None
+        self.back = 0
+        self.ready = mp.RawValue('i', 1)
+        self.lock = mp.Lock()
+        self.new_frame = mp.Event()
+        self.stop = mp.Event()
+        self.timer_q = mp.Queue() if time_stages else None
+        self.timer = None
+        self.process = None
+
+    def wants_frame(self):
+        """
+        True if it is time to show a new frame (so it is worth annotating)
+        """
+        return clock() >= self.next_show
+
+    def start(self, roi_frames):
+        #The ROI frames always have the same shapes, so the mosaic layout
+        #(and the canvases) only have to be made once
+        self.layout, mosaic_shape = mosaic_layout([roi_frame.shape for roi_frame in roi_frames])
+        mosaic_shape = mosaic_shape + roi_frames[0].shape[2:]
+        canvas_buffer = mp.RawArray('B', 3 * int(np.prod(mosaic_shape)))
+        self.canvases = np.frombuffer(canvas_buffer, dtype=np.uint8).reshape((3,) + mosaic_shape)
+        self.process = mp.Process(target=tracking_display_loop,
+                                  args=(canvas_buffer, mosaic_shape, self.ready, self.lock, self.new_frame,
+                                        self.stop, self.window_name, self.timer_q))
+        self.process.daemon = True
+        self.process.start()
+
+    def show(self, roi_frames):
+        """
+        Stitch the ROI frames into the mosaic and hand it to the display
+        process. roi_frames can be reused as soon as this returns.
+        """
+        self.next_show = clock() + self.interval
+        if self.layout is None:
+            self.start(roi_frames)
+        stitched = self.canvases[self.back]
+        #stich together individual arena roi tracked videos
+        for (y, x), roi_frame in zip(self.layout, roi_frames):
+            h,w = roi_frame.shape[:2]
+            stitched[y:y+h,x:x+w] = roi_frame
+        with self.lock:
+            self.back, self.ready.value = self.ready.value, self.back
+            self.new_frame.set()
+
+    def close(self):
+        """
+        Stop the display process (which closes the window)
+        """
+        if self.process is None:
+            return
+        self.stop.set()
+        self.new_frame.set()
+        if self.timer_q is not None:
+            #see live_plot_renderer.close()
+            try:
+                self.timer = self.timer_q.get(True, TIMER_TIMEOUT)
+            except queue.Empty:
+                pass
+        self.process.join(TIMER_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
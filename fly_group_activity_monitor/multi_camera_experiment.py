@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+"""
+Multi camera (multi rig) experiments driven from a single computer.
+
+Every camera gets its own control_expt() capture process with its own lens
+calibration, ROI set and shared frame ring (see shared_frame_buffer.py), so
+a slow or stalled camera never holds up the others. A single analysis loop
+picks up the frames of all cameras as they arrive and hands them to one
+roi_analysis_pool that is shared by all cameras (or analyzes them right here
+when there are no analysis workers). All results go through one common
+streaming_csv_writer.
+
+Every camera saves into its own sub directory of the save directory, with the
+same layout as a single camera experiment (so batch_analysis.py and the
+plotting scripts work on each camera's folder as usual):
+    <save_dir>/<camera name>/<timestring>/<timestring>-<roi_name>.csv
+The frame rate and lag (frames waiting in its frame ring) of every camera are
+printed every status_interval seconds and written to:
+    <save_dir>/<timestring>-camera_status.csv
+
+Multi camera experiments always run headless (no plots or windows). Only one
+Arduino can be driven, by the capture process of the first camera. Since all
+cameras share stim_on_time and stim_dur, the 'Stimulation' column is still
+correct for every camera.
+
+Cameras are described in a rig .json file (a list with one entry per camera,
+relative paths are relative to the rig file):
+    [{"name": "left", "source": 0, "rois": "left_ROIs.json", "calibration": "left_calibration.json"},
+     {"name": "right", "source": 1, "rois": "right_ROIs.json", "fps_cap": 30}]
+
+Example:
+    python multi_camera_experiment.py rigs.json --save-dir "D:/flyGrAM data" --expt-dur 1200 --workers 6
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import cv2
+
+import frame_sources
+import shared_frame_buffer
+import camera_calibration
+import camera_profile
+import roi_analysis
+import background_models
+import line_crossing
+from capture_scheduler import clock
+from results_writer import streaming_csv_writer
+from fly_activity_experiment_manager import control_expt, receive_sample_frames, MEDIAN_SAMPLE_FRAMES
+
+#If we are using python 2.7 or under
+if sys.version_info[0] < 3:
+    import Queue as queue
+#If we are using python 3.0 or above
+elif sys.version_info[0] >= 3:
+    import queue
+
+#seconds the stopped cameras get (all together) to finish writing their
+#videos before their processes are terminated
+CAMERA_STOP_TIMEOUT = 10
+
+class camera_rig(object):
+    """
+    One camera of a multi camera experiment.
+
+    name: name of the camera's save sub directory, also used in status output
+    frame_source: anything frame_sources.frame_source_from_spec() understands
+    roi_list, roi_dict: the camera's ROIs (see roi_analysis.load_roi_file())
+    calibration: camera_calibration object, calibration dict, calibration
+                 .json file path or None (no lens distortion correction)
+    fps_cap: capture rate. Live cameras default to the frame rate measured in
+             their camera profile (set by multi_camera_experiment.setup_camera()),
+             recorded sources to their own frame rate
+    """
+    def __init__(self, name, frame_source, roi_list, roi_dict, calibration=None, fps_cap=None):
+        self.name = name
+        self.frame_source = frame_sources.frame_source_from_spec(frame_source)
+        self.roi_list = list(roi_list)
+        self.roi_dict = roi_dict
+        if calibration is None:
+            self.calibration = None
+        elif isinstance(calibration, (dict, camera_calibration.camera_calibration)):
+            self.calibration = camera_calibration.camera_calibration.from_dict(calibration)
+        else:
+            self.calibration = camera_calibration.camera_calibration.from_file(calibration)
+        if fps_cap is None and not self.frame_source.is_live:
+            fps_cap = self.frame_source.fps
+        self.fps_cap = fps_cap
+
+def load_rig_file(filepath):
+    """
+    List of camera_rigs described by a rig .json file (see module docstring)
+    """
+    rig_dir = os.path.dirname(os.path.abspath(filepath))
+    def resolve(path):
+        return path if os.path.isabs(path) else os.path.join(rig_dir, path)
+
+    with open(filepath, 'r') as data_file:
+        rig_specs = json.load(data_file)
+    rigs = []
+    for indx, spec in enumerate(rig_specs):
+        source = spec.get("source", indx)
+        if not isinstance(source, int) and not str(source).isdigit() and source != 'synthetic':
+            source = resolve(source)
+        roi_list, roi_dict = roi_analysis.load_roi_file(resolve(spec["rois"]))
+        calibration = resolve(spec["calibration"]) if spec.get("calibration") else None
+        rigs.append(camera_rig(spec.get("name", "cam{}".format(indx)), source, roi_list, roi_dict,
+                               calibration, spec.get("fps_cap")))
+    names = [rig.name for rig in rigs]
+    if len(set(names)) != len(names):
+        raise ValueError('Every camera in the rig file needs its own name!')
+    return rigs
+
+class multi_camera_experiment(object):
+    """
+    Runs the same experiment on several cameras at once. rigs is a list of
+    camera_rigs, the other settings mean the same as for
+    fly_activity_experiment_manager.experiment and apply to every camera.
+    """
+    def __init__(self, rigs, expt_conn_obj=None, write_video=False, write_csv=True,
+                 use_arduino=False, expt_dur=60, led_freq=5, led_dur=5,
+                 stim_on_time=60, stim_dur=60, default_save_dir=None,
+                 frame_buffer_slots=64, analysis_workers=0,
+                 drop_policy='drop_newest', max_lag=None, every_nth=2,
+                 grayscale=False, csv_flush_interval=5.0,
+                 status_interval=5.0, status_format='text',
+                 counter='contours', min_blob_area=0, max_blob_area=None,
+                 bg_model='knn', analysis_scale=1.0,
+                 camera_profile_file=camera_profile.DEFAULT_PROFILE_FILE):
+        if not rigs:
+            raise ValueError('A multi camera experiment needs at least one camera!')
+        if expt_conn_obj:
+            self.expt_conn_obj = expt_conn_obj
+        self.rigs = list(rigs)
+        self.write_video = write_video
+        self.write_csv = write_csv
+        self.use_arduino = use_arduino
+        self.expt_dur = expt_dur
+        self.led_freq = led_freq
+        self.led_dur = led_dur
+        self.stim_on_time = stim_on_time
+        self.stim_dur = stim_dur
+        self.default_save_dir = default_save_dir or os.getcwd()
+        self.analysis_workers = analysis_workers
+        self.grayscale = grayscale
+        self.csv_flush_interval = csv_flush_interval
+        self.status_interval = status_interval
+        self.status_format = status_format
+        if counter not in roi_analysis.COUNTERS:
+            raise ValueError('Unknown counter "{}"! Choose one of: {}'.format(counter, roi_analysis.COUNTERS))
+        self.counter_kwargs = {"counter": counter, "min_area": min_blob_area, "max_area": max_blob_area}
+        if bg_model not in background_models.BG_MODELS:
+            raise ValueError('Unknown background model "{}"! Choose one of: {}'.format(bg_model, background_models.BG_MODELS))
+        self.bg_model = bg_model
+        if not 0 < analysis_scale <= 1:
+            raise ValueError('analysis_scale has to be larger than 0 and at most 1!')
+        self.analysis_scale = analysis_scale
+        #saved fps, frame size and warm-up of the live cameras (see camera_profile.py)
+        self.camera_profile_file = camera_profile_file
+        if max_lag is None:
+            max_lag = frame_buffer_slots // 2
+        #every camera lags (and skips frames) independently of the others
+        self.drop_policies = [shared_frame_buffer.frame_drop_policy(drop_policy, max_lag, every_nth)
+                              for rig in self.rigs]
+
+        self.frame_rings = []
+        self.median_backgrounds = []
+        self.parent_conns = []
+        self.child_conns = []
+        self.control_expt_processes = []
+        for cam_indx, rig in enumerate(self.rigs):
+            self.setup_camera(cam_indx, rig, frame_buffer_slots)
+        print("Finished starting {} camera processes!".format(len(self.rigs)))
+        sys.stdout.flush()
+
+    def setup_camera(self, cam_indx, rig, frame_buffer_slots):
+        """
+        Create a camera's frame ring, start its control_expt() process and get
+        the sample frames. Live cameras are only opened by their process, the
+        frame size comes from the camera's saved profile (see camera_profile.py)
+        """
+        num_sample_frames = MEDIAN_SAMPLE_FRAMES if self.bg_model == 'median' else 1
+        if rig.frame_source.is_live:
+            profile = camera_profile.get_camera_profile(rig.frame_source, self.camera_profile_file)
+            rig.frame_source.apply_profile(profile)
+            #like single camera experiments, capture at the measured frame rate
+            rig.fps_cap = rig.fps_cap or profile.fps
+            raw_frame_shape = profile.frame_shape(self.grayscale)
+            frame_dtype = np.uint8
+            sample_frames = None
+        else:
+            sample_cam = rig.frame_source.open(grayscale=self.grayscale)
+            sample_frames = []
+            for x in range(num_sample_frames):
+                ret, sample_frame = sample_cam.read()
+                if not ret:
+                    break
+                sample_frames.append(sample_frame)
+            sample_cam.release()
+            if not sample_frames:
+                raise IOError('Could not read any frames from camera "{}" ({})'.format(rig.name, rig.frame_source))
+            raw_frame_shape = sample_frames[-1].shape
+            frame_dtype = sample_frames[-1].dtype
+        frame_height, frame_width = raw_frame_shape[:2]
+        if self.analysis_scale != 1:
+            analysis_size = (max(1, int(round(frame_width * self.analysis_scale))),
+                             max(1, int(round(frame_height * self.analysis_scale))))
+            analysis_shape = (analysis_size[1], analysis_size[0]) + tuple(raw_frame_shape[2:])
+        else:
+            analysis_size = None
+            analysis_shape = raw_frame_shape
+        if rig.calibration is not None:
+            #build (or load) the undistortion tables for this frame size
+            #so the camera process doesn't have to
+            rig.calibration.get_remap_tables(frame_width, frame_height)
+
+        parent_conn, child_conn = mp.Pipe()
+        frame_ring = shared_frame_buffer.shared_frame_ring(analysis_shape,
+                                                           num_slots = frame_buffer_slots,
+                                                           dtype = frame_dtype,
+                                                           block_when_full = self.drop_policies[cam_indx].block_when_full)
+        #only the first camera's process drives the Arduino
+        use_arduino = self.use_arduino and cam_indx == 0
+        #control_expt() saves into <default_save_dir>/<timestring> so give
+        #every camera its own default_save_dir
+        proc_args = (child_conn, frame_ring, use_arduino,
+                     self.expt_dur, self.led_freq, self.led_dur,
+                     self.stim_on_time, self.stim_dur, rig.calibration,
+                     self.write_video, frame_height, frame_width, rig.fps_cap,
+                     os.path.join(self.default_save_dir, rig.name),
+                     rig.frame_source, self.grayscale, analysis_size, False,
+                     num_sample_frames if sample_frames is None else 0)
+        control_expt_process = mp.Process(target=control_expt, args=proc_args)
+        control_expt_process.start()
+        if sample_frames is None:
+            try:
+                sample_frames = receive_sample_frames(parent_conn, rig.frame_source, raw_frame_shape,
+                                                      self.camera_profile_file)
+            except IOError:
+                control_expt_process.terminate()
+                raise
+        if self.bg_model == 'median':
+            if rig.calibration is not None:
+                sample_frames = [rig.calibration.undistort(frame) for frame in sample_frames]
+            median_background = background_models.median_background(sample_frames)
+            if analysis_size:
+                median_background = cv2.resize(median_background, analysis_size, interpolation=cv2.INTER_AREA)
+        else:
+            median_background = None
+
+        self.frame_rings.append(frame_ring)
+        self.median_backgrounds.append(median_background)
+        self.parent_conns.append(parent_conn)
+        self.child_conns.append(child_conn)
+        self.control_expt_processes.append(control_expt_process)
+        print("Camera {}: {} at {} fps, {}x{} frames".format(rig.name, rig.frame_source, rig.fps_cap,
+                                                             frame_width, frame_height))
+        sys.stdout.flush()
+
+    def shutdown_expt_manager(self):
+        for parent_conn in self.parent_conns:
+            parent_conn.send('Shutdown!')
+
+    def stop_camera(self, cam_indx):
+        """
+        Close the frame ring of a camera whose process sent the 'stop' message.
+        Its process is only joined (see join_cameras()) once all cameras have
+        stopped, so the other cameras' frames keep being analyzed meanwhile.
+        """
+        self.frame_rings[cam_indx].close()
+        self.frame_rings[cam_indx].join_thread()
+
+    def join_cameras(self):
+        """
+        Clean up the processes of all (stopped) cameras
+        """
+        #give the processes a moment to finish writing their videos
+        deadline = clock() + CAMERA_STOP_TIMEOUT
+        for cam_indx, control_expt_process in enumerate(self.control_expt_processes):
+            control_expt_process.join(max(0, deadline - clock()))
+            self.child_conns[cam_indx].close()
+            self.parent_conns[cam_indx].close()
+            control_expt_process.terminate()
+
+    def print_status(self, camera_stats):
+        """
+        Periodic per camera status lines (fps, lag, dropped frames)
+        """
+        if self.status_format == 'json':
+            for stats in camera_stats:
+                print(json.dumps(stats, sort_keys=True))
+        else:
+            print(' | '.join('{camera}: t={time:.1f} sec fps={fps:.1f} lag={lag} dropped={dropped}'.format(**stats)
+                             for stats in camera_stats))
+        sys.stdout.flush()
+
+    def start_expt(self):
+        if self.use_arduino:
+            self.expt_timestring = time.strftime("%Y-%m-%d") + " " + time.strftime("%H.%M.%S") + " " + '- {} Hz {} Pulse width'.format(self.led_freq, self.led_dur)
+        else:
+            self.expt_timestring = time.strftime("%Y-%m-%d") + " " + time.strftime("%H.%M.%S")
+        self.save_dirs = []
+        for rig in self.rigs:
+            save_dir = os.path.abspath(os.path.join(self.default_save_dir, rig.name, self.expt_timestring))
+            if not os.path.isdir(save_dir):
+                os.makedirs(save_dir)
+            self.save_dirs.append(save_dir)
+
+        for parent_conn in self.parent_conns:
+            parent_conn.send('Time:{}'.format(self.expt_timestring))
+        time.sleep(0.25)
+        for parent_conn in self.parent_conns:
+            parent_conn.send('Start!')
+        time.sleep(0.25)
+
+        num_cameras = len(self.rigs)
+        analysis_counter_kwargs = roi_analysis.scale_counter_kwargs(self.counter_kwargs, self.analysis_scale)
+        #per camera: roi_name -> roi_plan (or line_crossing_detector)
+        roi_plans = []
+        line_lists = []
+        area_roi_lists = []
+        pool_roi_dict = {}
+        for cam_indx, rig in enumerate(self.rigs):
+            frame_shape = self.frame_rings[cam_indx].frame_shape
+            analysis_roi_dict = {roi_name:roi_analysis.scale_roi_coords(rig.roi_dict[roi_name], self.analysis_scale)
+                                 for roi_name in rig.roi_list}
+            line_list = [roi_name for roi_name in rig.roi_list if line_crossing.is_line_roi(roi_name)]
+            area_roi_list = [roi_name for roi_name in rig.roi_list if roi_name not in line_list]
+            plans = {roi_name:roi_analysis.roi_plan(analysis_roi_dict[roi_name], frame_shape, **analysis_counter_kwargs)
+                     for roi_name in area_roi_list}
+            plans.update({line_name:line_crossing.line_crossing_detector(analysis_roi_dict[line_name], frame_shape)
+                          for line_name in line_list})
+            roi_plans.append(plans)
+            line_lists.append(line_list)
+            area_roi_lists.append(area_roi_list)
+            pool_roi_dict.update({(cam_indx, roi_name):analysis_roi_dict[roi_name] for roi_name in area_roi_list})
+
+        #the ROIs of all cameras share one pool of analysis workers, line
+        #ROIs are cheap enough to always be analyzed right here
+        if self.analysis_workers and pool_roi_dict:
+            pool_roi_list = [(cam_indx, roi_name) for cam_indx in range(num_cameras) for roi_name in area_roi_lists[cam_indx]]
+            analysis_pool = roi_analysis.roi_analysis_pool(pool_roi_list, pool_roi_dict, self.frame_rings,
+                                                           self.analysis_workers, analysis_counter_kwargs,
+                                                           self.bg_model, self.median_backgrounds)
+            bg_sub_dicts = [{line_name:None for line_name in line_list} for line_list in line_lists]
+            print("Started {} ROI analysis worker processes for {} cameras!".format(analysis_pool.num_workers, num_cameras))
+        else:
+            analysis_pool = None
+            bg_sub_dicts = []
+            for cam_indx, plans in enumerate(roi_plans):
+                background = self.median_backgrounds[cam_indx]
+                bg_sub_dict = {roi_name:roi_analysis.create_bg_subtractor(self.bg_model, None if background is None else plans[roi_name].crop(background))
+                               for roi_name in area_roi_lists[cam_indx]}
+                bg_sub_dict.update({line_name:None for line_name in line_lists[cam_indx]})
+                bg_sub_dicts.append(bg_sub_dict)
+
+        #one writer for all cameras, tables are named '<camera>/<table>'
+        write_csv = self.write_csv
+        if write_csv:
+            csv_writer = streaming_csv_writer(self.csv_flush_interval)
+            for cam_indx, rig in enumerate(self.rigs):
+                save_dir = self.save_dirs[cam_indx]
+                for roi_name in rig.roi_list:
+                    count_header = "Number of crossings" if roi_name in line_lists[cam_indx] else "Number of active flies"
+                    csv_writer.add_table('{}/{}'.format(rig.name, roi_name), "{}/{}-{}.csv".format(save_dir, self.expt_timestring, roi_name),
+                                         ["Time Elapsed (sec)", count_header, "Stimulation"])
+                for line_name in line_lists[cam_indx]:
+                    csv_writer.add_table('{}/{}_crossings'.format(rig.name, line_name),
+                                         "{}/{}-{}_crossings.csv".format(save_dir, self.expt_timestring, line_name),
+                                         ["Time Elapsed (sec)", "Position (px)", "Direction", "Stimulation"])
+                csv_writer.add_table('{}/dropped_frames'.format(rig.name), "{}/{}-dropped_frames.csv".format(save_dir, self.expt_timestring),
+                                     ["Time Elapsed (sec)", "Reason"])
+            csv_writer.add_table('camera_status', os.path.join(os.path.abspath(self.default_save_dir),
+                                                               "{}-camera_status.csv".format(self.expt_timestring)),
+                                 ["Camera", "Time Elapsed (sec)", "FPS", "Lag (frames)", "Dropped frames"])
+            csv_write_rows = csv_writer.write_rows
+        table_names = [dict((roi_name, '{}/{}'.format(rig.name, roi_name)) for roi_name in rig.roi_list) for rig in self.rigs]
+
+        #per camera bookkeeping for the status reports
+        camera_names = [rig.name for rig in self.rigs]
+        frames_analyzed = [0] * num_cameras
+        frames_since_status = [0] * num_cameras
+        last_time_stamps = [0.0] * num_cameras
+        lags = [0] * num_cameras
+        self.max_lags = [0] * num_cameras
+        self.num_dropped_frames = [0] * num_cameras
+        status_interval = self.status_interval
+        start_time = last_status_time = clock()
+
+        def drop_frame(cam_indx, time_stamp, reason):
+            self.num_dropped_frames[cam_indx] += 1
+            if write_csv:
+                csv_write_rows([('{}/dropped_frames'.format(camera_names[cam_indx]), [time_stamp, reason])])
+
+        def report_status(now):
+            elapsed = max(now - last_status_time, 1e-9)
+            camera_stats = [{"camera": camera_names[cam_indx], "time": round(last_time_stamps[cam_indx], 3),
+                             "fps": round(frames_since_status[cam_indx]/elapsed, 2), "lag": lags[cam_indx],
+                             "dropped": self.num_dropped_frames[cam_indx]} for cam_indx in range(num_cameras)]
+            self.print_status(camera_stats)
+            if write_csv:
+                csv_write_rows([('camera_status', [stats["camera"], stats["time"], stats["fps"], stats["lag"], stats["dropped"]])
+                                for stats in camera_stats])
+
+        frame_rings = self.frame_rings
+        ring_frames = [frame_ring.frames for frame_ring in frame_rings]
+        skip_frames = [drop_policy.skip_frame for drop_policy in self.drop_policies]
+        pool_rois = [analysis_pool.ring_rois[cam_indx] for cam_indx in range(num_cameras)] if analysis_pool else None
+        roi_lists = [rig.roi_list for rig in self.rigs]
+        active_cameras = list(range(num_cameras))
+        shutdown_sent = False
+        msg = None
+
+        while active_cameras:
+            if hasattr(self, 'expt_conn_obj'):
+                if self.expt_conn_obj.poll():
+                    msg = self.expt_conn_obj.recv()
+                if msg == 'Shutdown!' and not shutdown_sent:
+                    for cam_indx in active_cameras:
+                        self.parent_conns[cam_indx].send('Shutdown!')
+                    shutdown_sent = True
+
+            #take (at most) one waiting frame from every camera so one busy
+            #camera can't starve the others
+            batch = []
+            for cam_indx in list(active_cameras):
+                try:
+                    time_stamp, slot, stim_bool = frame_rings[cam_indx].get_slot(False)
+                except queue.Empty:
+                    continue
+                if type(slot) == str:
+                    if slot == shared_frame_buffer.OVERRUN_MSG:
+                        drop_frame(cam_indx, time_stamp, 'overrun')
+                    elif slot == 'stop':
+                        self.stop_camera(cam_indx)
+                        active_cameras.remove(cam_indx)
+                    continue
+                lag = frame_rings[cam_indx].slots_in_use() - 1
+                if skip_frames[cam_indx](lag):
+                    drop_frame(cam_indx, time_stamp, 'skipped')
+                    frame_rings[cam_indx].release()
+                    continue
+                batch.append((cam_indx, time_stamp, slot, stim_bool, lag))
+            if not batch:
+                time.sleep(0.001)
+                continue
+
+            #all cameras' frames are analyzed by the workers at the same time
+            if analysis_pool:
+                for cam_indx, time_stamp, slot, stim_bool, lag in batch:
+                    if pool_rois[cam_indx]:
+                        analysis_pool.submit(slot, False, time_stamp, cam_indx)
+            for cam_indx, time_stamp, slot, stim_bool, lag in batch:
+                frame = ring_frames[cam_indx][slot]
+                plans = roi_plans[cam_indx]
+                bg_sub_dict = bg_sub_dicts[cam_indx]
+                if analysis_pool:
+                    pool_counts = {}
+                    if pool_rois[cam_indx]:
+                        pool_counts = dict(zip((roi_name for ring_indx, roi_name in pool_rois[cam_indx]), analysis_pool.collect()))
+                    roi_counts = [pool_counts[roi_name] if roi_name in pool_counts
+                                  else plans[roi_name].process(None, frame, False)[0] for roi_name in roi_lists[cam_indx]]
+                else:
+                    roi_counts = [plans[roi_name].process(bg_sub_dict[roi_name], frame, False)[0] for roi_name in roi_lists[cam_indx]]
+                frame_rings[cam_indx].release()
+
+                if write_csv:
+                    names = table_names[cam_indx]
+                    rows = [(names[roi_name], [time_stamp, count, stim_bool]) for roi_name, count in zip(roi_lists[cam_indx], roi_counts)]
+                    for line_name in line_lists[cam_indx]:
+                        rows.extend((names[line_name] + '_crossings', [time_stamp, position, direction, stim_bool])
+                                    for position, direction in plans[line_name].pop_events())
+                    csv_write_rows(rows)
+                frames_analyzed[cam_indx] += 1
+                frames_since_status[cam_indx] += 1
+                last_time_stamps[cam_indx] = time_stamp
+                lags[cam_indx] = lag
+                if lag > self.max_lags[cam_indx]:
+                    self.max_lags[cam_indx] = lag
+
+            if status_interval:
+                now = clock()
+                if now - last_status_time >= status_interval:
+                    report_status(now)
+                    frames_since_status = [0] * num_cameras
+                    last_status_time = now
+
+        run_time = max(clock() - start_time, 1e-9)
+        if analysis_pool:
+            analysis_pool.close()
+        self.join_cameras()
+        for cam_indx, name in enumerate(camera_names):
+            print("Camera {}: {} frames analyzed ({:.1f} fps), {} dropped, max lag of {} frames".format(
+                  name, frames_analyzed[cam_indx], frames_analyzed[cam_indx]/run_time,
+                  self.num_dropped_frames[cam_indx], self.max_lags[cam_indx]))
+        if write_csv:
+            csv_writer.close()
+            print("CSVs written to data folders!")
+        else:
+            print("Experiment is complete! Ready for the next one!")
+        sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('rig_file', help='.json file describing the cameras (see above)')
+    parser.add_argument('--save-dir', default=None, help='where to save data (default: current directory)')
+    parser.add_argument('--expt-dur', type=float, default=60)
+    parser.add_argument('--stim-on-time', type=float, default=60)
+    parser.add_argument('--stim-dur', type=float, default=60)
+    parser.add_argument('--use-arduino', action='store_true', help='drive an Arduino from the first camera\'s process')
+    parser.add_argument('--led-freq', type=float, default=5)
+    parser.add_argument('--led-dur', type=float, default=5)
+    parser.add_argument('--write-video', action='store_true')
+    parser.add_argument('--no-csv', action='store_true')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), help='0 analyzes in this process')
+    parser.add_argument('--buffer-slots', type=int, default=64)
+    parser.add_argument('--drop-policy', choices=shared_frame_buffer.DROP_POLICIES, default='drop_newest')
+    parser.add_argument('--grayscale', action='store_true')
+    parser.add_argument('--counter', choices=roi_analysis.COUNTERS, default='contours')
+    parser.add_argument('--min-area', type=float, default=0)
+    parser.add_argument('--max-area', type=float, default=None)
+    parser.add_argument('--bg-model', choices=background_models.BG_MODELS, default='knn')
+    parser.add_argument('--analysis-scale', type=float, default=1.0)
+    parser.add_argument('--status-interval', type=float, default=5.0)
+    parser.add_argument('--status-format', choices=('text', 'json'), default='text')
+    args = parser.parse_args()
+
+    rigs = load_rig_file(args.rig_file)
+    expt = multi_camera_experiment(rigs, write_video=args.write_video, write_csv=not args.no_csv,
+                                   use_arduino=args.use_arduino, expt_dur=args.expt_dur,
+                                   led_freq=args.led_freq, led_dur=args.led_dur,
+                                   stim_on_time=args.stim_on_time, stim_dur=args.stim_dur,
+                                   default_save_dir=args.save_dir, frame_buffer_slots=args.buffer_slots,
+                                   analysis_workers=args.workers, drop_policy=args.drop_policy,
+                                   grayscale=args.grayscale, status_interval=args.status_interval,
+                                   status_format=args.status_format, counter=args.counter,
+                                   min_blob_area=args.min_area, max_blob_area=args.max_area,
+                                   bg_model=args.bg_model, analysis_scale=args.analysis_scale)
+    expt.start_expt()
+
+if __name__ == '__main__':
+    main()
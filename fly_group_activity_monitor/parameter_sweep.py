@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Decode-once parameter sweep of the motion detection pipeline.
+
+Tuning the median blur size, dilation kernel size and background model
+history/threshold used to mean re-running whole videos once per setting, which
+is dominated by decoding the video. Instead, every video is decoded once and
+each frame is fanned out to all parameter configurations.
+
+Frames are decoded into a shared_frame_ring (see shared_frame_buffer.py) and
+only the slot index is sent to the worker processes. Every worker owns a fixed
+subset of the configurations (each with its own roi_plans and background
+models for the whole video) and reads the frames straight out of shared
+memory. Up to --buffer-slots frames can be in flight at once so decoding
+overlaps with the analysis.
+
+Results are written as two tidy .csv tables:
+    <output>-configs.csv: Config, Median blur size, Dilation kernel size, History, Threshold
+    <output>-counts.csv: Video, Config, Frame, Time Elapsed (sec), ROI, Number of active flies
+
+Line ROIs ('line1', 'line2'...) in the --rois file are left out of the sweep,
+they are beam crossing detectors (see line_crossing.py) that none of the swept
+parameters apply to.
+
+Example:
+    python parameter_sweep.py "video--2016-03-01 12.00.00.avi" --rois FlyActivityAssay_ROIs.json
+        --blur-sizes 3 5 7 9 --dilate-sizes 3 5 --histories 5 50 --thresholds 200 300 400 --workers 6
+"""
+import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+from collections import deque
+
+import numpy as np
+
+import frame_sources
+import roi_analysis
+import background_models
+import shared_frame_buffer
+import batch_analysis
+import line_crossing
+from results_writer import streaming_csv_writer
+
+CONFIG_KEYS = ('blur_size', 'dilate_size', 'history', 'threshold')
+
+def make_config_grid(blur_sizes=(7,), dilate_sizes=(3,), histories=(5,), thresholds=(300,)):
+    """
+    Every combination of the given parameter values as a list of config dicts
+    """
+    return [dict(zip(CONFIG_KEYS, values)) for values in itertools.product(blur_sizes, dilate_sizes, histories, thresholds)]
+
+def build_sweep_plans(configs, roi_coords, frame_shape, bg_model='knn', counter_kwargs=None):
+    """
+    (roi_plan, background model) for every config and ROI, in config major order
+    """
+    work = []
+    for config in configs:
+        for coords in roi_coords:
+            plan = roi_analysis.roi_plan(coords, frame_shape, blur_size=config['blur_size'],
+                                         dilate_size=config['dilate_size'], **(counter_kwargs or {}))
+            bg_subtractor = roi_analysis.create_bg_subtractor(bg_model, None, config['history'], config['threshold'])
+            work.append((plan, bg_subtractor))
+    return work
+
+def sweep_worker(conn, configs, roi_coords, frame_ring, bg_model, counter_kwargs):
+    """
+    Worker process loop. Receives the frame ring slot of every frame (in
+    order) and sends back the counts of all its configs and ROIs.
+    A slot of None ends the worker.
+    """
+    frames = frame_ring.frames
+    work = build_sweep_plans(configs, roi_coords, frame_ring.frame_shape, bg_model, counter_kwargs)
+    while True:
+        slot = conn.recv()
+        if slot is None:
+            break
+        frame = frames[slot]
+        conn.send([plan.process(bg_subtractor, frame, False)[0] for plan, bg_subtractor in work])
+    conn.close()
+
+def read_frames(reader):
+    while True:
+        ret, frame = reader.read()
+        if not ret:
+            break
+        yield reader.frame_time, frame
+
+def sweep_video(video_path, configs, roi_list, roi_dict, write_counts, num_workers=0, num_slots=64,
+                grayscale=False, bg_model='knn', counter_kwargs=None):
+    """
+    Decode a video once and analyze every frame with every config.
+    write_counts(frame_indx, time_stamp, counts) is called for each frame in
+    order, where counts[config_indx][roi_indx] is the number of active flies.
+    Returns the number of frames analyzed.
+    """
+    reader = frame_sources.video_file_source(video_path).open(grayscale=grayscale)
+    frames = read_frames(reader)
+    try:
+        time_stamp, frame = next(frames)
+    except StopIteration:
+        reader.release()
+        raise IOError('Could not read any frames from: {}'.format(video_path))
+    frames = itertools.chain([(time_stamp, frame)], frames)
+    roi_coords = [roi_dict[roi_name] for roi_name in roi_list]
+    num_rois = len(roi_coords)
+    num_frames = 0
+
+    if not num_workers:
+        work = build_sweep_plans(configs, roi_coords, frame.shape, bg_model, counter_kwargs)
+        for frame_indx, (time_stamp, frame) in enumerate(frames):
+            counts = [plan.process(bg_subtractor, frame, False)[0] for plan, bg_subtractor in work]
+            write_counts(frame_indx, time_stamp, [counts[indx:indx + num_rois] for indx in range(0, len(counts), num_rois)])
+            num_frames += 1
+        reader.release()
+        return num_frames
+
+    #deal configs out to the workers round robin style
+    num_workers = max(1, min(num_workers, len(configs)))
+    worker_configs = [list(range(len(configs)))[indx::num_workers] for indx in range(num_workers)]
+    frame_ring = shared_frame_buffer.shared_frame_ring(frame.shape, num_slots, frame.dtype)
+    conns = []
+    workers = []
+    for config_indxs in worker_configs:
+        parent_conn, child_conn = mp.Pipe()
+        worker = mp.Process(target=sweep_worker,
+                            args=(child_conn, [configs[indx] for indx in config_indxs], roi_coords,
+                                  frame_ring, bg_model, counter_kwargs))
+        worker.daemon = True
+        worker.start()
+        conns.append(parent_conn)
+        workers.append(worker)
+
+    #(frame index, timestamp) of frames handed to the workers but not yet finished
+    in_flight = deque()
+    def finish_oldest():
+        frame_indx, time_stamp = in_flight.popleft()
+        counts = [None] * len(configs)
+        for config_indxs, conn in zip(worker_configs, conns):
+            worker_counts = conn.recv()
+            for config_num, config_indx in enumerate(config_indxs):
+                counts[config_indx] = worker_counts[config_num*num_rois:(config_num + 1)*num_rois]
+        frame_ring.release()
+        write_counts(frame_indx, time_stamp, counts)
+
+    try:
+        for frame_indx, (time_stamp, frame) in enumerate(frames):
+            if len(in_flight) >= num_slots:
+                finish_oldest()
+            slot, slot_view = frame_ring.next_slot()
+            np.copyto(slot_view, frame)
+            #workers get the slot index through their pipes
+            frame_ring.commit_slot(slot, time_stamp, False, notify=False)
+            for conn in conns:
+                conn.send(slot)
+            in_flight.append((frame_indx, time_stamp))
+            num_frames += 1
+        while in_flight:
+            finish_oldest()
+    finally:
+        for conn in conns:
+            conn.send(None)
+        for worker in workers:
+            worker.join()
+        for conn in conns:
+            conn.close()
+        frame_ring.close()
+        reader.release()
+    return num_frames
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('videos', nargs='+', help='recorded videos (or directories of video--*.avi files)')
+    parser.add_argument('--rois', default=None, help='ROI .json file saved by the GUI (default: the whole frame)')
+    parser.add_argument('--output', default='parameter_sweep', help='output .csv files prefix')
+    parser.add_argument('--blur-sizes', type=int, nargs='+', default=[7])
+    parser.add_argument('--dilate-sizes', type=int, nargs='+', default=[3])
+    parser.add_argument('--histories', type=int, nargs='+', default=[5])
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[300])
+    parser.add_argument('--bg-model', choices=[bg_model for bg_model in background_models.BG_MODELS
+                                               if bg_model != 'median'], default='knn')
+    parser.add_argument('--counter', choices=roi_analysis.COUNTERS, default='contours')
+    parser.add_argument('--min-area', type=float, default=0)
+    parser.add_argument('--max-area', type=float, default=None)
+    parser.add_argument('--grayscale', action='store_true')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), help='0 analyzes in this process')
+    parser.add_argument('--buffer-slots', type=int, default=64)
+    args = parser.parse_args()
+
+    if any(blur_size % 2 == 0 for blur_size in args.blur_sizes):
+        sys.exit('Median blur sizes have to be odd!')
+    configs = make_config_grid(args.blur_sizes, args.dilate_sizes, args.histories, args.thresholds)
+    counter_kwargs = {"counter": args.counter, "min_area": args.min_area, "max_area": args.max_area}
+
+    video_paths = []
+    for path in args.videos:
+        video_paths.extend(batch_analysis.find_videos(path) if os.path.isdir(path) else [path])
+    if not video_paths:
+        sys.exit('No videos found!')
+
+    csv_writer = streaming_csv_writer()
+    csv_writer.add_table('configs', args.output + '-configs.csv',
+                         ["Config", "Median blur size", "Dilation kernel size", "History", "Threshold"])
+    csv_writer.write_rows([('configs', [config_indx] + [config[key] for key in CONFIG_KEYS])
+                           for config_indx, config in enumerate(configs)])
+    csv_writer.add_table('counts', args.output + '-counts.csv',
+                         ["Video", "Config", "Frame", "Time Elapsed (sec)", "ROI", "Number of active flies"])
+    print("Sweeping {} configurations over {} videos".format(len(configs), len(video_paths)))
+    sys.stdout.flush()
+
+    if args.rois:
+        roi_list, roi_dict = roi_analysis.load_roi_file(args.rois)
+        #line ROIs are crossing detectors, not motion detection ROIs
+        roi_list = [roi_name for roi_name in roi_list if not line_crossing.is_line_roi(roi_name)]
+        if not roi_list:
+            sys.exit('No (non line) ROIs found in: {}'.format(args.rois))
+    else:
+        #a single ROI covering the whole frame
+        roi_list, roi_dict = ['frame'], {'frame': (np.array([0, 0]), np.array([sys.maxsize, sys.maxsize]))}
+
+    for video_path in video_paths:
+        video_name = os.path.basename(video_path)
+
+        def write_counts(frame_indx, time_stamp, counts):
+            csv_writer.write_rows([('counts', [video_name, config_indx, frame_indx, time_stamp, roi_name, count])
+                                   for config_indx, config_counts in enumerate(counts)
+                                   for roi_name, count in zip(roi_list, config_counts)])
+
+        start = time.time()
+        num_frames = sweep_video(video_path, configs, roi_list, roi_dict, write_counts, args.workers,
+                                 args.buffer_slots, args.grayscale, args.bg_model, counter_kwargs)
+        print("{}: {} frames x {} configs in {:.1f} sec".format(video_path, num_frames, len(configs), time.time() - start))
+        sys.stdout.flush()
+    csv_writer.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming, crash safe .csv writer for experiment results.
+
+Instead of keeping every row in memory and writing the .csv files after the
+experiment loop exits, rows are handed to a background thread that appends
+them in batches. Every flush_interval seconds the files are flushed and
+fsync'ed so at most a few seconds of data can be lost in a crash.
+
+If writing fails in the background thread (i.e. the disk is full), the error
+is re-raised by the next write_rows() or close() call, and the .partial files
+are left as they are, so a truncated file is never renamed as if it were complete.
+
+While the experiment runs, rows go to '<name>.csv.partial' files. Only when the
+writer is closed are they renamed to their final '<name>.csv' names, so a
+finished .csv file is always complete and analysis scripts (which look for
+'*-roi[0-9]*.csv') never pick up a half written one.
+"""
+import os
+import sys
+import csv
+import time
+import threading
+
+#If we are using python 2.7 or under
+if sys.version_info[0] < 3:
+    import Queue as queue
+#If we are using python 3.0 or above
+elif sys.version_info[0] >= 3:
+    import queue
+
+PARTIAL_EXT = '.partial'
+
+def open_csv_file(filepath):
+    """
+    Open a file for writing with the csv module on python 2 and 3
+    """
+    if sys.version_info[0] < 3:
+        return open(filepath, 'wb')
+    return open(filepath, 'w', newline='')
+
+def replace_file(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        #python 2.7 on windows can't rename onto an existing file
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+class streaming_csv_writer(object):
+    """
+    flush_interval: max number of seconds between flushing (and fsync'ing) files
+    """
+    def __init__(self, flush_interval=5.0):
+        self.flush_interval = flush_interval
+        #table name -> [final filepath, open file, csv writer]
+        self.tables = {}
+        #add_table() may be called while the writer thread flushes the tables
+        self.tables_lock = threading.Lock()
+        self.row_q = queue.Queue()
+        self.rows_written = 0
+        #exception that stopped the writer thread (re-raised by write_rows() and close())
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_table(self, name, filepath, header):
+        """
+        Create a new .csv file (written as filepath + '.partial' until close())
+        """
+        outfile = open_csv_file(filepath + PARTIAL_EXT)
+        writer = csv.writer(outfile)
+        writer.writerow(header)
+        with self.tables_lock:
+            self.tables[name] = [filepath, outfile, writer]
+
+    def check_error(self):
+        """
+        Re-raise the exception that stopped the writer thread (if any)
+        """
+        if self.error is not None:
+            raise self.error
+
+    def write_row(self, name, row):
+        self.write_rows([(name, row)])
+
+    def write_rows(self, named_rows):
+        """
+        named_rows: list of (table name, row) tuples. Queued as a single batch.
+        """
+        self.check_error()
+        self.row_q.put(named_rows)
+
+    def _flush(self):
+        with self.tables_lock:
+            tables = list(self.tables.values())
+        for filepath, outfile, writer in tables:
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+    def _write_loop(self):
+        try:
+            self._write_batches()
+        except Exception as error:
+            self.error = error
+
+    def _write_batches(self):
+        next_flush = time.time() + self.flush_interval
+        finished = False
+        while not finished:
+            timeout = max(0, next_flush - time.time())
+            batches = []
+            try:
+                batches.append(self.row_q.get(True, timeout))
+                #grab everything else that has piled up in the mean time
+                while True:
+                    batches.append(self.row_q.get_nowait())
+            except queue.Empty:
+                pass
+            for named_rows in batches:
+                if named_rows is None:
+                    finished = True
+                    continue
+                with self.tables_lock:
+                    tables = self.tables
+                    for name, row in named_rows:
+                        tables[name][2].writerow(row)
+                self.rows_written += len(named_rows)
+            if finished or time.time() >= next_flush:
+                self._flush()
+                next_flush = time.time() + self.flush_interval
+
+    def close(self):
+        """
+        Write out all remaining rows, then atomically rename the finished files
+        """
+        self.row_q.put(None)
+        self.thread.join()
+        with self.tables_lock:
+            tables, self.tables = list(self.tables.values()), {}
+        for filepath, outfile, writer in tables:
+            outfile.close()
+        self.check_error()
+        for filepath, outfile, writer in tables:
+            replace_file(filepath + PARTIAL_EXT, filepath)
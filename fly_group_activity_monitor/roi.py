@@ -6,11 +6,12 @@ Created on Fri May 15 10:52:03 2015
 
 Package so that the ROI and LINE classes are a separate import.
 
-Allows user to draw rectangular ROIs as well as 'beam crossing' lines.
+Allows user to draw rectangular, polygon and circular ROIs as well as 
+'beam crossing' lines.
 """
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
+from matplotlib.patches import Rectangle, Polygon, Circle
 
 class set_roi(object):
     """
@@ -21,7 +22,8 @@ class set_roi(object):
     def __init__(self, roi_color, background_img, roi_selection_msg = "Press the 'n' key on your keyboard when you are happy with the ROI"):        
         self.fig, self.ax = plt.subplots()
         self.fig.set_size_inches((11, 8.5), forward=True)
-        self.ax.imshow(background_img)
+        #cmap only affects single channel (grayscale) images
+        self.ax.imshow(background_img, cmap='gray')
         self.fig.suptitle(roi_selection_msg, size=16)
 
         self.type = 'roi'        
@@ -113,7 +115,8 @@ class set_line(object):
     def __init__(self, line_color, background_img, line_width=3, line_mode = 'vertical', roi_selection_msg = "Press the 'n' key on your keyboard when you are happy with the ROI"):        
         self.fig, self.ax = plt.subplots()
         self.fig.set_size_inches((11, 8.5), forward=True)
-        self.ax.imshow(background_img)
+        #cmap only affects single channel (grayscale) images
+        self.ax.imshow(background_img, cmap='gray')
         self.fig.suptitle(roi_selection_msg, size=16)
 
         self.type = 'line'        
@@ -173,3 +176,129 @@ class set_line(object):
             if self.roi_finalized is True:
                 print("ROI is finalized")
                 break
+
+class set_polygon(object):
+    """
+    Class to set a polygon roi in an image.
+    Every mouse click adds a vertex, the backspace key removes the last one.
+    Saves the roi as a tuple of array([x,y]) vertices
+    """
+    def __init__(self, roi_color, background_img, roi_selection_msg = "Click to add vertices, press the 'n' key on your keyboard when you are happy with the ROI"):        
+        self.fig, self.ax = plt.subplots()
+        self.fig.set_size_inches((11, 8.5), forward=True)
+        #cmap only affects single channel (grayscale) images
+        self.ax.imshow(background_img, cmap='gray')
+        self.fig.suptitle(roi_selection_msg, size=16)
+
+        self.type = 'roi'        
+        self.color = roi_color
+        self.vertices = []
+        self.roi = None
+        self.roi_finalized = False
+        self.polygon = Polygon(np.zeros((0, 2)), closed=True, color=self.color, alpha=0.4)
+        
+        self.ax.add_patch(self.polygon)
+        self.ax.figure.canvas.mpl_connect('button_press_event', self.on_mouse_press)
+        self.ax.figure.canvas.mpl_connect('key_press_event', self.on_key_press) 
+        
+    def redraw(self):
+        self.polygon.set_xy(np.array(self.vertices).reshape(-1, 2))
+        self.ax.figure.canvas.draw()
+
+    def on_mouse_press(self, event):
+        if self.roi_finalized is False:
+            if event.xdata is None or event.ydata is None:
+                print("The mouse cursor went out of the canvas area! Please retry adding the vertex!")
+                return
+            self.vertices.append([event.xdata, event.ydata])
+            self.redraw()
+            
+    def on_key_press(self, event):
+        if event.key == 'backspace' and self.vertices:
+            self.vertices.pop()
+            self.redraw()
+        if event.key=='n':
+            if len(self.vertices) < 3:
+                print("A polygon ROI needs at least 3 vertices!")
+                return
+            self.roi = tuple([np.array(vertex).astype('int') for vertex in self.vertices])
+            self.roi_finalized = True
+            plt.close(self.fig)
+            
+    def wait_for_roi(self):
+        """
+        Function that allows scripts that invoke roi classes to wait for user to set ROI
+        """
+        while True:
+            plt.pause(0.0001)
+            if self.roi_finalized is True:
+                print("ROI is finalized")
+                break
+
+class set_circle(object):
+    """
+    Class to set a circular roi in an image.
+    Saves the center of the ROI on mouse button press and sets the radius by 
+    dragging. Saves the roi as a tuple of a single array([x,y,radius])
+    """
+    def __init__(self, roi_color, background_img, roi_selection_msg = "Press the 'n' key on your keyboard when you are happy with the ROI"):        
+        self.fig, self.ax = plt.subplots()
+        self.fig.set_size_inches((11, 8.5), forward=True)
+        #cmap only affects single channel (grayscale) images
+        self.ax.imshow(background_img, cmap='gray')
+        self.fig.suptitle(roi_selection_msg, size=16)
+
+        self.type = 'roi'        
+        self.color = roi_color
+        self.center = None
+        self.radius = 0
+        self.released = True
+        self.roi = None
+        self.roi_finalized = False
+        self.circle = Circle((0,0), 0, color=self.color, alpha=0.4)
+        
+        self.ax.add_patch(self.circle)
+        self.ax.figure.canvas.mpl_connect('button_press_event', self.on_mouse_press)
+        self.ax.figure.canvas.mpl_connect('button_release_event', self.on_mouse_release)
+        self.ax.figure.canvas.mpl_connect('motion_notify_event', self.on_mouse_motion)
+        self.ax.figure.canvas.mpl_connect('key_press_event', self.on_key_press) 
+
+    def on_mouse_press(self, event):
+        self.released = False
+        if self.roi_finalized is False and event.xdata is not None:
+            self.center = np.array([event.xdata, event.ydata])
+            self.radius = 0
+
+    def on_mouse_release(self, event):
+        self.released = True
+        self.on_mouse_drag(event)
+                  
+    def on_mouse_motion(self, event):
+        if self.released is False:
+            self.on_mouse_drag(event)
+            
+    def on_mouse_drag(self, event):
+        if self.roi_finalized is False and self.center is not None:
+            if event.xdata is None or event.ydata is None:
+                print("The mouse cursor went out of the canvas area! Please retry drawing the ROI!")
+                return
+            self.radius = np.hypot(*(np.array([event.xdata, event.ydata]) - self.center))
+            self.circle.center = tuple(self.center)
+            self.circle.set_radius(self.radius)
+            self.ax.figure.canvas.draw()
+    
+    def on_key_press(self, event):
+        if event.key=='n' and self.center is not None:
+            self.roi = (np.array([self.center[0], self.center[1], self.radius]).astype('int'),)
+            self.roi_finalized = True
+            plt.close(self.fig)
+            
+    def wait_for_roi(self):
+        """
+        Function that allows scripts that invoke roi classes to wait for user to set ROI
+        """
+        while True:
+            plt.pause(0.0001)
+            if self.roi_finalized is True:
+                print("ROI is finalized")
+                break
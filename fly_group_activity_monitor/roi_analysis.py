@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""
+Per-ROI motion analysis used by the experiment manager.
+
+get_activity_counts() does the actual counting of moving flies in one ROI.
+It lives in its own module (without any matplotlib/serial imports) so that
+the roi_analysis_pool worker processes can import it cheaply.
+
+Moving flies can be counted with one of two COUNTERS:
+    'contours': cv2.findContours() on the motion mask (the original method)
+    'components': cv2.connectedComponentsWithStats(), cheaper and gives blob
+                  areas for free
+Both can filter blobs by min/max area (in pixels). Annotation of the ROI
+frames is only done when asked for (i.e. for frames that will be displayed).
+
+ROIs can be rectangles, polygons or circles (see roi_shape()). Polygon and
+circle ROIs are cropped to their tight bounding box and a precomputed binary
+mask removes motion outside of the ROI, so any number of arenas of any shape
+(i.e. the wells of a multi-well plate, see plate_rois()) can be analyzed.
+
+For the experiment loop, each ROI gets a roi_plan that is built once. It
+holds the morphology kernel, the crop slices and preallocated output buffers
+for every OpenCV call so the steady state loop does no per frame allocation
+of images (only the small list of contours/blob stats is new every frame).
+
+Optionally, blob centroids can be linked from frame to frame (see
+centroid_tracker.py) to estimate the distance travelled by the flies. The
+'components' counter gets blob centroids for free.
+
+roi_analysis_pool spreads the ROIs of an experiment over several worker
+processes. Each worker owns the background subtractors of its ROIs for the
+whole run and reads frames directly out of the shared frame ring
+(see shared_frame_buffer.py) so frames are never pickled or copied.
+"""
+import re
+import json
+import itertools
+import multiprocessing as mp
+from collections import deque
+
+import numpy as np
+import cv2
+
+import background_models
+from centroid_tracker import centroid_tracker
+from capture_scheduler import clock
+from stage_timing import stage_timer
+
+COUNTERS = ('contours', 'components')
+ROI_SHAPES = ('rectangle', 'polygon', 'circle')
+
+def create_bg_subtractor(bg_model='knn', background=None, history=None, threshold=None):
+    """
+    By default implement a K-Nearest Neighbors background subtraction
+    Most efficient when number of foreground pixels is low (and image area is small)
+    So we will create one background subtractor for each ROI
+    See background_models.py for the other available models
+    """
+    return background_models.create_background_model(bg_model, background, history, threshold)
+
+def roi_sort_key(roi_name):
+    """
+    Sort key so that i.e. 'roi2' comes before 'roi10'
+    """
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', roi_name)]
+
+def roi_shape(roi_coords):
+    """
+    ROIs are sequences of points:
+        'rectangle': (start_pos, end_pos), the upper left and lower right corners as array([x,y])
+        'polygon': 3 or more array([x,y]) vertices
+        'circle': a single array([x,y,radius])
+    """
+    if len(roi_coords) == 1 and len(roi_coords[0]) == 3:
+        return 'circle'
+    elif len(roi_coords) == 2:
+        return 'rectangle'
+    elif len(roi_coords) >= 3:
+        return 'polygon'
+    raise ValueError('Could not determine the shape of ROI: {}'.format(roi_coords))
+
+def roi_bounds(roi_coords):
+    """
+    (x_start, y_start, x_end, y_end) bounding box of an ROI, ends are exclusive
+    """
+    shape = roi_shape(roi_coords)
+    if shape == 'rectangle':
+        start_pos, end_pos = roi_coords
+        return int(start_pos[0]), int(start_pos[1]), int(end_pos[0]), int(end_pos[1])
+    if shape == 'circle':
+        x, y, radius = roi_coords[0]
+        points = np.array([[x - radius, y - radius], [x + radius, y + radius]], dtype=float)
+    else:
+        points = np.asarray(roi_coords, dtype=float)
+    x_start, y_start = np.floor(points.min(axis=0)).astype(int)
+    x_end, y_end = np.ceil(points.max(axis=0)).astype(int) + 1
+    return x_start, y_start, x_end, y_end
+
+def roi_mask(roi_coords, origin, mask_shape):
+    """
+    Binary (0/255) mask of a polygon or circle ROI inside its crop, whose
+    upper left corner is at origin (x, y) in the frame. None for rectangles.
+    """
+    shape = roi_shape(roi_coords)
+    if shape == 'rectangle':
+        return None
+    mask = np.zeros(mask_shape, np.uint8)
+    if shape == 'circle':
+        x, y, radius = roi_coords[0]
+        cv2.circle(mask, (int(round(x - origin[0])), int(round(y - origin[1]))), int(round(radius)), 255, -1)
+    else:
+        vertices = np.round(np.asarray(roi_coords, dtype=float) - origin).astype(np.int32)
+        cv2.fillPoly(mask, [vertices], 255)
+    return mask
+
+def plate_rois(rows, cols, first_center, last_center, radius, prefix='roi'):
+    """
+    Circle ROIs for the wells of a multi-well plate (i.e. 4x6 or 8x12)
+    first_center, last_center: [x,y] centers of the upper left and lower right wells
+    Wells are named prefix1, prefix2... row by row. Returns the roi_list and the roi_dict
+    """
+    xs = np.linspace(first_center[0], last_center[0], cols)
+    ys = np.linspace(first_center[1], last_center[1], rows)
+    roi_list = []
+    roi_dict = {}
+    for indx, (y, x) in enumerate(itertools.product(ys, xs)):
+        roi_name = '{}{}'.format(prefix, indx + 1)
+        roi_list.append(roi_name)
+        roi_dict[roi_name] = (np.array([x, y, radius]).round().astype(int),)
+    return roi_list, roi_dict
+
+def load_roi_file(filepath):
+    """
+    Read an ROI .json file saved by the GUI (roi_name -> list of points, see roi_shape())
+    Returns the (naturally) sorted roi_list and the roi_dict
+    """
+    with open(filepath, 'r') as data_file:
+        data = json.load(data_file)
+    roi_list = sorted([str(roi_key) for roi_key in data.keys()], key=roi_sort_key)
+    roi_dict = {roi_name:tuple([np.array(element) for element in data[roi_name]]) for roi_name in roi_list}
+    return roi_list, roi_dict
+
+def scale_roi_coords(roi_coords, scale):
+    """
+    ROI coordinates for frames that were resized by 'scale' (i.e. for 
+    reduced resolution analysis). ROIs are always selected and saved at 
+    full camera resolution.
+    """
+    if scale == 1:
+        return roi_coords
+    return [np.round(np.asarray(pos, dtype=float) * scale).astype(int) for pos in roi_coords]
+
+def scale_counter_kwargs(counter_kwargs, scale):
+    """
+    Blob area thresholds (in pixels) scale with the square of the frame scale
+    """
+    scaled_kwargs = dict(counter_kwargs)
+    for key in ('min_area', 'max_area'):
+        if scaled_kwargs.get(key):
+            scaled_kwargs[key] = scaled_kwargs[key] * scale**2
+    return scaled_kwargs
+
+def count_contours(mask, min_area=0, max_area=None):
+    """
+    Count blobs in a mask with cv2.findContours(). Blob area is the contour area.
+    Returns the count and the list of contours
+    """
+    #OpenCV 3 returns (image, contours, hierarchy), OpenCV 4 (contours, hierarchy)
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if min_area or max_area is not None:
+        max_area = float('inf') if max_area is None else max_area
+        contours = [contour for contour in contours if min_area <= cv2.contourArea(contour) <= max_area]
+    return len(contours), contours
+
+def count_components(mask, min_area=0, max_area=None, labels=None):
+    """
+    Count blobs in a mask with cv2.connectedComponentsWithStats(). Blob area
+    is the number of pixels in the blob.
+    labels: optional preallocated int32 label image (same shape as mask)
+    Returns the count, the (x, y, w, h, area) stats and the (n, 2) x, y 
+    centroids of every counted blob
+    """
+    num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, labels, connectivity=8)
+    #label 0 is the background
+    stats = stats[1:]
+    centroids = centroids[1:]
+    if min_area or max_area is not None:
+        areas = stats[:, cv2.CC_STAT_AREA]
+        keep = areas >= min_area
+        if max_area is not None:
+            keep &= areas <= max_area
+        stats = stats[keep]
+        centroids = centroids[keep]
+    return len(stats), stats, centroids
+
+def contour_centroids(contours):
+    """
+    (n, 2) array of the x, y centroids of a list of contours
+    """
+    centroids = np.zeros((len(contours), 2))
+    for indx, contour in enumerate(contours):
+        moments = cv2.moments(contour)
+        if moments['m00']:
+            centroids[indx] = moments['m10']/moments['m00'], moments['m01']/moments['m00']
+        else:
+            #degenerate (i.e. single pixel wide) contours have no area
+            centroids[indx] = contour.reshape(-1, 2).mean(axis=0)
+    return centroids
+
+def annotate_blobs(cropped_frame, blobs, counter):
+    if counter == 'components':
+        for x, y, w, h, area in blobs:
+            cv2.rectangle(cropped_frame, (x, y), (x + w, y + h), (255,0,0), 2)
+    else:
+        cv2.drawContours(cropped_frame, blobs, -1, (255,0,0), 2)
+
+class roi_plan(object):
+    """
+    Everything needed to analyze one ROI, computed once per experiment.
+
+    roi_coords: the ROI in any of the formats of roi_shape()
+    frame_shape: shape of the frames the ROI will be cropped from
+    counter, min_area, max_area: see get_activity_counts()
+    blur_size: aperture of the median blur applied to the motion mask (odd)
+    dilate_size: size of the elliptical kernel the motion mask is dilated with
+    track_kwargs: if not None, blob centroids are linked from frame to frame
+                  by a centroid_tracker created with these kwargs (see
+                  centroid_tracker.py), available as self.tracker
+    """
+    def __init__(self, roi_coords, frame_shape, counter='contours', min_area=0, max_area=None,
+                 blur_size=7, dilate_size=3, track_kwargs=None):
+        x_start, y_start, x_end, y_end = roi_bounds(roi_coords)
+        #Image cropping works by img[y: y + h, x: x + w]
+        self.y_slice = slice(max(0, y_start), y_end)
+        self.x_slice = slice(max(0, x_start), x_end)
+        height = len(range(*self.y_slice.indices(frame_shape[0])))
+        width = len(range(*self.x_slice.indices(frame_shape[1])))
+        self.shape = (height, width)
+        #polygon and circle ROIs only count motion inside of the ROI
+        self.mask = roi_mask(roi_coords, (self.x_slice.start, self.y_slice.start), self.shape)
+
+        self.counter = counter
+        self.min_area = min_area
+        self.max_area = max_area
+        self.blur_size = blur_size
+        #A kernel to do morphology operations with
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (dilate_size, dilate_size))
+        #destination buffers reused for every frame
+        self.fgmask = np.zeros(self.shape, np.uint8)
+        self.filtered = np.zeros(self.shape, np.uint8)
+        self.dilated = np.zeros(self.shape, np.uint8)
+        self.labels = np.zeros(self.shape, np.int32)
+        self.tracker = None if track_kwargs is None else centroid_tracker(**track_kwargs)
+        #(n, 2) centroids of the blobs counted in the most recent frame (only when tracking)
+        self.centroids = np.zeros((0, 2))
+        #if set to a stage_timing.stage_timer, process() records how long
+        #background subtraction, filtering and counting take
+        self.timer = None
+
+    def crop(self, frame):
+        return frame[self.y_slice, self.x_slice]
+
+    def motion_mask(self, bg_subtractor, cropped_frame):
+        #Apply the appropriate background subtractor to the cropped current frame of the video
+        bg_subtractor.apply(cropped_frame, self.fgmask)
+        return self.filter_mask()
+
+    def filter_mask(self):
+        # Apply a medianblur filter and then morphological dilate to
+        # remove noise and consolidate detections
+        cv2.medianBlur(self.fgmask, self.blur_size, self.filtered)
+        cv2.dilate(self.filtered, self.kernel, self.dilated)
+        if self.mask is not None:
+            cv2.bitwise_and(self.dilated, self.mask, self.dilated)
+        return self.dilated
+
+    def count(self, mask):
+        if self.counter == 'components':
+            count, stats, centroids = count_components(mask, self.min_area, self.max_area, self.labels)
+            if self.tracker:
+                self.centroids = centroids
+            return count, stats
+        count, contours = count_contours(mask, self.min_area, self.max_area)
+        if self.tracker:
+            self.centroids = contour_centroids(contours)
+        return count, contours
+
+    def process(self, bg_subtractor, current_frame, annotate=True, time_stamp=None):
+        """
+        Returns the number of moving objects in the ROI and the cropped frame
+        (annotated if annotate is True). Note that the cropped frame is a view
+        so annotations are drawn onto current_frame.
+        When tracking, time_stamp (sec) of the frame is needed for speed estimates.
+        """
+        cropped_current_frame = self.crop(current_frame)
+        timer = self.timer
+        if timer is None:
+            count, blobs = self.count(self.motion_mask(bg_subtractor, cropped_current_frame))
+            if self.tracker:
+                self.tracker.update(self.centroids, time_stamp)
+        else:
+            start = clock()
+            bg_subtractor.apply(cropped_current_frame, self.fgmask)
+            subtracted = clock()
+            mask = self.filter_mask()
+            filtered = clock()
+            count, blobs = self.count(mask)
+            if self.tracker:
+                self.tracker.update(self.centroids, time_stamp)
+            counted = clock()
+            timer.record('bg_subtraction', subtracted - start)
+            timer.record('filtering', filtered - subtracted)
+            timer.record('counting', counted - filtered)
+        if annotate:
+            annotate_blobs(cropped_current_frame, blobs, self.counter)
+        return count, cropped_current_frame
+
+def get_activity_counts(bg_subtractor, current_frame, roi_coords, counter='contours',
+                        min_area=0, max_area=None, annotate=True):
+    """
+    Count the number of moving objects in an ROI of the current frame.
+    Returns the count and the cropped frame (annotated if annotate is True).
+    Note that the cropped frame is a view so annotations are drawn onto current_frame.
+
+    This builds a new roi_plan on every call, for repeated calls on the same
+    ROI build a roi_plan once and use its process() method instead.
+    """
+    plan = roi_plan(roi_coords, current_frame.shape, counter, min_area, max_area)
+    return plan.process(bg_subtractor, current_frame, annotate)
+
+def roi_analysis_worker(conn, roi_jobs, frame_rings, counter_kwargs, bg_model, backgrounds,
+                        track_kwargs=None, time_stages=False):
+    """
+    Worker process loop. Receives (frame ring index, slot index, annotate, timestamp)
+    of each new frame, analyzes its own ROIs on that frame ring and sends back
+    their counts (in the same order as they appear in roi_jobs). When tracking,
+    (count, distance moved) pairs are sent back instead. A slot index of None
+    ends the worker, which then sends back the tracker summaries of all its
+    ROIs (if tracking) and the stage_timer of its ROIs (if time_stages).
+
+    roi_jobs: list of (frame ring index, roi coordinates) this worker owns
+    frame_rings, backgrounds: one of each per frame ring
+    """
+    #These background subtractors and roi plans persist for the entire experiment
+    timer = stage_timer() if time_stages else None
+    plans = []
+    work = dict((ring_indx, []) for ring_indx in range(len(frame_rings)))
+    for ring_indx, roi_coords in roi_jobs:
+        plan = roi_plan(roi_coords, frame_rings[ring_indx].frame_shape, track_kwargs=track_kwargs, **counter_kwargs)
+        plan.timer = timer
+        background = backgrounds[ring_indx]
+        bg_subtractor = create_bg_subtractor(bg_model, None if background is None else plan.crop(background))
+        plans.append(plan)
+        work[ring_indx].append((plan, bg_subtractor))
+    ring_frames = [frame_ring.frames for frame_ring in frame_rings]
+    while True:
+        ring_indx, slot, annotate, time_stamp = conn.recv()
+        if slot is None:
+            break
+        frame = ring_frames[ring_indx][slot]
+        if track_kwargs is None:
+            conn.send([plan.process(bg_subtractor, frame, annotate)[0] for plan, bg_subtractor in work[ring_indx]])
+        else:
+            conn.send([(plan.process(bg_subtractor, frame, annotate, time_stamp)[0], plan.tracker.last_distance) 
+                       for plan, bg_subtractor in work[ring_indx]])
+    summaries = [plan.tracker.summary() for plan in plans] if track_kwargs is not None else None
+    conn.send((summaries, timer))
+    conn.close()
+
+class roi_analysis_pool(object):
+    """
+    Pool of worker processes that each analyze a fixed subset of the ROIs.
+
+    roi_list: names of all ROIs (results are returned in this order)
+    roi_dict: roi_name -> roi coordinates
+    frame_ring: the shared_frame_ring frames are read from
+    num_workers: number of worker processes (never more than the number of ROIs)
+    counter_kwargs: counter, min_area and max_area for get_activity_counts()
+    bg_model, background: see create_bg_subtractor(). background is the full frame
+    track_kwargs: see roi_plan. When tracking, the distance moved in each ROI in 
+                  the most recently analyzed frame is kept in self.distances
+    time_stages: time the analysis stages of every ROI (see stage_timing.py),
+                 after close() the workers' stage timers are merged into self.timer
+
+    One pool can also be shared by several cameras: frame_ring is then a list
+    of frame rings, roi_list holds (ring index, roi_name) pairs, roi_dict is
+    keyed by those pairs and background is a list with one (or None) per ring.
+    ROIs of all cameras are dealt out over the same workers.
+    """
+    def __init__(self, roi_list, roi_dict, frame_ring, num_workers=None, counter_kwargs=None,
+                 bg_model='knn', background=None, track_kwargs=None, time_stages=False):
+        self.roi_list = list(roi_list)
+        self.tracking = track_kwargs is not None
+        self.timer = stage_timer() if time_stages else None
+        if isinstance(frame_ring, (list, tuple)):
+            frame_rings = list(frame_ring)
+            backgrounds = list(background) if background is not None else [None] * len(frame_rings)
+            ring_of = lambda roi_key: roi_key[0]
+        else:
+            frame_rings = [frame_ring]
+            backgrounds = [background]
+            ring_of = lambda roi_key: 0
+        #ROIs of every frame ring, results of a ring's frames are returned in this order
+        self.ring_rois = [[roi_key for roi_key in self.roi_list if ring_of(roi_key) == ring_indx] 
+                          for ring_indx in range(len(frame_rings))]
+        self.distances = [0.0] * len(self.ring_rois[0])
+        if not num_workers:
+            num_workers = mp.cpu_count()
+        num_workers = max(1, min(num_workers, len(self.roi_list)))
+        #deal ROIs out to the workers round robin style
+        self.worker_rois = [self.roi_list[indx::num_workers] for indx in range(num_workers)]
+        #workers that have to see the frames of each ring
+        self.ring_workers = [[worker_indx for worker_indx, roi_keys in enumerate(self.worker_rois)
+                              if any(ring_of(roi_key) == ring_indx for roi_key in roi_keys)]
+                             for ring_indx in range(len(frame_rings))]
+        self.ring_of = ring_of
+        #ring index of every frame that was submitted but not yet collected
+        self.pending = deque()
+        self.conns = []
+        self.workers = []
+        for roi_keys in self.worker_rois:
+            parent_conn, child_conn = mp.Pipe()
+            roi_jobs = [(ring_of(roi_key), roi_dict[roi_key]) for roi_key in roi_keys]
+            worker = mp.Process(target=roi_analysis_worker,
+                                args=(child_conn, roi_jobs, frame_rings, counter_kwargs or {},
+                                      bg_model, backgrounds, track_kwargs, time_stages))
+            worker.daemon = True
+            worker.start()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+
+    @property
+    def num_workers(self):
+        return len(self.workers)
+
+    def submit(self, slot, annotate=False, time_stamp=None, ring_indx=0):
+        """
+        Hand the frame in a frame ring slot to the workers that own ROIs on
+        that ring without waiting for the results (see collect()). Frames of
+        different rings can be in flight at the same time.
+        """
+        for worker_indx in self.ring_workers[ring_indx]:
+            self.conns[worker_indx].send((ring_indx, slot, annotate, time_stamp))
+        self.pending.append(ring_indx)
+
+    def collect(self):
+        """
+        Wait for the results of the oldest submitted frame and return the
+        counts of its ring's ROIs (in ring_rois order)
+        """
+        ring_indx = self.pending.popleft()
+        ring_of = self.ring_of
+        roi_results = {}
+        for worker_indx in self.ring_workers[ring_indx]:
+            roi_keys = [roi_key for roi_key in self.worker_rois[worker_indx] if ring_of(roi_key) == ring_indx]
+            roi_results.update(zip(roi_keys, self.conns[worker_indx].recv()))
+        ring_rois = self.ring_rois[ring_indx]
+        if self.tracking:
+            self.distances = [roi_results[roi_key][1] for roi_key in ring_rois]
+            return [roi_results[roi_key][0] for roi_key in ring_rois]
+        return [roi_results[roi_key] for roi_key in ring_rois]
+
+    def analyze(self, slot, annotate=False, time_stamp=None, ring_indx=0):
+        """
+        Analyze the frame in a frame ring slot on all workers at once and
+        return the counts in roi_list order. Every worker gets frames in the
+        order they were captured so background models stay in frame order.
+        If annotate is True, workers draw detections into the shared frame.
+        """
+        self.submit(slot, annotate, time_stamp, ring_indx)
+        return self.collect()
+
+    def close(self):
+        """
+        Stop the workers. When tracking, returns roi_name -> tracker summary
+        """
+        while self.pending:
+            self.collect()
+        for conn in self.conns:
+            conn.send((None, None, False, None))
+        summaries = {}
+        for roi_keys, conn in zip(self.worker_rois, self.conns):
+            worker_summaries, worker_timer = conn.recv()
+            if self.tracking:
+                summaries.update(zip(roi_keys, worker_summaries))
+            if self.timer is not None:
+                self.timer.merge(worker_timer)
+        for worker in self.workers:
+            worker.join()
+        for conn in self.conns:
+            conn.close()
+        return summaries
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Shared memory ring buffer used to pass video frames from the control_expt()
+camera process to the experiment analysis loop.
+
+Sending frames through a multiprocessing Queue pickles and copies the whole
+frame twice. Instead, frames are copied once into one of a fixed number of
+preallocated slots in shared memory and only a small (timestamp, slot, stim)
+tuple goes through the queue. The consumer reads each frame as a NumPy view
+of its slot (no copy) and hands the slot back with release() when done.
+
+If the consumer falls so far behind that every slot is still in use, the new
+frame is not written (slots the consumer may still be looking at are never
+overwritten). Instead an 'overrun' message with the frame's timestamp is sent
+so the consumer knows exactly which frame was lost. Alternatively the producer
+can be made to block until a slot is free (block_when_full=True).
+
+frame_drop_policy decides on the consumer side which waiting frames to skip
+when the consumer lags behind, so memory use stays bounded on long runs.
+"""
+import time
+import multiprocessing as mp
+
+import numpy as np
+
+OVERRUN_MSG = 'overrun'
+DROP_POLICIES = ('block', 'drop_newest', 'drop_oldest', 'every_nth')
+
+class shared_frame_ring(object):
+    """
+    Preallocated ring of fixed size frame slots in shared memory.
+
+    frame_shape: shape of every frame that will be put in the ring (h, w, d)
+    num_slots: number of frames that can be waiting for the consumer at once
+    dtype: numpy dtype of the frames
+    block_when_full: if True the producer waits for a free slot instead of
+                     dropping the new frame (reporting an overrun)
+    """
+    def __init__(self, frame_shape, num_slots=64, dtype=np.uint8, block_when_full=False):
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.num_slots = int(num_slots)
+        self.block_when_full = block_when_full
+        self.slot_nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+
+        self._shared_buffer = mp.RawArray('B', self.num_slots * self.slot_nbytes)
+        #Only the consumer writes 'released' and only the producer writes
+        #'written' and 'overruns' so none of these counters needs a lock
+        self._written = mp.RawValue('L', 0)
+        self._released = mp.RawValue('L', 0)
+        self._overruns = mp.RawValue('L', 0)
+        #the small metadata channel: (timestamp, slot index or message, stim_bool)
+        self.meta_q = mp.Queue()
+        self._frames = None
+
+    def __getstate__(self):
+        #Don't pickle the numpy views of the shared buffer, they are rebuilt
+        #on first use in whichever process the ring ends up in
+        state = self.__dict__.copy()
+        state['_frames'] = None
+        return state
+
+    @property
+    def frames(self):
+        """
+        (num_slots, h, w, d) numpy view onto the shared memory slots
+        """
+        if self._frames is None:
+            self._frames = np.frombuffer(self._shared_buffer, dtype=self.dtype).reshape((self.num_slots,) + self.frame_shape)
+        return self._frames
+
+    @property
+    def overruns(self):
+        return self._overruns.value
+
+    def slots_in_use(self):
+        """
+        Number of frames that have been written but not yet released
+        (this is the number of frames the consumer is lagging behind by)
+        """
+        return self._written.value - self._released.value
+
+    #================= producer side ========================
+    def next_slot(self):
+        """
+        Returns the (index, view) of the next free slot or (None, None) if
+        the consumer has not yet released any of the slots. If the ring was
+        created with block_when_full, waits until a slot is released instead.
+        """
+        while self.slots_in_use() >= self.num_slots:
+            if not self.block_when_full:
+                return None, None
+            time.sleep(0.0005)
+        slot = self._written.value % self.num_slots
+        return slot, self.frames[slot]
+
+    def commit_slot(self, slot, time_stamp, stim_bool, notify=True):
+        """
+        Hand a slot that was filled in place (see next_slot()) to the consumer
+        If notify is False nothing is sent through the metadata channel, for
+        producers that hand slot indices to their consumers some other way
+        """
+        self._written.value += 1
+        if notify:
+            self.meta_q.put_nowait((time_stamp, slot, stim_bool))
+
+    def put(self, time_stamp, frame, stim_bool):
+        """
+        Copy a frame into the next free slot and notify the consumer.
+        Returns False (and reports an overrun) if there was no free slot.
+        """
+        slot, slot_view = self.next_slot()
+        if slot is None:
+            self.report_overrun(time_stamp, stim_bool)
+            return False
+        np.copyto(slot_view, frame)
+        self.commit_slot(slot, time_stamp, stim_bool)
+        return True
+
+    def report_overrun(self, time_stamp, stim_bool):
+        self._overruns.value += 1
+        self.meta_q.put_nowait((time_stamp, OVERRUN_MSG, stim_bool))
+
+    def put_message(self, time_stamp, msg, stim_bool):
+        """
+        Send a string message (i.e. 'stop') through the metadata channel
+        """
+        self.meta_q.put_nowait((time_stamp, msg, stim_bool))
+
+    #================= consumer side ========================
+    def get_slot(self, block=True, timeout=None):
+        """
+        Returns (timestamp, slot index, stim_bool) or (timestamp, message, stim_bool)
+        Useful when the slot index is handed on to other processes.
+        """
+        return self.meta_q.get(block, timeout)
+
+    def get(self, block=True, timeout=None):
+        """
+        Returns (timestamp, frame, stim_bool) where frame is a zero-copy view
+        of the slot. Messages (i.e. 'stop' or 'overrun') are returned as strings
+        in place of the frame.
+
+        The frame view is only valid until release() is called!
+        """
+        time_stamp, item, stim_bool = self.get_slot(block, timeout)
+        if isinstance(item, str):
+            return time_stamp, item, stim_bool
+        return time_stamp, self.frames[item], stim_bool
+
+    def release(self):
+        """
+        Give the oldest frame slot returned by get() back to the producer
+        """
+        self._released.value += 1
+
+    def qsize(self):
+        return self.meta_q.qsize()
+
+    def close(self):
+        self.meta_q.close()
+
+    def join_thread(self):
+        self.meta_q.join_thread()
+
+class frame_drop_policy(object):
+    """
+    Decides which frames the consumer should skip when it lags behind.
+
+    policy: one of DROP_POLICIES
+        'block': never skip, the producer waits for free slots (backpressure)
+        'drop_newest': never skip, the producer drops new frames when the ring is full
+        'drop_oldest': skip the oldest waiting frames until lag is back under max_lag
+        'every_nth': while lag is over max_lag only analyze every nth frame
+    max_lag: number of waiting frames tolerated before skipping starts
+    every_nth: see 'every_nth' policy
+    """
+    def __init__(self, policy='drop_newest', max_lag=32, every_nth=2):
+        if policy not in DROP_POLICIES:
+            raise ValueError('Unknown frame drop policy "{}"! Choose one of: {}'.format(policy, DROP_POLICIES))
+        self.policy = policy
+        self.max_lag = max_lag
+        self.every_nth = max(1, int(every_nth))
+        self._lagged_frames = 0
+
+    @property
+    def block_when_full(self):
+        return self.policy == 'block'
+
+    def skip_frame(self, lag):
+        """
+        lag: number of frames still waiting behind the current one
+        Returns True if the current frame should not be analyzed
+        """
+        if lag <= self.max_lag or self.policy in ('block', 'drop_newest'):
+            self._lagged_frames = 0
+            return False
+        if self.policy == 'drop_oldest':
+            return True
+        #every_nth: analyze the 1st, (n+1)th, (2n+1)th... frame while lagging
+        skip = self._lagged_frames % self.every_nth != 0
+        self._lagged_frames += 1
+        return skip
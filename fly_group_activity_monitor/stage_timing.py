@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Low overhead latency instrumentation of the experiment's hot paths.
+
+Every stage of the pipeline records how long it took in a latency_histogram:
+    camera process: 'capture_read', 'undistort', 'video_write'
+    analysis loop: 'queue_transit' (capture timestamp to analysis start, live
+                   cameras only), 'analysis' (all ROIs of a frame), 'plotting',
+                   'display' (time the analysis loop spends on each)
+    per ROI (analysis loop or workers): 'bg_subtraction', 'filtering', 'counting'
+    renderers: 'plot_render', 'display_render'
+Histograms have fixed, logarithmically spaced bins (BINS_PER_DECADE per
+factor of 10 from MIN_LATENCY to MAX_LATENCY) so recording a latency is a few
+arithmetic operations and one list increment, memory use never grows during
+a run and histograms from different processes (camera process, analysis
+workers, display process) can simply be added up with merge().
+
+Timing is off by default. At the end of an experiment run with
+time_stages=True all stages are written to
+'<timestring>-stage_timing.json' next to the .csv files, with the count,
+mean, min, max and 50/90/99/99.9th percentiles (in ms) of every stage and the
+non-empty histogram bins. The stage with the largest mean (or high
+percentiles) is the one capping the frame rate.
+
+Percentiles are read off the histogram, so they are accurate to the width of
+one bin (about 12% with the default 20 bins per decade).
+"""
+import json
+import math
+
+BINS_PER_DECADE = 20
+#latencies below MIN_LATENCY (or above MAX_LATENCY) go into the first (last) bin
+MIN_LATENCY = 1e-6
+MAX_LATENCY = 100.0
+NUM_BINS = int(round(math.log10(MAX_LATENCY / MIN_LATENCY) * BINS_PER_DECADE)) + 2
+PERCENTILES = (50, 90, 99, 99.9)
+
+def bin_edges(indx):
+    """
+    (lower, upper) latency (sec) of histogram bin indx
+    """
+    if indx == 0:
+        return 0.0, MIN_LATENCY
+    if indx == NUM_BINS - 1:
+        return MAX_LATENCY, float('inf')
+    return (MIN_LATENCY * 10**((indx - 1) / float(BINS_PER_DECADE)),
+            MIN_LATENCY * 10**(indx / float(BINS_PER_DECADE)))
+
+class latency_histogram(object):
+    def __init__(self):
+        self.counts = [0] * NUM_BINS
+        self.num = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds > MIN_LATENCY:
+            indx = min(NUM_BINS - 1, int(math.log10(seconds / MIN_LATENCY) * BINS_PER_DECADE) + 1)
+        else:
+            indx = 0
+        self.counts[indx] += 1
+        self.num += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.num += other.num
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.num if self.num else 0.0
+
+    def percentile(self, q):
+        """
+        Upper edge of the bin the q-th percentile latency falls in (sec)
+        """
+        if not self.num:
+            return 0.0
+        target = self.num * q / 100.0
+        cumulative = 0
+        for indx, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= target:
+                return min(bin_edges(indx)[1], self.max)
+        return self.max
+
+    def to_dict(self):
+        """
+        Summary (latencies in ms) and the non-empty [lower ms, upper ms, count]
+        bins (the upper edge of the overflow bin is None)
+        """
+        summary = {"count": self.num, "mean_ms": self.mean * 1e3,
+                   "min_ms": self.min * 1e3 if self.num else 0.0, "max_ms": self.max * 1e3}
+        for q in PERCENTILES:
+            summary["p{}_ms".format(q).replace('.', '_')] = self.percentile(q) * 1e3
+        summary["histogram"] = [[bin_edges(indx)[0] * 1e3, 
+                                 bin_edges(indx)[1] * 1e3 if indx < NUM_BINS - 1 else None, count]
+                                for indx, count in enumerate(self.counts) if count]
+        return summary
+
+class stage_timer(object):
+    """
+    One latency_histogram per stage name
+    """
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = latency_histogram()
+        histogram.record(seconds)
+
+    def merge(self, other):
+        """
+        Add the histograms of another stage_timer (i.e. one sent back by another process)
+        """
+        if other is None:
+            return
+        for stage, histogram in other.stages.items():
+            if stage in self.stages:
+                self.stages[stage].merge(histogram)
+            else:
+                self.stages[stage] = histogram
+
+    def to_dict(self):
+        return dict((stage, histogram.to_dict()) for stage, histogram in self.stages.items())
+
+    def summary_lines(self):
+        """
+        One line per stage (slowest mean first) for printing
+        """
+        lines = []
+        for stage, histogram in sorted(self.stages.items(), key=lambda item: -item[1].mean):
+            lines.append('{:<16} n={:<8} mean={:8.3f} ms  p50={:8.3f} ms  p99={:8.3f} ms  max={:8.3f} ms'.format(
+                         stage, histogram.num, histogram.mean * 1e3, histogram.percentile(50) * 1e3,
+                         histogram.percentile(99) * 1e3, histogram.max * 1e3))
+        return lines
+
+    def write_json(self, filepath, **info):
+        """
+        Write all stages (plus any extra info about the run) to a .json file
+        """
+        report = dict(info)
+        report["stages"] = self.to_dict()
+        with open(filepath, 'w') as outfile:
+            json.dump(report, outfile, indent=2, sort_keys=True)
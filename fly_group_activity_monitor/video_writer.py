@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous ffmpeg video writer used by the control_expt() camera loop.
+
+Writing frames straight to the ffmpeg pipe in the camera loop means every
+time ffmpeg stalls on encoding, the camera loop (and our frame timing)
+stalls with it. Here frames are copied into one of a fixed number of
+preallocated buffers and a background thread writes the buffers to ffmpeg's
+stdin directly (no frame.tostring() copy). If ffmpeg falls so far behind that
+no buffer is free, the frame is dropped from the video (and counted) rather
+than slowing down the camera loop.
+
+Frames are copied once (into the writer's own buffers) rather than handed to
+the writer thread as is: the frame the camera loop writes is either a slot of
+the shared frame ring, which the analysis loop releases (and the camera loop
+then overwrites) long before ffmpeg may get to it, or a buffer that is reused
+for the next frame (the full resolution frame when analyzing downscaled
+frames, or the raw frame when the ring is full). Holding ring slots until
+ffmpeg is done with them would also let a slow encoder starve the analysis.
+"""
+import sys
+import threading
+import subprocess as sp
+
+import numpy as np
+
+#If we are using python 2.7 or under
+if sys.version_info[0] < 3:
+    import Queue as queue
+#If we are using python 3.0 or above
+elif sys.version_info[0] >= 3:
+    import queue
+
+class async_video_writer(object):
+    """
+    ffmpeg_command: full ffmpeg command line, must read rawvideo from stdin ('-i', '-')
+    frame_shape: shape of the frames that will be written (h, w, d)
+    num_buffers: max number of frames waiting to be written before frames are dropped
+    """
+    def __init__(self, ffmpeg_command, frame_shape, dtype=np.uint8, num_buffers=64):
+        #Note to self, don't try to redirect stout or sterr to sp.PIPE as filling the pipe up will cause subprocess to hang really bad :(
+        self.process = sp.Popen(ffmpeg_command, stdin=sp.PIPE)
+        self.buffers = np.empty((num_buffers,) + tuple(frame_shape), dtype)
+
+        self.free_q = queue.Queue()
+        for indx in range(num_buffers):
+            self.free_q.put(indx)
+        self.write_q = queue.Queue()
+
+        #writer statistics
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.max_lag = 0
+        self.failed = False
+
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def lag(self):
+        """
+        Number of frames waiting to be written to ffmpeg
+        """
+        return self.write_q.qsize()
+
+    def write(self, frame):
+        """
+        Queue a frame to be written. Never blocks. Returns False if the frame
+        had to be dropped because the writer is lagging too far behind.
+        """
+        try:
+            indx = self.free_q.get_nowait()
+        except queue.Empty:
+            self.frames_dropped += 1
+            return False
+        np.copyto(self.buffers[indx], frame)
+        self.write_q.put(indx)
+        lag = self.write_q.qsize()
+        if lag > self.max_lag:
+            self.max_lag = lag
+        return True
+
+    def _write_loop(self):
+        stdin = self.process.stdin
+        while True:
+            indx = self.write_q.get()
+            if indx is None:
+                break
+            if not self.failed:
+                try:
+                    #write the buffer itself, no intermediate byte string copy
+                    stdin.write(self.buffers[indx].data)
+                    self.frames_written += 1
+                except (IOError, OSError):
+                    #ffmpeg has gone away, keep draining so the camera loop isn't affected
+                    self.failed = True
+                    print("Video writer: ffmpeg stopped accepting frames!")
+            self.free_q.put(indx)
+
+    def close(self):
+        """
+        Flush all frames still waiting to be written and let ffmpeg finish
+        """
+        self.write_q.put(None)
+        self.thread.join()
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+    def stats(self):
+        return {"frames_written": self.frames_written,
+                "frames_dropped": self.frames_dropped,
+                "max_lag": self.max_lag}
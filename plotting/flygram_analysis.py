@@ -75,7 +75,7 @@ def load_flygram_experiments(bin_size = 10, raw_data_path = None,
         key_df = pd.read_csv(expt_key_path)
         
         #Determine file paths for raw .csv data from the flyGrAM expts
-        files_to_analyze = glob.glob('{basedir}/*/*-roi?.csv'.format(basedir = raw_data_path))
+        files_to_analyze = glob.glob('{basedir}/*/*-roi[0-9]*.csv'.format(basedir = raw_data_path))
     
         treatments = list(set(key_df['Treatment'].values)) 
         try:
@@ -96,7 +96,7 @@ def load_flygram_experiments(bin_size = 10, raw_data_path = None,
                 datetime = df_tuple[1]
                 roi = df_tuple[2]
                 num_flies = df_tuple[3]
-                path = [path for path in files_to_analyze if (datetime in path) and ('roi{}'.format(roi) in path)]
+                path = [path for path in files_to_analyze if (datetime in path) and path.endswith('-roi{}.csv'.format(roi))]
             
                 try:
                     data = pd.read_csv(path[0])
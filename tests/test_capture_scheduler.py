@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the deadline capture scheduler with a fake clock: missed frame slots
+are skipped after a stall instead of being captured in a burst
+"""
+import pytest
+
+import capture_scheduler
+
+class fake_clock(object):
+    """
+    Clock that only moves when slept on, or a tick per call (a spin loop)
+    """
+    def __init__(self, tick=1e-5):
+        self.now = 0.0
+        self.tick = tick
+        self.sleeps = []
+
+    def clock(self):
+        self.now += self.tick
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    fake = fake_clock()
+    monkeypatch.setattr(capture_scheduler, 'clock', fake.clock)
+    monkeypatch.setattr(capture_scheduler.time, 'sleep', fake.sleep)
+    return fake
+
+def capture(scheduler, fake, num_frames):
+    """
+    (scheduled time, clock time relative to start()) of every captured frame
+    """
+    frames = []
+    for indx in range(num_frames):
+        scheduled_time = scheduler.wait_for_next_frame()
+        frames.append((scheduled_time, fake.now - scheduler.start_time))
+    return frames
+
+def test_frames_are_captured_on_schedule(fake_time):
+    scheduler = capture_scheduler.capture_scheduler(10)
+    scheduler.start()
+    frames = capture(scheduler, fake_time, 5)
+    assert [scheduled for scheduled, captured in frames] == pytest.approx([0, 0.1, 0.2, 0.3, 0.4])
+    for scheduled, captured in frames:
+        assert scheduled <= captured < scheduled + 0.001
+    assert scheduler.missed_slots == 0
+
+def test_missed_slots_are_skipped_after_a_stall(fake_time):
+    scheduler = capture_scheduler.capture_scheduler(10)
+    scheduler.start()
+    before = capture(scheduler, fake_time, 3)
+    #the camera read stalls for 5.5 frame periods
+    fake_time.now += 0.55
+    after = capture(scheduler, fake_time, 3)
+    scheduled_times = [scheduled for scheduled, captured in before + after]
+    #slots 0.3 to 0.6 are skipped, the next frame is the one due in the current slot
+    assert scheduled_times == pytest.approx([0, 0.1, 0.2, 0.7, 0.8, 0.9])
+    assert scheduler.missed_slots == 4
+    #no burst: after the late frame, frames are a whole period apart again
+    captured_times = [captured for scheduled, captured in after]
+    assert captured_times[1] - captured_times[0] > 0.04
+    assert captured_times[2] - captured_times[1] == pytest.approx(0.1, abs=0.001)
+
+def test_less_than_a_period_behind_is_caught_up_without_skipping(fake_time):
+    scheduler = capture_scheduler.capture_scheduler(10)
+    scheduler.start()
+    capture(scheduler, fake_time, 3)
+    fake_time.now += 0.15
+    frames = capture(scheduler, fake_time, 2)
+    assert [scheduled for scheduled, captured in frames] == pytest.approx([0.3, 0.4])
+    assert scheduler.missed_slots == 0
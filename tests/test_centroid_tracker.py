@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the mutual nearest neighbour centroid matching and distance/speed bookkeeping
+"""
+import numpy as np
+import pytest
+
+from centroid_tracker import match_centroids, centroid_tracker
+
+def points(*xys):
+    return np.array(xys, dtype=float).reshape(-1, 2)
+
+@pytest.mark.parametrize('prev_centroids, centroids', [
+    (points(), points()),
+    (points(), points([1, 1], [5, 5])),
+    (points([1, 1], [5, 5]), points()),
+])
+def test_empty_inputs(prev_centroids, centroids):
+    prev_indxs, indxs, distances = match_centroids(prev_centroids, centroids, 10)
+    assert len(prev_indxs) == len(indxs) == len(distances) == 0
+
+def test_links_are_gated_by_max_distance():
+    prev_indxs, indxs, distances = match_centroids(points([0, 0]), points([3, 4]), 4.9)
+    assert len(distances) == 0
+    #max_distance itself is still linked
+    prev_indxs, indxs, distances = match_centroids(points([0, 0]), points([3, 4]), 5)
+    assert list(prev_indxs) == [0]
+    assert list(indxs) == [0]
+    assert list(distances) == [5]
+
+def test_only_mutual_nearest_neighbours_are_linked():
+    #both previous blobs are closest to the one current blob, which is closest to the second
+    prev_indxs, indxs, distances = match_centroids(points([0, 0], [3, 0]), points([2, 0]), 10)
+    assert list(prev_indxs) == [1]
+    assert list(indxs) == [0]
+    assert list(distances) == [1]
+    #and the other way around
+    prev_indxs, indxs, distances = match_centroids(points([0, 0]), points([2, 0], [1, 0]), 10)
+    assert list(prev_indxs) == [0]
+    assert list(indxs) == [1]
+
+def test_matching_does_not_depend_on_blob_order():
+    prev_indxs, indxs, distances = match_centroids(points([0, 0], [10, 0]), points([11, 0], [1, 0]), 5)
+    assert list(prev_indxs) == [0, 1]
+    assert list(indxs) == [1, 0]
+    assert list(distances) == [1, 1]
+
+def test_mean_speed_is_distance_per_fly_second():
+    tracker = centroid_tracker(max_distance=10)
+    assert tracker.update(points([0, 0], [20, 0]), 0.0) == 0
+    #two flies each move 1 px in 0.5 sec: 2 px over 1 fly-second
+    assert tracker.update(points([1, 0], [21, 0]), 0.5) == 2
+    assert tracker.mean_speed == pytest.approx(2.0)
+    #one fly moves 3 px in 0.5 sec, the other stops being detected
+    assert tracker.update(points([4, 0]), 1.0) == 3
+    assert tracker.total_distance == 5
+    assert tracker.total_time == pytest.approx(1.5)
+    assert tracker.mean_speed == pytest.approx(5 / 1.5)
+    assert tracker.summary() == {"total_distance": 5, "mean_speed": tracker.mean_speed, "num_links": 3}
+
+def test_distances_are_reported_in_full_resolution_pixels():
+    tracker = centroid_tracker(max_distance=10, px_scale=2.0)
+    tracker.update(points([0, 0]), 0.0)
+    assert tracker.update(points([3, 4]), 1.0) == 10
+    assert tracker.mean_speed == pytest.approx(10.0)
+
+def test_no_speed_without_links():
+    tracker = centroid_tracker()
+    tracker.update(points([0, 0]), 0.0)
+    tracker.update(points(), 1.0)
+    assert tracker.mean_speed == 0.0
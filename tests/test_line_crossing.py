@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the beam crossing detector on synthetic line strips
+"""
+import numpy as np
+
+import roi_analysis
+from line_crossing import line_crossing_detector, is_line_roi, widen_strip, MIN_THICKNESS
+
+FRAME_SHAPE = (40, 30)
+#vertical line strip 4 pixels wide: beam A is x 10-11, beam B is x 12-13
+STRIP = (np.array([10, 0]), np.array([14, 40]))
+BEAM_A = (10, 12)
+BEAM_B = (12, 14)
+#a fly halfway across the line covers one column of each beam
+ON_LINE = (11, 13)
+
+def strip_frame(*flies):
+    """
+    Bright frame with a dark fly for every (y_start, y_end, (x_start, x_end))
+    """
+    frame = np.full(FRAME_SHAPE, 200, np.uint8)
+    for y_start, y_end, (x_start, x_end) in flies:
+        frame[y_start:y_end, x_start:x_end] = 30
+    return frame
+
+def run_detector(frames):
+    detector = line_crossing_detector(STRIP, FRAME_SHAPE)
+    counts = [detector.process(None, frame, annotate=False)[0] for frame in frames]
+    return counts, detector.pop_events()
+
+def test_left_to_right_crossing():
+    frames = [strip_frame(), strip_frame((18, 22, BEAM_A)), strip_frame((18, 22, ON_LINE)),
+              strip_frame((18, 22, BEAM_B)), strip_frame()]
+    counts, events = run_detector(frames)
+    assert counts == [0, 0, 0, 0, 1]
+    assert events == [(20, 'left_to_right')]
+
+def test_right_to_left_crossing():
+    frames = [strip_frame(), strip_frame((18, 22, BEAM_B)), strip_frame((18, 22, ON_LINE)),
+              strip_frame((18, 22, BEAM_A)), strip_frame()]
+    counts, events = run_detector(frames)
+    assert sum(counts) == 1
+    assert events == [(20, 'right_to_left')]
+
+def test_fly_that_backs_out_is_not_a_crossing():
+    frames = [strip_frame(), strip_frame((18, 22, BEAM_A)), strip_frame((18, 22, ON_LINE)),
+              strip_frame((18, 22, BEAM_A)), strip_frame()]
+    counts, events = run_detector(frames)
+    assert sum(counts) == 0
+    assert events == []
+
+def test_two_flies_crossing_at_once():
+    frames = [strip_frame(),
+              strip_frame((5, 9, BEAM_A), (30, 34, BEAM_B)),
+              strip_frame((5, 9, ON_LINE), (30, 34, ON_LINE)),
+              strip_frame((5, 9, BEAM_B), (30, 34, BEAM_A)),
+              strip_frame()]
+    counts, events = run_detector(frames)
+    assert counts[-1] == 2
+    assert sorted(events) == [(7, 'left_to_right'), (32, 'right_to_left')]
+
+def test_is_line_roi():
+    assert is_line_roi('line1')
+    assert is_line_roi('line12')
+    assert not is_line_roi('roi1')
+    assert not is_line_roi('outline1')
+    assert not is_line_roi('baseline')
+
+def test_scaled_down_line_is_widened():
+    #a default 3 pixel wide line at a quarter of the camera resolution is
+    #less than 1 pixel wide, it is widened to two beams around its center
+    roi_coords = roi_analysis.scale_roi_coords((np.array([42, 0]), np.array([45, 160])), 0.25)
+    detector = line_crossing_detector(roi_coords, FRAME_SHAPE)
+    assert detector.line_mode == 'vertical'
+    assert detector.thickness == MIN_THICKNESS
+    #scaled to x 10-11, widened to x 9-11
+    assert (detector.x_slice.start, detector.x_slice.stop) == (9, 11)
+    frames = [strip_frame(), strip_frame((18, 22, (9, 10))), strip_frame((18, 22, (9, 11))),
+              strip_frame((18, 22, (10, 11))), strip_frame()]
+    counts = [detector.process(None, frame, annotate=False)[0] for frame in frames]
+    assert counts == [0, 0, 0, 0, 1]
+    assert detector.pop_events() == [(20, 'left_to_right')]
+
+def test_widen_strip_stays_inside_the_frame():
+    assert widen_strip(5, 9, 30) == (5, 9)
+    assert widen_strip(0, 0, 30) == (0, 2)
+    assert widen_strip(30, 30, 30) == (28, 30)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the durability contract of the streaming csv writer: .partial files
+that are only renamed on close(), periodic fsync and writer thread errors
+"""
+import os
+import csv
+import time
+
+import pytest
+
+import results_writer
+from results_writer import streaming_csv_writer, PARTIAL_EXT
+
+HEADER = ["Time Elapsed (sec)", "Number of active flies"]
+
+def read_csv(filepath):
+    with open(filepath, 'r') as infile:
+        return list(csv.reader(infile))
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def test_partial_files_are_renamed_on_close(tmpdir):
+    filepath = str(tmpdir.join('expt-roi1.csv'))
+    writer = streaming_csv_writer()
+    writer.add_table('roi1', filepath, HEADER)
+    writer.write_rows([('roi1', [0.1, 3]), ('roi1', [0.2, 4])])
+    assert os.path.exists(filepath + PARTIAL_EXT)
+    assert not os.path.exists(filepath)
+    writer.close()
+    assert not os.path.exists(filepath + PARTIAL_EXT)
+    assert read_csv(filepath) == [HEADER, ['0.1', '3'], ['0.2', '4']]
+    assert writer.rows_written == 2
+
+def test_interrupted_run_leaves_partial_files(tmpdir):
+    filepath = str(tmpdir.join('expt-roi1.csv'))
+    writer = streaming_csv_writer(flush_interval=0.01)
+    writer.add_table('roi1', filepath, HEADER)
+    writer.write_rows([('roi1', [0.1, 3])])
+    #the experiment never gets to close() the writer, but the flushed rows are on disk
+    assert wait_for(lambda: read_csv(filepath + PARTIAL_EXT) == [HEADER, ['0.1', '3']])
+    assert not os.path.exists(filepath)
+    #stop the writer thread without close() so it doesn't outlive the test
+    writer.row_q.put(None)
+    writer.thread.join()
+    assert not os.path.exists(filepath)
+
+def test_files_are_fsynced_every_flush_interval(tmpdir, monkeypatch):
+    fsynced = []
+    monkeypatch.setattr(results_writer.os, 'fsync', fsynced.append)
+    writer = streaming_csv_writer(flush_interval=0.02)
+    writer.add_table('roi1', str(tmpdir.join('expt-roi1.csv')), HEADER)
+    writer.add_table('roi2', str(tmpdir.join('expt-roi2.csv')), HEADER)
+    #every table is fsynced on every flush, even without new rows
+    assert wait_for(lambda: len(fsynced) >= 6)
+    writer.close()
+
+def test_nothing_is_fsynced_before_the_flush_interval(tmpdir, monkeypatch):
+    fsynced = []
+    monkeypatch.setattr(results_writer.os, 'fsync', fsynced.append)
+    writer = streaming_csv_writer(flush_interval=60)
+    writer.add_table('roi1', str(tmpdir.join('expt-roi1.csv')), HEADER)
+    writer.write_rows([('roi1', [0.1, 3])])
+    time.sleep(0.1)
+    assert fsynced == []
+    #close() flushes the remaining rows
+    writer.close()
+    assert len(fsynced) == 1
+
+def test_writer_thread_errors_are_raised_by_the_caller(tmpdir):
+    filepath = str(tmpdir.join('expt-roi1.csv'))
+    writer = streaming_csv_writer()
+    writer.add_table('roi1', filepath, HEADER)
+    writer.write_rows([('roi1', [0.1, 3])])
+    writer.write_rows([('unknown_table', [0.2, 4])])
+    writer.thread.join(5.0)
+    assert isinstance(writer.error, KeyError)
+    with pytest.raises(KeyError):
+        writer.write_rows([('roi1', [0.3, 5])])
+    with pytest.raises(KeyError):
+        writer.close()
+    #the truncated file is not renamed as if it were complete
+    assert os.path.exists(filepath + PARTIAL_EXT)
+    assert not os.path.exists(filepath)
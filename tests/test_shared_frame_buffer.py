@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the shared memory frame ring (a real RawArray ring, used from one
+process) and of the consumer side frame drop policies
+"""
+import threading
+
+import numpy as np
+import pytest
+
+from shared_frame_buffer import shared_frame_ring, frame_drop_policy, OVERRUN_MSG, DROP_POLICIES
+
+FRAME_SHAPE = (4, 6)
+
+def make_ring(num_slots, block_when_full=False):
+    return shared_frame_ring(FRAME_SHAPE, num_slots=num_slots, dtype=np.uint8,
+                             block_when_full=block_when_full)
+
+def make_frame(value):
+    return np.full(FRAME_SHAPE, value, np.uint8)
+
+def test_slots_wrap_around():
+    ring = make_ring(3)
+    slots = []
+    for value in range(7):
+        slot, view = ring.next_slot()
+        slots.append(slot)
+        np.copyto(view, make_frame(value))
+        ring.commit_slot(slot, value, False, notify=False)
+        assert (ring.frames[slot] == value).all()
+        ring.release()
+    assert slots == [0, 1, 2, 0, 1, 2, 0]
+    assert ring.slots_in_use() == 0
+    assert ring.overruns == 0
+
+def test_put_and_get_reuse_released_slots():
+    ring = make_ring(2)
+    for value in range(5):
+        assert ring.put(value * 0.1, make_frame(value), False)
+        time_stamp, frame, stim_bool = ring.get(True, 1)
+        assert time_stamp == value * 0.1
+        assert (frame == value).all()
+        ring.release()
+    ring.close()
+    ring.join_thread()
+
+def test_overrun_when_all_slots_in_use():
+    ring = make_ring(2)
+    assert ring.put(0.0, make_frame(1), False)
+    assert ring.put(0.1, make_frame(2), False)
+    assert ring.next_slot() == (None, None)
+    assert not ring.put(0.2, make_frame(3), True)
+    assert ring.overruns == 1
+    assert ring.slots_in_use() == 2
+    #the frames waiting for the consumer were not overwritten
+    assert (ring.frames[0] == 1).all()
+    assert (ring.frames[1] == 2).all()
+    assert ring.get_slot(True, 1) == (0.0, 0, False)
+    assert ring.get_slot(True, 1) == (0.1, 1, False)
+    assert ring.get_slot(True, 1) == (0.2, OVERRUN_MSG, True)
+    #once the oldest frame is released its slot is used again
+    ring.release()
+    assert ring.put(0.3, make_frame(4), False)
+    time_stamp, frame, stim_bool = ring.get(True, 1)
+    assert time_stamp == 0.3
+    assert (frame == 4).all()
+    assert (ring.frames[0] == 4).all()
+    ring.close()
+    ring.join_thread()
+
+def test_release_accounting():
+    ring = make_ring(4)
+    for value in range(3):
+        ring.put(value, make_frame(value), False)
+    assert ring.slots_in_use() == 3
+    for expected in (2, 1, 0):
+        ring.release()
+        assert ring.slots_in_use() == expected
+    #a full ring again, but now starting at slot 3
+    for value in range(4):
+        assert ring.put(value, make_frame(value), False)
+    assert ring.slots_in_use() == 4
+    assert ring.next_slot() == (None, None)
+    assert ring.overruns == 0
+
+def test_block_when_full_waits_for_release():
+    ring = make_ring(1, block_when_full=True)
+    ring.put(0.0, make_frame(1), False)
+    releaser = threading.Timer(0.05, ring.release)
+    releaser.start()
+    slot, view = ring.next_slot()
+    releaser.join()
+    assert slot == 0
+    assert ring.overruns == 0
+
+#(policy, max_lag, every_nth, lag of every consecutive frame, expected skips)
+DROP_POLICY_CASES = [
+    ('block', 2, 2, [0, 5, 10, 1], [False, False, False, False]),
+    ('drop_newest', 2, 2, [0, 5, 10, 1], [False, False, False, False]),
+    ('drop_oldest', 2, 2, [0, 2, 3, 10, 2], [False, False, True, True, False]),
+    ('drop_oldest', 0, 2, [0, 1, 0, 1], [False, True, False, True]),
+    #analyze the 1st, 3rd... lagging frame and start counting again once caught up
+    ('every_nth', 2, 2, [3, 3, 3, 3, 1, 3, 3], [False, True, False, True, False, False, True]),
+    ('every_nth', 0, 3, [0, 1, 1, 1, 1, 1], [False, False, True, True, False, True]),
+    ('every_nth', 0, 1, [1, 1, 1], [False, False, False]),
+    #every_nth is at least 1
+    ('every_nth', 0, 0, [1, 1, 1], [False, False, False]),
+]
+
+@pytest.mark.parametrize('policy, max_lag, every_nth, lags, expected', DROP_POLICY_CASES)
+def test_frame_drop_policy(policy, max_lag, every_nth, lags, expected):
+    drop_policy = frame_drop_policy(policy, max_lag, every_nth)
+    assert [drop_policy.skip_frame(lag) for lag in lags] == expected
+
+def test_only_block_policy_blocks_the_producer():
+    assert frame_drop_policy('block').block_when_full
+    for policy in DROP_POLICIES:
+        if policy != 'block':
+            assert not frame_drop_policy(policy).block_when_full
+
+def test_unknown_drop_policy():
+    with pytest.raises(ValueError):
+        frame_drop_policy('drop_all')
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the log binned latency histograms and of merging stage timers
+"""
+import pytest
+
+from stage_timing import latency_histogram, stage_timer, BINS_PER_DECADE, MIN_LATENCY, MAX_LATENCY
+
+#relative width of one histogram bin
+BIN_WIDTH = 10**(1.0 / BINS_PER_DECADE)
+
+def histogram_of(samples):
+    histogram = latency_histogram()
+    for seconds in samples:
+        histogram.record(seconds)
+    return histogram
+
+#1 to 100 ms
+SAMPLES = [indx * 1e-3 for indx in range(1, 101)]
+
+@pytest.mark.parametrize('q, true_latency', [(50, 50e-3), (90, 90e-3), (99, 99e-3)])
+def test_percentiles_are_within_one_bin(q, true_latency):
+    histogram = histogram_of(SAMPLES)
+    #the upper edge of the bin the percentile falls in, never above the max
+    assert true_latency <= histogram.percentile(q) <= min(true_latency * BIN_WIDTH, max(SAMPLES))
+
+def test_summary_of_known_samples():
+    histogram = histogram_of(SAMPLES)
+    assert histogram.num == 100
+    assert histogram.min == 1e-3
+    assert histogram.max == 100e-3
+    assert histogram.mean == pytest.approx(50.5e-3)
+    assert histogram.percentile(100) == 100e-3
+    summary = histogram.to_dict()
+    assert summary["count"] == 100
+    assert summary["p99_9_ms"] == pytest.approx(100)
+    assert sum(count for lower, upper, count in summary["histogram"]) == 100
+
+def test_identical_samples_percentiles_are_exact():
+    histogram = histogram_of([2e-3] * 10)
+    for q in (1, 50, 99.9):
+        assert histogram.percentile(q) == 2e-3
+
+def test_out_of_range_latencies():
+    histogram = histogram_of([MIN_LATENCY / 10, MAX_LATENCY * 10])
+    assert histogram.counts[0] == 1
+    assert histogram.counts[-1] == 1
+    assert histogram.percentile(50) == MIN_LATENCY
+    assert histogram.percentile(100) == MAX_LATENCY * 10
+
+def test_empty_histogram():
+    histogram = latency_histogram()
+    assert histogram.mean == 0.0
+    assert histogram.percentile(50) == 0.0
+    assert histogram.to_dict()["min_ms"] == 0.0
+
+def test_merge_equals_recording_everything_in_one_timer():
+    first, second, combined = stage_timer(), stage_timer(), stage_timer()
+    for indx, seconds in enumerate(SAMPLES):
+        (first if indx % 3 else second).record('analysis', seconds)
+        combined.record('analysis', seconds)
+    first.record('capture_read', 5e-3)
+    second.record('display_render', 20e-3)
+    combined.record('capture_read', 5e-3)
+    combined.record('display_render', 20e-3)
+    first.merge(second)
+    assert sorted(first.stages) == ['analysis', 'capture_read', 'display_render']
+    merged = first.stages['analysis']
+    expected = combined.stages['analysis']
+    assert merged.counts == expected.counts
+    assert merged.num == expected.num == 100
+    assert merged.total == pytest.approx(expected.total)
+    assert (merged.min, merged.max) == (expected.min, expected.max)
+    for q in (50, 90, 99):
+        assert merged.percentile(q) == expected.percentile(q)
+    assert first.stages['display_render'].num == 1
+
+def test_merge_none_is_a_no_op():
+    timer = stage_timer()
+    timer.record('analysis', 1e-3)
+    timer.merge(None)
+    assert timer.stages['analysis'].num == 1